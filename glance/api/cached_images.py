@@ -89,9 +89,17 @@ class Controller(controller.BaseController):
         Queues an image for caching. We do not check to see if
         the image is in the registry here. That is done by the
         prefetcher...
+
+        An optional ``priority`` query parameter raises the image ahead of
+        the images queued with a lower one.
         """
         self._enforce(req)
-        self.cache.queue_image(image_id)
+        try:
+            priority = float(req.params.get('priority', 0))
+        except ValueError:
+            msg = _("Image priority must be a number")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        self.cache.queue_image(image_id, priority=priority)
 
     def delete_queued_image(self, req, image_id):
         """
@@ -111,6 +119,23 @@ class Controller(controller.BaseController):
         self._enforce(req)
         return dict(num_deleted=self.cache.delete_all_queued_images())
 
+    def get_cache_stats(self, req):
+        """
+        GET /cache_stats
+
+        Returns a mapping of the cache's counters, summed over all the
+        processes using the cache, and of its current size.
+        """
+        self._enforce(req)
+        return dict(cache_stats=self.cache.get_stats())
+
+    def reset_cache_stats(self, req):
+        """
+        DELETE /cache_stats - Set the cache's counters back to zero
+        """
+        self._enforce(req)
+        self.cache.reset_stats()
+
 
 class CachedImageDeserializer(wsgi.JSONRequestDeserializer):
     pass
@@ -16,6 +16,8 @@
 from oslo.config import cfg
 
 from glance.common import exception
+from glance.common import utils
+from glance.common import wsgi
 from glance.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -55,6 +57,44 @@ def size_checked_iter(response, image_meta, expected_size, image_iter,
                                           "image %(image_id)s") % locals())
 
 
+def image_body(response, image_meta, expected_size, image_iter, notifier):
+    """
+    Return the response body for an image download.
+
+    Image data held in a local file is wrapped in a `SendFileBody`, so the
+    server can transmit it with sendfile(2). Everything else, and any
+    response whose body is consumed by a middleware, is streamed through
+    `size_checked_iter`.
+    """
+    if not wsgi.is_sendfile_source(image_iter):
+        return size_checked_iter(response, image_meta, expected_size,
+                                 image_iter, notifier)
+
+    fallback = size_checked_iter(response, image_meta, expected_size,
+                                 utils.cooperative_iter(image_iter), notifier)
+    body = wsgi.SendFileBody(image_iter, fallback=fallback)
+
+    def notify_image_sent_hook(env):
+        # NOTE: size_checked_iter sends the notification itself when the
+        # body was iterated rather than sent with sendfile.
+        if not body.attached:
+            return
+        if expected_size != body.bytes_sent:
+            msg = _("Backend storage for image %(image_id)s "
+                    "disconnected after writing only %(bytes_sent)d "
+                    "bytes") % {'image_id': image_meta['id'],
+                                'bytes_sent': body.bytes_sent}
+            LOG.error(msg)
+        image_send_notification(body.bytes_sent, expected_size,
+                                image_meta, response.request, notifier)
+
+    if 'eventlet.posthooks' in response.request.environ:
+        response.request.environ['eventlet.posthooks'].append(
+            (notify_image_sent_hook, (), {}))
+
+    return body
+
+
 def image_send_notification(bytes_written, expected_size, image_meta, request,
                             notifier):
     """Send an image.send message to the notifier."""
@@ -26,39 +26,62 @@ the local cached copy of the image file is returned.
 
 import re
 
+from oslo.config import cfg
 import webob
+import webob.dec
 
-from glance.api.common import size_checked_iter
+from glance.api.common import image_body
 from glance.api import policy
 from glance.api.v1 import images
 from glance.common import exception
-from glance.common import utils
 from glance.common import wsgi
 import glance.db
 from glance import image_cache
+from glance.image_cache import peers
+from glance.openstack.common import excutils
 import glance.openstack.common.log as logging
 from glance import notifier
 import glance.registry.client.v1.api as registry
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+CONF.import_opt('image_cache_coalesce_fills', 'glance.image_cache')
+CONF.import_opt('image_cache_block_size', 'glance.image_cache')
+CONF.import_opt('image_cache_metadata_ttl', 'glance.image_cache')
+
 PATTERNS = {
     ('v1', 'GET'): re.compile(r'^/v1/images/([^\/]+)$'),
     ('v1', 'DELETE'): re.compile(r'^/v1/images/([^\/]+)$'),
+    ('v1', 'PUT'): re.compile(r'^/v1/images/([^\/]+)$'),
     ('v2', 'GET'): re.compile(r'^/v2/images/([^\/]+)/file$'),
-    ('v2', 'DELETE'): re.compile(r'^/v2/images/([^\/]+)$')
+    ('v2', 'DELETE'): re.compile(r'^/v2/images/([^\/]+)$'),
+    ('v2', 'PATCH'): re.compile(r'^/v2/images/([^\/]+)$')
 }
 
 
 class CacheFilter(wsgi.Middleware):
 
+    peers = None
+
     def __init__(self, app):
         self.cache = image_cache.ImageCache()
         self.serializer = images.ImageSerializer()
         self.policy = policy.Enforcer()
+        self.peers = peers.PeerGroup.from_config()
         LOG.info(_("Initialized image cache middleware"))
         super(CacheFilter, self).__init__(app)
 
+    @webob.dec.wsgify
+    def __call__(self, request):
+        try:
+            return super(CacheFilter, self).__call__(request)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # process_response never ran, so a claim taken by
+                # process_request would be left for followers to wait on
+                self._release_fill(request)
+
     def _verify_metadata(self, image_meta):
         """
         Sanity check the 'deleted' and 'size' metadata values.
@@ -116,16 +139,29 @@ class CacheFilter(wsgi.Middleware):
 
         self._stash_request_info(request, image_id, method)
 
-        if request.method != 'GET' or not self.cache.is_cached(image_id):
+        if request.method != 'GET':
             return None
 
+        if request.range is not None and CONF.image_cache_block_size:
+            return self._process_range_request(request, version, image_id)
+
+        if self.cache.is_cached(image_id):
+            LOG.debug(_("Cache hit for image '%s'"), image_id)
+            get_image_iterator = self.get_from_cache
+        else:
+            self.cache.record_miss(image_id)
+            if not self._follow_fill(request, image_id):
+                return self._process_peer_request(request, version, image_id)
+            LOG.debug(_("Cache miss for image '%s', reading it as it is "
+                        "written into the cache"), image_id)
+            get_image_iterator = self.get_from_fill
+
         try:
             self._enforce(request, 'download_image')
         except webob.exc.HTTPForbidden:
             return None
 
-        LOG.debug(_("Cache hit for image '%s'"), image_id)
-        image_iterator = self.get_from_cache(image_id)
+        image_iterator = get_image_iterator(image_id, request)
         method = getattr(self, '_process_%s_request' % version)
 
         try:
@@ -137,6 +173,78 @@ class CacheFilter(wsgi.Middleware):
             LOG.error(msg)
             self.cache.delete_cached_image(image_id)
 
+    def _process_peer_request(self, request, version, image_id):
+        """
+        Serve a cache miss by downloading the image from the peer API
+        server owning it, caching it on the way. Returns None, to pass the
+        request on to the store, if there is no such peer, if the request
+        itself comes from a peer, or if the peer fails to send the image.
+        """
+        if self.peers is None or peers.PEER_HEADER in request.headers:
+            return None
+        peer = self.peers.get_owner(image_id)
+        if peer is None:
+            return None
+
+        try:
+            self._enforce(request, 'download_image')
+        except webob.exc.HTTPForbidden:
+            return None
+
+        try:
+            peer_iter, headers = self.peers.fetch(
+                peer, request, self._store_fetcher(request, image_id))
+        except exception.GlanceException as e:
+            LOG.info(_("%(e)s, reading image '%(image_id)s' from the "
+                       "store instead"), {'e': e, 'image_id': image_id})
+            return None
+        LOG.debug(_("Cache miss for image '%(image_id)s', reading it from "
+                    "peer %(peer)s"), {'image_id': image_id, 'peer': peer})
+        if headers.get('content-length'):
+            self.cache.record_bytes_served('peers',
+                                           int(headers['content-length']))
+
+        claimed = request.environ.pop('api.cache.fill_claimed', False)
+        image_checksum = (headers.get('content-md5') or
+                          headers.get('x-image-meta-checksum'))
+        image_size = (headers.get('x-image-meta-size') or
+                      headers.get('content-length'))
+        image_iterator = self._get_caching_iter(
+            request, image_id, image_checksum,
+            int(image_size) if image_size else None,
+            headers.get('x-image-meta-disk_format'), peer_iter, claimed)
+        method = getattr(self, '_process_%s_request' % version)
+        try:
+            return method(request, image_id, image_iterator)
+        except exception.NotFound:
+            peer_iter.close()
+            if claimed and image_iterator is not peer_iter:
+                # The caching iterator holding the claim never started
+                self.cache.release_fill(image_id)
+            return None
+
+    def _follow_fill(self, request, image_id):
+        """
+        Returns True if another request is writing the image into the
+        cache, in which case this one should read it from there. Otherwise
+        try to claim filling the cache for this request, if the image
+        may be admitted into the cache.
+        """
+        if not CONF.image_cache_coalesce_fills:
+            return False
+        if self.cache.may_admit(image_id) and self.cache.claim_fill(image_id):
+            request.environ['api.cache.fill_claimed'] = True
+            return False
+        return self.cache.is_being_filled(image_id)
+
+    def _release_fill(self, request):
+        """
+        Give up this request's claim on filling the cache, if it has one
+        """
+        if request.environ.pop('api.cache.fill_claimed', False):
+            image_id = request.environ['api.cache.image_id']
+            self.cache.release_fill(image_id)
+
     @staticmethod
     def _stash_request_info(request, image_id, method):
         """
@@ -159,12 +267,114 @@ class CacheFilter(wsgi.Middleware):
         else:
             return (image_id, method)
 
-    def _process_v1_request(self, request, image_id, image_iterator):
+    def _process_range_request(self, request, version, image_id):
+        """
+        Serve a request for a range of an image's data from the cached
+        image, or from the image's cached blocks, reading the blocks that
+        are missing from the store. Returns None, to pass the request on,
+        if the image's size is unknown or the range cannot be satisfied.
+        """
+        try:
+            self._enforce(request, 'download_image')
+        except webob.exc.HTTPForbidden:
+            return None
+
+        try:
+            image_meta = self._get_image_meta(request, version, image_id)
+        except (exception.NotFound, exception.Forbidden):
+            return None
+        if (image_meta['deleted'] or image_meta['status'] != 'active' or
+                not image_meta['size']):
+            return None
+
+        image_size = int(image_meta['size'])
+        byte_range = request.range.range_for_length(image_size)
+        if byte_range is None:
+            return None
+        start, stop = byte_range
+
+        if self.cache.is_cached(image_id):
+            LOG.debug(_("Cache hit for range of image '%s'"), image_id)
+            image_iterator = image_cache.CachedImageFile(
+                self.cache, image_id, start, stop - start)
+        else:
+            LOG.debug(_("Reading range of image '%s' from its cached "
+                        "blocks"), image_id)
+            self.cache.record_miss(image_id)
+            admitted = self._admit(request, image_id, image_size,
+                                   image_meta.get('disk_format'))
+            try:
+                image_iterator = self.cache.get_range_iter(
+                    image_id, image_size, image_meta['checksum'], start,
+                    stop, self._store_fetcher(request, image_id),
+                    admitted=admitted)
+            except exception.GlanceException as e:
+                LOG.debug(e)
+                return None
+
+        response = webob.Response(request=request, status=206)
+        response.app_iter = image_body(response, image_meta, stop - start,
+                                       image_iterator, notifier.Notifier())
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, image_size)
+        if version == 'v1':
+            # NOTE: The checksum is that of the whole image, which clients
+            # would check the range against
+            partial_meta = dict(image_meta)
+            partial_meta.pop('checksum', None)
+            self.serializer._inject_image_meta_headers(response,
+                                                       partial_meta)
+        return response
+
+    @staticmethod
+    def _may_see(context, image_meta):
+        """
+        Returns True if the metadata kept for an image may be shown to the
+        requester without asking the registry, that is if the image is
+        public or owned by the requester, or the requester is an admin.
+        Images shared with the requester are looked up every time.
+        """
+        return (context.is_admin or image_meta.get('is_public') or
+                (context.owner is not None and
+                 context.owner == image_meta.get('owner')))
+
+    def _get_image_meta(self, request, version, image_id):
+        """
+        Returns the metadata of a cached image, from the snapshot kept in
+        the cache if there is a recent one the requester may see, and
+        otherwise from the registry (v1) or database (v2), in which case
+        a new snapshot is kept.
+        """
+        image_meta = self.cache.get_metadata_snapshot(image_id, version)
+        if image_meta is not None and self._may_see(request.context,
+                                                    image_meta):
+            LOG.debug(_("Using the cached metadata of image '%s'"), image_id)
+            return image_meta
+
+        get_image_meta = getattr(self, '_get_%s_image_meta' % version)
+        image_meta = get_image_meta(request, image_id)
+        if image_meta.get('status') == 'active' and not image_meta['deleted']:
+            self.cache.store_metadata_snapshot(image_id, version, image_meta)
+        return image_meta
+
+    def _get_v1_image_meta(self, request, image_id):
         image_meta = registry.get_image_metadata(request.context, image_id)
         # Don't display location
         if 'location' in image_meta:
             del image_meta['location']
         image_meta.pop('location_data', None)
+        return image_meta
+
+    def _get_v2_image_meta(self, request, image_id):
+        db_api = glance.db.get_api()
+        image_repo = glance.db.ImageRepo(request.context, db_api)
+        image = image_repo.get(image_id)
+        return glance.notifier.format_image_notification(image)
+
+    def _process_v1_request(self, request, image_id, image_iterator):
+        image_meta = self._get_image_meta(request, 'v1', image_id)
         self._verify_metadata(image_meta)
 
         response = webob.Response(request=request)
@@ -176,32 +386,29 @@ class CacheFilter(wsgi.Middleware):
 
     def _process_v2_request(self, request, image_id, image_iterator):
         # We do some contortions to get the image_metadata so
-        # that we can provide it to 'size_checked_iter' which
+        # that we can provide it to 'image_body' which
         # will generate a notification.
         # TODO(mclaren): Make notification happen more
         # naturally once caching is part of the domain model.
-        db_api = glance.db.get_api()
-        image_repo = glance.db.ImageRepo(request.context, db_api)
-        image = image_repo.get(image_id)
-        image_meta = glance.notifier.format_image_notification(image)
+        image_meta = self._get_image_meta(request, 'v2', image_id)
         self._verify_metadata(image_meta)
         response = webob.Response(request=request)
-        response.app_iter = size_checked_iter(response, image_meta,
-                                              image_meta['size'],
-                                              image_iterator,
-                                              notifier.Notifier())
+        response.app_iter = image_body(response, image_meta,
+                                       image_meta['size'],
+                                       image_iterator,
+                                       notifier.Notifier())
         # NOTE (flwang): Set the content-type, content-md5 and content-length
         # explicitly to be consistent with the non-cache scenario.
         # Besides, it's not worth the candle to invoke the "download" method
         # of ResponseSerializer under image_data. Because method "download"
         # will reset the app_iter. Then we have to call method
-        # "size_checked_iter" to avoid missing any notification. But after
-        # call "size_checked_iter", we will lose the content-md5 and
+        # "image_body" to avoid missing any notification. But after
+        # call "image_body", we will lose the content-md5 and
         # content-length got by the method "download" because of this issue:
         # https://github.com/Pylons/webob/issues/86
         response.headers['Content-Type'] = 'application/octet-stream'
-        response.headers['Content-MD5'] = image.checksum
-        response.headers['Content-Length'] = str(image.size)
+        response.headers['Content-MD5'] = image_meta['checksum']
+        response.headers['Content-Length'] = str(image_meta['size'])
         return response
 
     def process_response(self, resp):
@@ -211,6 +418,7 @@ class CacheFilter(wsgi.Middleware):
         if necessary
         """
         if not 200 <= self.get_status_code(resp) < 300:
+            self._release_fill(resp.request)
             return resp
 
         try:
@@ -232,29 +440,91 @@ class CacheFilter(wsgi.Middleware):
         if self.cache.is_cached(image_id):
             LOG.debug(_("Removing image %s from cache"), image_id)
             self.cache.delete_cached_image(image_id)
+        else:
+            self.cache.delete_metadata_snapshots(image_id)
         return resp
 
-    def _process_GET_response(self, resp, image_id):
-        image_checksum = resp.headers.get('Content-MD5', None)
-
-        if not image_checksum:
-            # API V1 stores the checksum in a different header:
-            image_checksum = resp.headers.get('x-image-meta-checksum', None)
-
-        if not image_checksum:
-            LOG.error(_("Checksum header is missing."))
+    def _process_PUT_response(self, resp, image_id):
+        self.cache.delete_metadata_snapshots(image_id)
+        return resp
 
-        # NOTE(zhiyan): image_cache return a generator object and set to
-        # response.app_iter, it will be called by eventlet.wsgi later.
-        # So we need enforce policy firstly but do it by application
-        # since eventlet.wsgi could not catch webob.exc.HTTPForbidden and
-        # return 403 error to client then.
-        self._enforce(resp.request, 'download_image')
+    _process_PATCH_response = _process_PUT_response
 
-        resp.app_iter = self.cache.get_caching_iter(image_id, image_checksum,
-                                                    resp.app_iter)
+    def _process_GET_response(self, resp, image_id):
+        claimed = resp.request.environ.pop('api.cache.fill_claimed', False)
+        try:
+            image_checksum = resp.headers.get('Content-MD5', None)
+
+            if not image_checksum:
+                # API V1 stores the checksum in a different header:
+                image_checksum = resp.headers.get('x-image-meta-checksum',
+                                                  None)
+
+            if not image_checksum:
+                LOG.error(_("Checksum header is missing."))
+
+            # NOTE(zhiyan): image_cache return a generator object and set to
+            # response.app_iter, it will be called by eventlet.wsgi later.
+            # So we need enforce policy firstly but do it by application
+            # since eventlet.wsgi could not catch webob.exc.HTTPForbidden and
+            # return 403 error to client then.
+            self._enforce(resp.request, 'download_image')
+
+            image_size = (resp.headers.get('x-image-meta-size') or
+                          resp.headers.get('Content-Length'))
+            image_size = int(image_size) if image_size else None
+            if image_size:
+                self.cache.record_bytes_served('backend', image_size)
+        except Exception:
+            # The claim is handed over to the caching iterator once it is
+            # set up, until then it is given back if anything goes wrong.
+            with excutils.save_and_reraise_exception():
+                if claimed:
+                    self.cache.release_fill(image_id)
+
+        resp.app_iter = self._get_caching_iter(
+            resp.request, image_id, image_checksum, image_size,
+            resp.headers.get('x-image-meta-disk_format'), resp.app_iter,
+            claimed)
         return resp
 
+    def _get_caching_iter(self, request, image_id, image_checksum,
+                          image_size, disk_format, image_iter, claimed):
+        """
+        Returns an iterator writing an image read from the store or a peer
+        into the cache as it goes, or `image_iter` itself if the image is
+        not admitted into the cache, in which case the request's claim on
+        filling the cache is given back.
+        """
+        try:
+            admitted = self._admit(request, image_id, image_size,
+                                   disk_format)
+            if admitted:
+                return self.cache.get_caching_iter(image_id, image_checksum,
+                                                   image_iter,
+                                                   claimed=claimed)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if claimed:
+                    self.cache.release_fill(image_id)
+        if claimed:
+            self.cache.release_fill(image_id)
+        return image_iter
+
+    def _admit(self, request, image_id, image_size, disk_format):
+        """
+        Returns True if an image should be written into the cache,
+        according to the cache's admission policy.
+        """
+        # API V2 does not send the disk format with the image data
+        if disk_format is None and self.cache.admission.needs_disk_format:
+            try:
+                image_meta = self._get_image_meta(request, 'v2', image_id)
+                disk_format = image_meta['disk_format']
+            except (exception.NotFound, exception.Forbidden):
+                pass
+        return self.cache.admit(image_id, image_size, disk_format)
+
     def get_status_code(self, response):
         """
         Returns the integer status code from the response, which
@@ -264,9 +534,32 @@ class CacheFilter(wsgi.Middleware):
             return response.status_int
         return response.status
 
-    def get_from_cache(self, image_id):
+    def get_from_cache(self, image_id, request=None):
         """Called if cache hit"""
-        with self.cache.open_for_read(image_id) as cache_file:
-            chunks = utils.chunkiter(cache_file)
-            for chunk in chunks:
-                yield chunk
+        return self.cache.get_image_file(image_id)
+
+    def get_from_fill(self, image_id, request):
+        """Called if another request is writing the image into the cache"""
+        return self.cache.get_tailing_iter(
+            image_id, self._store_fetcher(request, image_id))
+
+    def _store_fetcher(self, request, image_id):
+        """
+        Returns a callable returning an iterable over the whole image,
+        read from the store.
+        """
+        def fetch_from_store():
+            # NOTE: The request is passed down the pipeline without this
+            # middleware, so it is neither cached nor notified twice.
+            store_request = request.copy_get()
+            store_request.environ.pop('eventlet.posthooks', None)
+            store_request.range = None
+            response = store_request.get_response(self.application)
+            if not 200 <= self.get_status_code(response) < 300:
+                raise exception.GlanceException(
+                    _("Failed to read image %(image_id)s from the store: "
+                      "%(status)s") % {'image_id': image_id,
+                                       'status': response.status})
+            return response.app_iter
+
+        return fetch_from_store
@@ -68,6 +68,16 @@ class CacheManageFilter(wsgi.Middleware):
                        action="delete_queued_images",
                        conditions=dict(method=["DELETE"]))
 
+        mapper.connect("/v1/cache_stats",
+                       controller=resource,
+                       action="get_cache_stats",
+                       conditions=dict(method=["GET"]))
+
+        mapper.connect("/v1/cache_stats",
+                       controller=resource,
+                       action="reset_cache_stats",
+                       conditions=dict(method=["DELETE"]))
+
         self._mapper = mapper
         self._resource = resource
 
@@ -431,7 +431,8 @@ class Controller(controller.BaseController):
         else:
             image_iterator, size = self._get_from_store(req.context,
                                                         image_meta['location'])
-            image_iterator = utils.cooperative_iter(image_iterator)
+            if not wsgi.is_sendfile_source(image_iterator):
+                image_iterator = utils.cooperative_iter(image_iterator)
             image_meta['size'] = size or image_meta['size']
 
         image_meta = redact_loc(image_meta)
@@ -1058,7 +1059,7 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         image_iter = result['image_iterator']
         # image_meta['size'] should be an int, but could possibly be a str
         expected_size = int(image_meta['size'])
-        response.app_iter = common.size_checked_iter(
+        response.app_iter = common.image_body(
                 response, image_meta, expected_size, image_iter, self.notifier)
         # Using app_iter blanks content-length, so we set it here...
         response.headers['Content-Length'] = str(image_meta['size'])
@@ -146,7 +146,8 @@ def queue_image(options, args):
     """
 %(prog)s queue-image <IMAGE_ID> [options]
 
-Queues an image for caching"""
+Queues an image for caching. Images queued with a higher --priority are
+prefetched first."""
     try:
         image_id = args.pop()
     except IndexError:
@@ -160,7 +161,7 @@ Queues an image for caching"""
         return SUCCESS
 
     client = get_client(options)
-    client.queue_image_for_caching(image_id)
+    client.queue_image_for_caching(image_id, priority=options.priority)
 
     if options.verbose:
         print("Queued image %(image_id)s for caching" % locals())
@@ -260,6 +261,52 @@ Removes all images from the cache queue"""
     return SUCCESS
 
 
+@catch_error('show cache stats')
+def show_stats(options, args):
+    """
+%(prog)s stats [options]
+
+Show the counters of the image cache, such as its hits, misses and
+evictions, and its current size"""
+    client = get_client(options)
+    stats = client.get_cache_stats()
+
+    pretty_table = utils.PrettyTable()
+    pretty_table.add_column(24, label="Counter")
+    pretty_table.add_column(20, label="Value", just="r")
+
+    print(pretty_table.make_header())
+
+    for name in sorted(stats):
+        value = stats[name]
+        if value is None:
+            value = "N/A"
+        elif isinstance(value, float):
+            value = "%.3f" % value
+        print(pretty_table.make_row(name, value))
+
+    return SUCCESS
+
+
+@catch_error('reset cache stats')
+def reset_stats(options, args):
+    """
+%(prog)s reset-stats [options]
+
+Sets the counters of the image cache back to zero"""
+    if (not options.force and
+        not user_confirm("Reset the cache counters?", default=False)):
+        return SUCCESS
+
+    client = get_client(options)
+    client.reset_cache_stats()
+
+    if options.verbose:
+        print("Reset the cache counters")
+
+    return SUCCESS
+
+
 def get_client(options):
     """
     Returns a new client object to a Glance server
@@ -320,6 +367,10 @@ def create_options(parser):
                       default=False, action="store_true",
                       help="Prevent select actions from requesting "
                            "user confirmation")
+    parser.add_option('--priority', dest="priority", metavar="PRIORITY",
+                      type=float, default=None,
+                      help="Priority of an image queued for caching. Images "
+                           "of higher priority are prefetched first")
 
     parser.add_option('--os-auth-token',
                       dest='os_auth_token',
@@ -434,6 +485,8 @@ def lookup_command(parser, command_name):
         'delete-all-cached-images': delete_all_cached_images,
         'delete-queued-image': delete_queued_image,
         'delete-all-queued-images': delete_all_queued_images,
+        'stats': show_stats,
+        'reset-stats': reset_stats,
     }
 
     commands = {}
@@ -492,6 +545,10 @@ Commands:
     delete-queued-image         Deletes an image from the cache queue
 
     delete-all-queued-images    Deletes all images from the cache queue
+
+    stats                       Show the counters of the image cache
+
+    reset-stats                 Sets the counters of the image cache to zero
 """
 
     version_string = version.cached_version_string()
@@ -26,12 +26,19 @@ import functools
 import httplib
 import os
 import re
+import time
 import urllib
 import urlparse
 
 try:
+    from eventlet import patcher
     from eventlet.green import socket, ssl
+    # NOTE: idle connections are polled with the unpatched select, as the
+    # green one goes through the hub, which may still hold the state of
+    # an earlier socket that had the same file descriptor.
+    select = patcher.original('select')
 except ImportError:
+    import select
     import socket
     import ssl
 
@@ -53,6 +60,12 @@ CHUNKSIZE = 65536
 
 VERSION_REGEX = re.compile(r"/?v[0-9\.]+")
 
+# Seconds after which an idle connection is closed instead of being reused
+POOL_IDLE_TIMEOUT = 30
+
+# Number of idle connections kept open to each server
+POOL_MAX_IDLE = 8
+
 
 def handle_unauthenticated(func):
     """
@@ -130,6 +143,96 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
                                         cert_reqs=ssl.CERT_REQUIRED)
 
 
+def _is_alive(connection):
+    """
+    Return True if an idle connection can be reused, which is not the
+    case once the server closed it or sent something on it.
+    """
+    sock = connection.sock
+    if sock is None:
+        return False
+    try:
+        readable, writable, errored = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+class ConnectionPool(object):
+
+    """
+    Idle HTTP connections of this process, kept open so that later requests
+    to the same server skip the TCP and SSL handshakes.
+
+    :param idle_timeout: Seconds after which an idle connection is closed
+    :param max_idle: Number of idle connections kept for each server
+    """
+
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_idle=POOL_MAX_IDLE):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def _get_idle(self, key):
+        # NOTE: connections opened before a fork are shared with the
+        # parent process, and must not be used by both
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+        return self.idle.setdefault(key, [])
+
+    def _expire(self, connections):
+        oldest = time.time() - self.idle_timeout
+        while connections and connections[0][1] < oldest:
+            connection, released_at = connections.pop(0)
+            connection.close()
+
+    def get(self, key):
+        """
+        Return an idle connection for a key, or None if there is none.
+
+        :param key: Tuple of what the connections for a server are made of
+        """
+        connections = self._get_idle(key)
+        self._expire(connections)
+        while connections:
+            connection, released_at = connections.pop()
+            if _is_alive(connection):
+                return connection
+            connection.close()
+        return None
+
+    def put(self, key, connection):
+        """Keep a connection whose last response was read for reuse"""
+        connections = self._get_idle(key)
+        self._expire(connections)
+        if len(connections) >= self.max_idle:
+            connection.close()
+        else:
+            connections.append((connection, time.time()))
+
+    def release_on_close(self, key, connection, response):
+        """
+        Put a connection back in the pool once its response is read to
+        the end, unless the server is closing it.
+        """
+        close = response.close
+
+        def release():
+            reusable = (response.fp is not None and response.length == 0 and
+                        not response.will_close)
+            close()
+            if reusable:
+                self.put(key, connection)
+
+        response.close = release
+
+
+_POOL = ConnectionPool()
+
+
 class BaseClient(object):
 
     """A base client class"""
@@ -457,11 +560,21 @@ class BaseClient(object):
             if 'x-auth-token' not in headers and self.auth_tok:
                 headers['x-auth-token'] = self.auth_tok
 
-            c = connection_type(url.hostname, url.port, **self.connect_kwargs)
+            pool_key = (connection_type, url.hostname, url.port,
+                        tuple(sorted(self.connect_kwargs.items())))
+            c = _POOL.get(pool_key)
+            reused = c is not None
+            if c is None:
+                c = connection_type(url.hostname, url.port,
+                                    **self.connect_kwargs)
 
             def _pushing(method):
                 return method.lower() in ('post', 'put')
 
+            def _idempotent(method):
+                return method.upper() in ('GET', 'HEAD', 'PUT', 'DELETE',
+                                          'OPTIONS')
+
             def _simple(body):
                 return body is None or isinstance(body, basestring)
 
@@ -481,36 +594,76 @@ class BaseClient(object):
                     connection.send('%x\r\n%s\r\n' % (len(chunk), chunk))
                 connection.send('0\r\n\r\n')
 
-            # Do a simple request or a chunked request, depending
-            # on whether the body param is file-like or iterable and
-            # the method is PUT or POST
-            #
-            if not _pushing(method) or _simple(body):
-                # Simple request...
-                c.request(method, path, body, headers)
-            elif _filelike(body) or self._iterable(body):
-                c.putrequest(method, path)
-
-                use_sendfile = self._sendable(body)
-
-                # According to HTTP/1.1, Content-Length and Transfer-Encoding
-                # conflict.
-                for header, value in headers.items():
-                    if use_sendfile or header.lower() != 'content-length':
-                        c.putheader(header, str(value))
-
-                iter = self.image_iterator(c, headers, body)
-
-                if use_sendfile:
-                    # send actual file without copying into userspace
-                    _sendbody(c, iter)
+            def _stale(e, sending):
+                # NOTE: a pooled connection the server closed while it was
+                # idle fails before the server has read the request: either
+                # sending it breaks the pipe or is reset, or the connection
+                # is closed without a byte of response.
+                if sending:
+                    return (isinstance(e, socket.error) and
+                            e.errno in (errno.EPIPE, errno.ECONNRESET))
+                return (isinstance(e, httplib.BadStatusLine) and
+                        e.line in ('', repr('')))
+
+            def _send(c):
+                # Do a simple request or a chunked request, depending
+                # on whether the body param is file-like or iterable and
+                # the method is PUT or POST
+                #
+                if not _pushing(method) or _simple(body):
+                    # Simple request...
+                    c.request(method, path, body, headers)
+                elif _filelike(body) or self._iterable(body):
+                    c.putrequest(method, path)
+
+                    use_sendfile = self._sendable(body)
+
+                    # According to HTTP/1.1, Content-Length and
+                    # Transfer-Encoding conflict.
+                    for header, value in headers.items():
+                        if use_sendfile or header.lower() != 'content-length':
+                            c.putheader(header, str(value))
+
+                    iter = self.image_iterator(c, headers, body)
+
+                    if use_sendfile:
+                        # send actual file without copying into userspace
+                        _sendbody(c, iter)
+                    else:
+                        # otherwise iterate and chunk
+                        _chunkbody(c, iter)
                 else:
-                    # otherwise iterate and chunk
-                    _chunkbody(c, iter)
-            else:
-                raise TypeError('Unsupported image type: %s' % body.__class__)
+                    raise TypeError('Unsupported image type: %s' %
+                                    body.__class__)
 
-            res = c.getresponse()
+            sending = True
+            try:
+                _send(c)
+                sending = False
+                res = c.getresponse()
+            except socket.timeout:
+                c.close()
+                raise
+            except (socket.error, httplib.BadStatusLine) as e:
+                c.close()
+                # NOTE: the server may close an idle connection just as it
+                # is reused. A body that is not a string may be consumed
+                # already, so only simple requests are sent again. Requests
+                # that are not idempotent are only sent again if the server
+                # cannot have run them, since the connection was stale.
+                if not (reused and _simple(body) and
+                        (_idempotent(method) or _stale(e, sending))):
+                    raise
+                c = connection_type(url.hostname, url.port,
+                                    **self.connect_kwargs)
+                _send(c)
+                res = c.getresponse()
+
+            if isinstance(res, httplib.HTTPResponse):
+                _POOL.release_on_close(pool_key, c, res)
+                if res.length == 0:
+                    # Nothing to read, the connection can be reused now
+                    res.close()
 
             def _retry(res):
                 return res.getheader('Retry-After')
@@ -539,6 +692,9 @@ class BaseClient(object):
                 raise exception.ServerError()
             elif status_code == httplib.SERVICE_UNAVAILABLE:
                 raise exception.ServiceUnavailable(retry=_retry(res))
+            elif status_code == httplib.UNSUPPORTED_MEDIA_TYPE:
+                raise exception.UnsupportedMediaType(status=status_code,
+                                                     body=res.read())
             else:
                 raise exception.UnexpectedStatus(status=status_code,
                                                  body=res.read())
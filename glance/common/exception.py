@@ -205,6 +205,11 @@ class UnexpectedStatus(GlanceException):
                 "\n\nThe response body:\n%(body)s")
 
 
+class UnsupportedMediaType(UnexpectedStatus):
+    message = _("The request returned 415 Unsupported Media Type."
+                "\n\nThe response body:\n%(body)s")
+
+
 class InvalidContentType(GlanceException):
     message = _("Invalid content type %(content_type)s")
 
@@ -18,12 +18,21 @@
 """
 RPC Controller
 """
+import calendar
 import datetime
+import struct
 import traceback
 
+import eventlet
 from oslo.config import cfg
 from webob import exc
 
+try:
+    import msgpack
+    MSGPACK_SUPPORTED = True
+except ImportError:
+    MSGPACK_SUPPORTED = False
+
 from glance.common import client
 from glance.common import exception
 from glance.common import wsgi
@@ -44,11 +53,38 @@ rpc_opts = [
                          ],
                 help='Modules of exceptions that are permitted to be recreated'
                      'upon receiving exception data from an rpc call.'),
+    cfg.IntOpt('rpc_parallel_commands', default=8,
+               help=_('The maximum number of commands of a request sent as '
+                      'independent that are run at the same time. Set to 1 '
+                      'to always run commands one after another.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(rpc_opts)
 
+# Marks requests whose commands may run in any order, or concurrently
+PARALLEL_HEADER = 'X-RPC-Parallel'
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+# Codes of the msgpack extension types of the objects JSON has no type for
+_DATETIME_EXT = 1
+_SET_EXT = 2
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Hosts and ports of the RPC servers found not to take msgpack bodies,
+# which are sent JSON by every client of this process
+_JSON_ONLY_SERVERS = set()
+
+# NOTE: strings are packed as raw and decoded as UTF-8 when unpacked, like
+# JSON does. msgpack 0.5.2 replaced the encoding argument of unpackb, which
+# 1.0 removed, with raw.
+if MSGPACK_SUPPORTED and msgpack.version >= (0, 5, 2):
+    _UNPACK_KWARGS = {'raw': False}
+else:
+    _UNPACK_KWARGS = {'encoding': 'utf-8'}
+
 
 class RPCJSONSerializer(wsgi.JSONResponseSerializer):
 
@@ -75,6 +111,108 @@ class RPCJSONDeserializer(wsgi.JSONRequestDeserializer):
             return obj
 
 
+class RPCMsgPackSerializer(object):
+    """
+    Serializes results with msgpack, packing datetimes as seconds and
+    microseconds since the epoch and sets as lists, in extension types.
+    """
+
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def _default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            seconds = calendar.timegm(obj.utctimetuple())
+            return msgpack.ExtType(_DATETIME_EXT,
+                                   struct.pack('!qI', seconds,
+                                               obj.microsecond))
+        if isinstance(obj, (set, frozenset)):
+            return msgpack.ExtType(_SET_EXT, self.to_msgpack(list(obj)))
+        if hasattr(obj, "to_dict"):
+            return obj.to_dict()
+        raise TypeError(_("Can not serialize %r") % obj)
+
+    def to_msgpack(self, data):
+        return msgpack.packb(data, default=self._default,
+                             use_bin_type=False)
+
+    def default(self, response, result):
+        response.content_type = self.content_type
+        response.body = self.to_msgpack(result)
+
+
+class RPCMsgPackDeserializer(wsgi.JSONRequestDeserializer):
+    """Deserializes the bodies packed by `RPCMsgPackSerializer`."""
+
+    def _ext_hook(self, code, data):
+        if code == _DATETIME_EXT:
+            seconds, microseconds = struct.unpack('!qI', data)
+            return _EPOCH + datetime.timedelta(seconds=seconds,
+                                               microseconds=microseconds)
+        if code == _SET_EXT:
+            return set(self.from_msgpack(data))
+        return msgpack.ExtType(code, data)
+
+    def from_msgpack(self, datastring):
+        try:
+            return msgpack.unpackb(datastring, ext_hook=self._ext_hook,
+                                   **_UNPACK_KWARGS)
+        except (ValueError, msgpack.UnpackException):
+            msg = _('Malformed msgpack in request body.')
+            raise exc.HTTPBadRequest(explanation=msg)
+
+    def default(self, request):
+        if self.has_body(request):
+            return {'body': self.from_msgpack(request.body)}
+        else:
+            return {}
+
+
+def _accepts_msgpack(request):
+    """Whether the client of a request listed msgpack in Accept"""
+    if request is None:
+        return False
+    accept = request.headers.get('Accept', '')
+    return MSGPACK_CONTENT_TYPE in [media_range.split(';')[0].strip()
+                                    for media_range in accept.split(',')]
+
+
+class RPCRequestDeserializer(object):
+    """
+    Deserializes request bodies with msgpack when their Content-Type is
+    msgpack, and as JSON otherwise.
+    """
+
+    def __init__(self):
+        self.json = RPCJSONDeserializer()
+        self.msgpack = (RPCMsgPackDeserializer() if MSGPACK_SUPPORTED
+                        else None)
+
+    def default(self, request):
+        if request.content_type != MSGPACK_CONTENT_TYPE:
+            return self.json.default(request)
+        if self.msgpack is None:
+            msg = _("The msgpack library is not installed on the server")
+            raise exc.HTTPUnsupportedMediaType(explanation=msg)
+        return self.msgpack.default(request)
+
+
+class RPCResponseSerializer(object):
+    """
+    Serializes results with msgpack for the clients accepting msgpack,
+    and as JSON for the others.
+    """
+
+    def __init__(self):
+        self.json = RPCJSONSerializer()
+        self.msgpack = (RPCMsgPackSerializer() if MSGPACK_SUPPORTED
+                        else None)
+
+    def default(self, response, result):
+        if self.msgpack is not None and _accepts_msgpack(response.request):
+            return self.msgpack.default(response, result)
+        return self.json.default(response, result)
+
+
 class Controller(object):
     """
     Base RPCController.
@@ -168,13 +306,12 @@ class Controller(object):
         # them.
         commands = filter(validate, body)
 
-        results = []
-        for cmd in commands:
+        def execute(cmd):
             # kwargs is not required
             command, kwargs = cmd["command"], cmd.get("kwargs", {})
             method = self._registered[command]
             try:
-                result = method(req.context, **kwargs)
+                return method(req.context, **kwargs)
             except Exception as e:
                 if self.raise_exc:
                     raise
@@ -192,12 +329,122 @@ class Controller(object):
                     val = str(exception.RPCError(cls=cls, val=val))
 
                 cls_path = "%s.%s" % (cls.__module__, cls.__name__)
-                result = {"_error": {"cls": cls_path, "val": val}}
-            results.append(result)
-        return results
+                return {"_error": {"cls": cls_path, "val": val}}
+
+        parallel = req.headers.get(PARALLEL_HEADER, '').lower() == 'true'
+        workers = min(CONF.rpc_parallel_commands, len(commands))
+        if parallel and workers > 1:
+            # NOTE: the caller sent commands that do not depend on each
+            # other, results are still returned in the order of commands
+            pool = eventlet.GreenPool(size=workers)
+            return list(pool.imap(execute, commands))
+        return [execute(cmd) for cmd in commands]
+
+
+class RPCResult(object):
+    """
+    The result of a command added to an `RPCBatch`, available once the
+    batch is sent.
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = False
+        self._content = None
+        self._error = None
+
+    def _set(self, content):
+        self._content = content
+        self._done = True
+
+    def _fail(self, error):
+        self._error = error
+        self._done = True
+
+    def result(self):
+        """
+        Return the result of the command, sending the batch first if it
+        was not sent yet, or raise the error the command raised, or the
+        error sending the batch raised.
+        """
+        if not self._done:
+            self._batch.send()
+        if self._error is not None:
+            raise self._error
+        return self._batch.client._unpack_result(self._content)
+
+
+class RPCBatch(object):
+    """
+    Commands collected to be sent to the RPC server in a single request.
+
+    Methods called on a batch are queued instead of being sent, and
+    return an `RPCResult`. All queued commands are sent together when the
+    batch is used as a context manager and the block ends, or when the
+    result of one of them is asked for:
+
+        with client.batch() as batch:
+            image = batch.image_get(image_id=image_id)
+            tags = batch.image_tag_get_all(image_id=image_id)
+        image, tags = image.result(), tags.result()
+    """
+
+    def __init__(self, client, parallel=False):
+        self.client = client
+        self.parallel = parallel
+        self._commands = []
+        self._results = []
+
+    def add(self, method, **kwargs):
+        """Queue a command, returning its `RPCResult`"""
+        result = RPCResult(self)
+        self._commands.append({'command': method, 'kwargs': kwargs})
+        self._results.append(result)
+        return result
+
+    def send(self):
+        """Send the queued commands in a single request"""
+        if not self._commands:
+            return
+        commands, self._commands = self._commands, []
+        results, self._results = self._results, []
+        try:
+            contents = self.client.bulk_request(commands,
+                                                parallel=self.parallel)
+        except Exception as e:
+            for result in results:
+                result._fail(e)
+            raise
+        for result, content in zip(results, contents):
+            result._set(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        def method_proxy(**kw):
+            return self.add(item, **kw)
+
+        return method_proxy
 
 
 class RPCClient(client.BaseClient):
+    """
+    Client of an RPC server.
+
+    :params use_msgpack: Whether to send commands and receive results
+    packed with msgpack instead of JSON. If the RPC server can not unpack
+    msgpack, because it lacks the msgpack library or predates msgpack
+    support, the commands are sent again as JSON, and so are all the
+    following requests of this process to that server.
+    """
 
     def __init__(self, *args, **kwargs):
         self._serializer = RPCJSONSerializer()
@@ -205,10 +452,28 @@ class RPCClient(client.BaseClient):
 
         self.raise_exc = kwargs.pop("raise_exc", True)
         self.base_path = kwargs.pop("base_path", '/rpc')
+        self.use_msgpack = kwargs.pop("use_msgpack", False)
+        if self.use_msgpack and not MSGPACK_SUPPORTED:
+            LOG.warn(_("The msgpack library is not installed, sending RPC "
+                       "commands as JSON"))
+            self.use_msgpack = False
+        if self.use_msgpack:
+            self._msgpack_serializer = RPCMsgPackSerializer()
+        if MSGPACK_SUPPORTED:
+            self._msgpack_deserializer = RPCMsgPackDeserializer()
         super(RPCClient, self).__init__(*args, **kwargs)
+        if (self.host, self.port) in _JSON_ONLY_SERVERS:
+            self.use_msgpack = False
+
+    def _disable_msgpack(self):
+        """Send commands as JSON to this RPC server from now on"""
+        LOG.warn(_("The RPC server at %s can not unpack msgpack, sending "
+                   "RPC commands as JSON") % self.host)
+        _JSON_ONLY_SERVERS.add((self.host, self.port))
+        self.use_msgpack = False
 
     @client.handle_unauthenticated
-    def bulk_request(self, commands):
+    def bulk_request(self, commands, parallel=False):
         """
         Execute multiple commands in a single request.
 
@@ -219,11 +484,49 @@ class RPCClient(client.BaseClient):
                 'command': 'method_name',
                 'kwargs': method_kwargs
             }
+        :params parallel: Whether the commands are independent of each
+        other, and may be run concurrently by the server.
         """
-        body = self._serializer.to_json(commands)
-        response = super(RPCClient, self).do_request('POST',
+        headers = {}
+        if parallel:
+            headers[PARALLEL_HEADER] = 'true'
+
+        def _send_json():
+            body = self._serializer.to_json(commands)
+            return super(RPCClient, self).do_request('POST',
                                                      self.base_path,
-                                                     body)
+                                                     body,
+                                                     headers=headers or None)
+
+        if not self.use_msgpack:
+            return self._deserialize(_send_json())
+
+        msgpack_headers = dict(headers)
+        msgpack_headers['Content-Type'] = MSGPACK_CONTENT_TYPE
+        msgpack_headers['Accept'] = MSGPACK_CONTENT_TYPE
+        try:
+            response = super(RPCClient, self).do_request(
+                'POST', self.base_path,
+                self._msgpack_serializer.to_msgpack(commands),
+                headers=msgpack_headers)
+        except exception.UnsupportedMediaType:
+            self._disable_msgpack()
+            response = _send_json()
+        except exception.Invalid:
+            # NOTE: servers from before msgpack support read every body as
+            # JSON, and reject msgpack ones as malformed. Commands are only
+            # run once all of them are read, so they are sent again as JSON;
+            # if the server rejects that too, msgpack was not the problem.
+            response = _send_json()
+            self._disable_msgpack()
+        return self._deserialize(response)
+
+    def _deserialize(self, response):
+        """Deserialize a response according to its Content-Type"""
+        content_type = response.getheader('content-type') or ''
+        if (MSGPACK_SUPPORTED and
+                content_type.split(';')[0].strip() == MSGPACK_CONTENT_TYPE):
+            return self._msgpack_deserializer.from_msgpack(response.read())
         return self._deserializer.from_json(response.read())
 
     def do_request(self, method, **kwargs):
@@ -241,8 +544,24 @@ class RPCClient(client.BaseClient):
 
         # NOTE(flaper87): Return the first result if
         # a single command was executed.
-        content = content[0]
+        return self._unpack_result(content[0])
+
+    def batch(self, parallel=False):
+        """
+        Return an `RPCBatch` collecting commands to be sent in a single
+        request.
 
+        :params parallel: Whether the commands of the batch are
+        independent of each other, and may be run concurrently by the
+        server.
+        """
+        return RPCBatch(self, parallel=parallel)
+
+    def _unpack_result(self, content):
+        """
+        Return the result of a command, raising the error it raised
+        instead if raise_exc is True.
+        """
         # NOTE(flaper87): Check if content is an error
         # and re-raise it if raise_exc is True. Before
         # checking if content contains the '_error' key,
@@ -90,6 +90,22 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+def skip_bytes(iter, num_bytes):
+    """
+    Return an iterator over the data of an iterator of strings, leaving
+    out its first bytes
+
+    :param iter: an iterator yielding strings
+    :param num_bytes: number of bytes to leave out
+    """
+    for chunk in iter:
+        if num_bytes >= len(chunk):
+            num_bytes -= len(chunk)
+            continue
+        yield chunk[num_bytes:]
+        num_bytes = 0
+
+
 def cooperative_iter(iter):
     """
     Return an iterator which schedules after each
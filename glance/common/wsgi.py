@@ -34,6 +34,7 @@ import time
 import eventlet
 from eventlet.green import socket, ssl
 import eventlet.greenio
+import eventlet.hubs
 import eventlet.wsgi
 from oslo.config import cfg
 import routes
@@ -41,6 +42,12 @@ import routes.middleware
 import webob.dec
 import webob.exc
 
+try:
+    import sendfile
+    SENDFILE_SUPPORTED = True
+except ImportError:
+    SENDFILE_SUPPORTED = False
+
 from glance.common import exception
 from glance.common import utils
 import glance.openstack.common.log as os_logging
@@ -79,6 +86,13 @@ eventlet_opts = [
                       'only supported \'poll\', however \'selects\' may be '
                       'appropriate for some platforms. See '
                       'http://eventlet.net/doc/hubs.html for more details.')),
+    cfg.BoolOpt('use_sendfile', default=True,
+                help=_('Transmit image data that is held in a local file '
+                       'with sendfile(2), so that it is not copied through '
+                       'the API server process. Only applies when no '
+                       'middleware needs to modify the response body, and '
+                       'is ignored when SSL is enabled or the sendfile '
+                       'module is not available.')),
 ]
 
 
@@ -184,6 +198,143 @@ def get_socket(default_port):
     return sock
 
 
+def is_sendfile_source(data):
+    """
+    Return True if `data` can be transmitted by :class:`SendFileBody`,
+    i.e. it exposes a file descriptor along with the offset and length of
+    the data within that file.
+    """
+    return (CONF.use_sendfile and SENDFILE_SUPPORTED and
+            all(hasattr(data, attr) for attr in ('fileno', 'offset',
+                                                 'length')))
+
+
+class SendFileBody(object):
+    """
+    A response body for data that is held in a local file.
+
+    When the WSGI application returns this object unchanged, the server
+    attaches its client socket to it (see :class:`HttpProtocol`) and the
+    data is written with sendfile(2) without ever being read into the
+    process. If anything else iterates over the body instead, for instance
+    a middleware that caches or compresses it, the `fallback` iterator is
+    used.
+
+    If the data could not all be written to the socket, for instance
+    because the client went away, the `abort` method of `source`, if it
+    has one, is called when the body is closed.
+    """
+
+    def __init__(self, source, fallback=None):
+        self.source = source
+        self.fallback = source if fallback is None else fallback
+        self.sock = None
+        self.bytes_sent = 0
+        self.client_gone = False
+        self.complete = False
+
+    def attach(self, sock, wfile, write):
+        """
+        Have the body write itself to `sock` when iterated. `write` is the
+        callable returned by the server's start_response, used to send the
+        status line and headers first.
+        """
+        self.sock = sock
+        self.wfile = wfile
+        self.write = write
+
+    @property
+    def attached(self):
+        return self.sock is not None
+
+    def __iter__(self):
+        if not self.attached:
+            return iter(self.fallback)
+        self._sendfile()
+        # NOTE: The data went straight to the socket, so nothing is left
+        # for the server to write.
+        return iter([])
+
+    def _sendfile(self):
+        # NOTE: Writing an empty string makes the server send the status
+        # line and headers, after which the socket is ours to write to.
+        self.write('')
+        self.wfile.flush()
+
+        out_fd = self.sock.fileno()
+        in_fd = self.source.fileno()
+        offset = self.source.offset
+        remaining = self.source.length
+        while remaining > 0:
+            try:
+                sent = sendfile.sendfile(out_fd, in_fd, offset, remaining)
+            except OSError as e:
+                if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                    # The client went away, like a closed connection
+                    self.client_gone = True
+                    return
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                eventlet.hubs.trampoline(out_fd, write=True)
+                continue
+            if not sent:
+                raise IOError(_("File ended %d bytes short of the expected "
+                                "length") % remaining)
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        self.complete = True
+
+    def close(self):
+        if (self.attached and not self.complete and
+                hasattr(self.source, 'abort')):
+            self.source.abort()
+        for data in (self.source, self.fallback):
+            if hasattr(data, 'close'):
+                data.close()
+
+
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    eventlet HTTP protocol which lets a :class:`SendFileBody` returned
+    unchanged by the application write itself straight to the client
+    socket.
+    """
+
+    def _can_sendfile(self):
+        return (CONF.use_sendfile and SENDFILE_SUPPORTED and
+                not isinstance(self.connection, ssl.SSLSocket))
+
+    def handle_one_response(self):
+        application = self.application
+        response = {}
+
+        def sendfile_application(environ, start_response):
+            def sendfile_start_response(status, headers, exc_info=None):
+                response['headers'] = headers
+                response['write'] = start_response(status, headers, exc_info)
+                return response['write']
+
+            result = application(environ, sendfile_start_response)
+            # NOTE: Without a Content-Length the server would send the body
+            # chunked, which the file data written to the socket is not.
+            if (isinstance(result, SendFileBody) and self._can_sendfile()
+                    and 'write' in response and
+                    'content-length' in [h.lower() for h, _v in
+                                         response['headers']]):
+                result.attach(self.connection, self.wfile, response['write'])
+                response['body'] = result
+            return result
+
+        self.application = sendfile_application
+        try:
+            eventlet.wsgi.HttpProtocol.handle_one_response(self)
+        finally:
+            self.application = application
+        if 'body' in response and response['body'].client_gone:
+            self.close_connection = 1
+
+
 class Server(object):
     """Server class to manage multiple WSGI sockets and applications."""
 
@@ -292,7 +443,7 @@ class Server(object):
         pid = os.fork()
         if pid == 0:
             signal.signal(signal.SIGHUP, signal.SIG_DFL)
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, self._terminate_child)
             # ignore the interrupt signal to avoid a race whereby
             # a child worker receives the signal before the parent
             # and is respawned unneccessarily as a result
@@ -306,6 +457,16 @@ class Server(object):
             self.logger.info(_('Started child %s') % pid)
             self.children.append(pid)
 
+    @staticmethod
+    def _terminate_child(*args):
+        """
+        Exits a worker through the interpreter rather than letting the
+        signal kill it, so that the exit handlers writing out the image
+        cache hits and counters buffered in the worker get to run.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+
     def run_server(self):
         """Run a WSGI server."""
         if cfg.CONF.pydev_worker_debug_host:
@@ -325,6 +486,7 @@ class Server(object):
                                  self.application,
                                  log=WritableLogger(self.logger),
                                  custom_pool=self.pool,
+                                 protocol=HttpProtocol,
                                  debug=False)
         except socket.error as err:
             if err[0] != errno.EINVAL:
@@ -335,7 +497,8 @@ class Server(object):
         """Start a WSGI server in a new green thread."""
         self.logger.info(_("Starting single process server"))
         eventlet.wsgi.server(sock, application, custom_pool=self.pool,
-                             log=WritableLogger(self.logger), debug=False)
+                             log=WritableLogger(self.logger),
+                             protocol=HttpProtocol, debug=False)
 
 
 class Middleware(object):
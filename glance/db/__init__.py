@@ -67,11 +67,12 @@ class ImageRepo(object):
 
     def get(self, image_id):
         try:
-            db_api_image = dict(self.db_api.image_get(self.context, image_id))
+            db_api_image, tags = self.db_api.image_get_with_tags(self.context,
+                                                                 image_id)
+            db_api_image = dict(db_api_image)
             assert not db_api_image['deleted']
         except (exception.NotFound, exception.Forbidden, AssertionError):
             raise exception.NotFound(image_id=image_id)
-        tags = self.db_api.image_tag_get_all(self.context, image_id)
         image = self._format_image_from_db(db_api_image, tags)
         return ImageProxy(image, self.context, self.db_api)
 
@@ -81,11 +82,14 @@ class ImageRepo(object):
                 self.context, filters=filters, marker=marker, limit=limit,
                 sort_key=sort_key, sort_dir=sort_dir,
                 member_status=member_status)
+        image_ids = [db_api_image['id'] for db_api_image in db_api_images]
+        tags = self.db_api.image_tag_get_all_for_images(self.context,
+                                                        image_ids)
         images = []
         for db_api_image in db_api_images:
-            tags = self.db_api.image_tag_get_all(self.context,
-                                                 db_api_image['id'])
-            image = self._format_image_from_db(dict(db_api_image), tags)
+            image = self._format_image_from_db(dict(db_api_image),
+                                               tags.get(db_api_image['id'],
+                                                        []))
             images.append(image)
         return images
 
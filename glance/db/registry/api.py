@@ -32,12 +32,17 @@ database back-end.
 
 import functools
 
+from glance.common import exception
 import glance.openstack.common.log as logging
 from glance.registry.client.v2 import api
 
 
 LOG = logging.getLogger(__name__)
 
+# Hosts and ports of the registries found to predate the
+# image_tag_get_all_for_images command
+_NO_BULK_TAGS_REGISTRIES = set()
+
 
 def setup_db_env():
     """
@@ -90,6 +95,17 @@ def image_get(client, image_id, force_show_deleted=False):
                             force_show_deleted=force_show_deleted)
 
 
+@_get_client
+def image_get_with_tags(client, image_id, session=None):
+    """Get an image and its list of tags."""
+    # NOTE: both lookups go in a single request, as commands every version
+    # of the registry knows
+    with client.batch() as batch:
+        image = batch.image_get(image_id=image_id)
+        tags = batch.image_tag_get_all(image_id=image_id)
+    return image.result(), tags.result()
+
+
 def is_image_visible(context, image, status=None):
     """Return True if the image is visible in this context."""
     # Is admin == image visible
@@ -218,6 +234,31 @@ def image_tag_get_all(client, image_id, session=None):
     return client.image_tag_get_all(image_id=image_id)
 
 
+@_get_client
+def image_tag_get_all_for_images(client, image_ids, session=None):
+    """Get a dict mapping each of several images to its list of tags."""
+    image_ids = list(image_ids)
+    registry = (client.host, client.port)
+    if registry not in _NO_BULK_TAGS_REGISTRIES:
+        try:
+            return client.image_tag_get_all_for_images(image_ids=image_ids)
+        except exception.NotFound:
+            # NOTE: registries answer 404 to the commands they do not
+            # know, the command itself finds no image missing
+            LOG.info(_("The registry at %s predates "
+                       "image_tag_get_all_for_images, getting the tags of "
+                       "each image instead") % client.host)
+            _NO_BULK_TAGS_REGISTRIES.add(registry)
+
+    if not image_ids:
+        return {}
+    with client.batch() as batch:
+        tags = [batch.image_tag_get_all(image_id=image_id)
+                for image_id in image_ids]
+    return dict((image_id, image_tags.result())
+                for image_id, image_tags in zip(image_ids, tags))
+
+
 @_get_client
 def user_get_storage_usage(client, owner_id, image_id=None, session=None):
     return client.user_get_storage_usage(owner_id=owner_id, image_id=image_id)
@@ -302,6 +302,11 @@ def image_get(context, image_id, session=None, force_show_deleted=False):
     return copy.deepcopy(image)
 
 
+@log_call
+def image_get_with_tags(context, image_id):
+    return image_get(context, image_id), image_tag_get_all(context, image_id)
+
+
 @log_call
 def image_get_all(context, filters=None, marker=None, limit=None,
                   sort_key='created_at', sort_dir='desc',
@@ -538,6 +543,12 @@ def image_tag_get_all(context, image_id):
     return DATA['tags'].get(image_id, [])
 
 
+@log_call
+def image_tag_get_all_for_images(context, image_ids):
+    return dict((image_id, DATA['tags'].get(image_id, []))
+                for image_id in image_ids)
+
+
 @log_call
 def image_tag_get(context, image_id, value):
     tags = image_tag_get_all(context, image_id)
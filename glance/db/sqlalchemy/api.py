@@ -23,6 +23,7 @@ Defines interface for DB access
 """
 
 import logging
+import operator
 import time
 
 from oslo.config import cfg
@@ -49,6 +50,13 @@ LOG = os_logging.getLogger(__name__)
 STATUSES = ['active', 'saving', 'queued', 'killed', 'pending_delete',
             'deleted']
 
+# Maximum number of values bound in a single IN clause
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# Number of leading characters of property values covered by the index on
+# image properties
+PROPERTY_VALUE_PREFIX_LENGTH = 255
+
 sql_connection_opt = cfg.StrOpt('sql_connection',
                                 default='sqlite:///glance.sqlite',
                                 secret=True,
@@ -313,15 +321,21 @@ def image_get(context, image_id, session=None, force_show_deleted=False):
     return image
 
 
-def _image_get(context, image_id, session=None, force_show_deleted=False):
+def image_get_with_tags(context, image_id):
+    """Get an image and its list of tags."""
+    return image_get(context, image_id), image_tag_get_all(context, image_id)
+
+
+def _image_get(context, image_id, session=None, force_show_deleted=False,
+               eager_load=True):
     """Get an image or raise if it does not exist."""
     session = session or _get_session()
 
     try:
-        query = session.query(models.Image)\
-                       .options(sa_orm.joinedload(models.Image.properties))\
-                       .options(sa_orm.joinedload(models.Image.locations))\
-                       .filter_by(id=image_id)
+        query = session.query(models.Image).filter_by(id=image_id)
+        if eager_load:
+            query = query.options(sa_orm.joinedload(models.Image.properties))\
+                         .options(sa_orm.joinedload(models.Image.locations))
 
         # filter out deleted images if context disallows it
         if not force_show_deleted and not _can_show_deleted(context):
@@ -487,7 +501,12 @@ def _paginate_query(query, model, limit, sort_keys, marker=None,
     default = ''  # Default to an empty string if NULL
 
     # Add pagination
-    if marker is not None:
+    if marker is not None and _can_paginate_by_keyset(model, sort_keys,
+                                                      sort_dirs):
+        marker_values = [getattr(marker, sort_key) for sort_key in sort_keys]
+        query = query.filter(_keyset_criteria(model, sort_keys, sort_dirs[0],
+                                              marker_values))
+    elif marker is not None:
         marker_values = []
         for sort_key in sort_keys:
             v = getattr(marker, sort_key)
@@ -530,6 +549,44 @@ def _paginate_query(query, model, limit, sort_keys, marker=None,
     return query
 
 
+def _can_paginate_by_keyset(model, sort_keys, sort_dirs):
+    """
+    Return True if the rows following a marker can be selected by
+    comparing the sort keys directly, which is the case when all of them
+    are sorted in the same direction and none of them may be NULL.
+    """
+    if len(set(sort_dirs)) != 1:
+        return False
+    columns = model.__table__.columns
+    return all(sort_key in columns and not columns[sort_key].nullable
+               for sort_key in sort_keys)
+
+
+def _keyset_criteria(model, sort_keys, sort_dir, marker_values):
+    """
+    Build the criteria selecting the rows that follow the marker values
+    in the order of the sort keys.
+
+    The criteria compare the plain columns, with a leading bound on the
+    first sort key, so that the database seeks to the marker in an index
+    on the sort keys instead of evaluating every row:
+    k1 <= X1 and (k1 < X1 or (k1 == X1 and (k2 < X2 or (...))))
+    """
+    try:
+        after = {'asc': operator.gt, 'desc': operator.lt}[sort_dir]
+        bound = {'asc': operator.ge, 'desc': operator.le}[sort_dir]
+    except KeyError:
+        raise ValueError(_("Unknown sort direction, "
+                           "must be 'desc' or 'asc'"))
+
+    attrs = [getattr(model, sort_key) for sort_key in sort_keys]
+    criteria = after(attrs[-1], marker_values[-1])
+    for attr, value in reversed(zip(attrs[:-1], marker_values[:-1])):
+        criteria = sa_sql.or_(after(attr, value),
+                              sa_sql.and_(attr == value, criteria))
+    return sa_sql.and_(bound(attrs[0], marker_values[0]), criteria)
+
+
 def _make_conditions_from_filters(filters, is_public=None):
     #NOTE(venkatesh) make copy of the filters are to be altered in this method.
     filters = filters.copy()
@@ -609,6 +666,12 @@ def _make_image_property_condition(key, value):
     prop_filters = [models.ImageProperty.deleted == False]
     prop_filters.extend([models.ImageProperty.name == key])
     prop_filters.extend([models.ImageProperty.value == value])
+    if isinstance(value, basestring):
+        #NOTE: redundant with the equality, but lets PostgreSQL use its
+        # index on a prefix of the values
+        prefix = sqlalchemy.func.substr(models.ImageProperty.value, 1,
+                                        PROPERTY_VALUE_PREFIX_LENGTH)
+        prop_filters.append(prefix == value[:PROPERTY_VALUE_PREFIX_LENGTH])
     return prop_filters
 
 
@@ -620,40 +683,34 @@ def _select_images_query(context, image_conditions, admin_as_user,
 
     regular_user = (not context.is_admin) or admin_as_user
 
-    query_member = session.query(models.Image) \
-        .join(models.Image.members) \
-        .filter(img_conditional_clause)
+    member_filters = []
     if regular_user:
-        member_filters = [models.ImageMember.deleted == False]
+        member_filters.append(models.ImageMember.deleted == False)
         if context.owner is not None:
-            member_filters.extend([models.ImageMember.member == context.owner])
+            member_filters.append(models.ImageMember.member == context.owner)
             if member_status != 'all':
-                member_filters.extend([
-                    models.ImageMember.status == member_status])
-        query_member = query_member.filter(sa_sql.and_(*member_filters))
+                member_filters.append(
+                    models.ImageMember.status == member_status)
+    #NOTE: a correlated EXISTS keeps the visibility filter in a single
+    # query on the images table, which the database can serve from its
+    # indexes, rather than a UNION of three queries wrapped in a subquery
+    member_clause = sa_sql.and_(*member_filters) if member_filters else None
+    shared_clause = models.Image.members.any(member_clause)
+
+    query = session.query(models.Image).filter(img_conditional_clause)
 
     #NOTE(venkatesh) if the 'visibility' is set to 'shared', we just
-    # query the image members table. No union is required.
+    # query the image members table.
     if visibility is not None and visibility == 'shared':
-        return query_member
+        return query.filter(shared_clause)
 
-    query_image = session.query(models.Image)\
-        .filter(img_conditional_clause)
     if regular_user:
-        query_image = query_image.filter(models.Image.is_public == True)
-        query_image_owner = None
+        visibility_filters = [models.Image.is_public == True]
         if context.owner is not None:
-            query_image_owner = session.query(models.Image) \
-                .filter(models.Image.owner == context.owner) \
-                .filter(img_conditional_clause)
-        if query_image_owner is not None:
-            query = query_image.union(query_image_owner, query_member)
-        else:
-            query = query_image.union(query_member)
-        return query
-    else:
-        #Admin user
-        return query_image
+            visibility_filters.append(models.Image.owner == context.owner)
+        visibility_filters.append(shared_clause)
+        query = query.filter(sa_sql.or_(*visibility_filters))
+    return query
 
 
 def image_get_all(context, filters=None, marker=None, limit=None,
@@ -699,21 +756,24 @@ def image_get_all(context, filters=None, marker=None, limit=None,
         elif visibility == 'private':
             query = query.filter(models.Image.is_public == False)
 
-    if prop_conditions:
-        for prop_condition in prop_conditions:
-            query = query.join(models.ImageProperty, aliased=True)\
-                .filter(sa_sql.and_(*prop_condition))
+    #NOTE: property and tag filters are correlated EXISTS clauses rather
+    # than joins, so that they do not multiply the rows of each image and
+    # can be served from the (name, value) and value indexes
+    for prop_condition in prop_conditions:
+        query = query.filter(
+            models.Image.properties.any(sa_sql.and_(*prop_condition)))
 
-    if tag_conditions:
-        for tag_condition in tag_conditions:
-            query = query.join(models.ImageTag, aliased=True)\
-                .filter(sa_sql.and_(*tag_condition))
+    for tag_condition in tag_conditions:
+        query = query.filter(
+            models.Image.tags.any(sa_sql.and_(*tag_condition)))
 
     marker_image = None
     if marker is not None:
+        # NOTE: only the sort keys of the marker image are needed
         marker_image = _image_get(context,
                                   marker,
-                                  force_show_deleted=showing_deleted)
+                                  force_show_deleted=showing_deleted,
+                                  eager_load=False)
 
     sort_keys = ['created_at', 'id']
     sort_keys.insert(0, sort_key) if sort_key not in sort_keys else sort_keys
@@ -740,14 +800,17 @@ def _drop_protected_attrs(model_class, values):
 
 
 def _image_get_disk_usage_by_owner(owner, session, image_id=None):
-    query = session.query(models.Image)
+    # NOTE: each image is counted once per location, summed up by the
+    # database rather than by loading every image of the owner
+    query = session.query(sqlalchemy.func.sum(models.Image.size))
+    query = query.filter(models.ImageLocation.image_id == models.Image.id)
+    query = query.filter(models.ImageLocation.deleted == False)
     query = query.filter(models.Image.owner == owner)
     if image_id is not None:
         query = query.filter(models.Image.id != image_id)
     query = query.filter(models.Image.size > 0)
-    images = query.all()
-    total = sum([i.size * len(i.locations) for i in images])
-    return total
+    total = query.scalar()
+    return int(total or 0)
 
 
 def _validate_image(values):
@@ -1156,6 +1219,30 @@ def image_tag_get_all(context, image_id, session=None):
     return [tag['value'] for tag in tags]
 
 
+def image_tag_get_all_for_images(context, image_ids, session=None):
+    """
+    Get the tags of several images at once.
+
+    :param image_ids: list of image ids
+    :returns: dict mapping each image id to its list of tags
+    """
+    session = session or _get_session()
+    image_ids = list(image_ids)
+    result = dict((image_id, []) for image_id in image_ids)
+    # NOTE: keep the number of bound parameters of each query below the
+    # limits of the database back-ends
+    for start in range(0, len(image_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = image_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+        tags = session.query(models.ImageTag.image_id, models.ImageTag.value)\
+                      .filter(models.ImageTag.image_id.in_(chunk))\
+                      .filter_by(deleted=False)\
+                      .order_by(sqlalchemy.asc(models.ImageTag.created_at))\
+                      .all()
+        for image_id, value in tags:
+            result[image_id].append(value)
+    return result
+
+
 def user_get_storage_usage(context, owner_id, image_id=None, session=None):
     session = session or _get_session()
     total_size = _image_get_disk_usage_by_owner(
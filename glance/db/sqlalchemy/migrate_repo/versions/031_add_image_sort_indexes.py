@@ -0,0 +1,51 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+
+# Indexes matching the default sort of image listings, so that the pages
+# following a marker are read from the index instead of a full table scan
+INDEXES = (
+    ('ix_images_deleted_is_public_created_at',
+     ('deleted', 'is_public', 'created_at', 'id')),
+    ('ix_images_owner_created_at', ('owner', 'created_at', 'id')),
+)
+
+
+def _get_indexes(images):
+    return [Index(name, *[images.c[column] for column in columns])
+            for name, columns in INDEXES]
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    images = Table('images', meta, autoload=True)
+
+    for index in _get_indexes(images):
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    images = Table('images', meta, autoload=True)
+
+    for index in _get_indexes(images):
+        index.drop(migrate_engine)
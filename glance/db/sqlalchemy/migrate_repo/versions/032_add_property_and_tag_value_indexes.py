@@ -0,0 +1,76 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+
+PROPERTY_INDEX_NAME = 'ix_image_properties_name_value'
+TAG_INDEX_NAME = 'ix_image_tags_value'
+
+# Number of leading characters of property values which are indexed, since
+# the value is an unbounded TEXT column. Must match
+# glance.db.sqlalchemy.api.PROPERTY_VALUE_PREFIX_LENGTH.
+VALUE_PREFIX_LENGTH = 255
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    image_properties = Table('image_properties', meta, autoload=True)
+    image_tags = Table('image_tags', meta, autoload=True)
+
+    if migrate_engine.name == 'mysql':
+        # NOTE: InnoDB keys are limited to 767 bytes, or 255 utf8
+        # characters, so both columns are indexed by a prefix
+        migrate_engine.execute(
+            'CREATE INDEX %s ON image_properties (name(64), value(191))' %
+            PROPERTY_INDEX_NAME)
+    elif migrate_engine.name == 'postgresql':
+        # NOTE: btree entries are limited to a third of a page, so only a
+        # prefix of the value is indexed, matching the prefix condition
+        # added to property filters
+        migrate_engine.execute(
+            'CREATE INDEX %s ON image_properties (name, substr(value, 1, %d))'
+            % (PROPERTY_INDEX_NAME, VALUE_PREFIX_LENGTH))
+    else:
+        index = Index(PROPERTY_INDEX_NAME, image_properties.c.name,
+                      image_properties.c.value)
+        index.create(migrate_engine)
+
+    index = Index(TAG_INDEX_NAME, image_tags.c.value)
+    index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    image_properties = Table('image_properties', meta, autoload=True)
+    image_tags = Table('image_tags', meta, autoload=True)
+
+    if migrate_engine.name == 'mysql':
+        migrate_engine.execute('DROP INDEX %s ON image_properties' %
+                               PROPERTY_INDEX_NAME)
+    elif migrate_engine.name == 'postgresql':
+        migrate_engine.execute('DROP INDEX %s' % PROPERTY_INDEX_NAME)
+    else:
+        index = Index(PROPERTY_INDEX_NAME, image_properties.c.name,
+                      image_properties.c.value)
+        index.drop(migrate_engine)
+
+    index = Index(TAG_INDEX_NAME, image_tags.c.value)
+    index.drop(migrate_engine)
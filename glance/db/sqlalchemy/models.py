@@ -128,7 +128,11 @@ class Image(BASE, ModelBase):
     __table_args__ = (Index('checksum_image_idx', 'checksum'),
                       Index('ix_images_is_public', 'is_public'),
                       Index('ix_images_deleted', 'deleted'),
-                      Index('owner_image_idx', 'owner'),)
+                      Index('owner_image_idx', 'owner'),
+                      Index('ix_images_deleted_is_public_created_at',
+                            'deleted', 'is_public', 'created_at', 'id'),
+                      Index('ix_images_owner_created_at',
+                            'owner', 'created_at', 'id'),)
 
     id = Column(String(36), primary_key=True, default=uuidutils.generate_uuid)
     name = Column(String(255))
@@ -147,6 +151,9 @@ class Image(BASE, ModelBase):
 class ImageProperty(BASE, ModelBase):
     """Represents an image properties in the datastore"""
     __tablename__ = 'image_properties'
+    #NOTE: the ix_image_properties_name_value index is only created by
+    # migration 032, since it covers a prefix of the values on some
+    # back-ends
     __table_args__ = (Index('ix_image_properties_image_id', 'image_id'),
                       Index('ix_image_properties_deleted', 'deleted'),
                       UniqueConstraint('image_id',
@@ -169,7 +176,8 @@ class ImageTag(BASE, ModelBase):
     __table_args__ = (Index('ix_image_tags_image_id', 'image_id'),
                       Index('ix_image_tags_image_id_tag_value',
                             'image_id',
-                            'value'),)
+                            'value'),
+                      Index('ix_image_tags_value', 'value'),)
 
     id = Column(Integer, primary_key=True, nullable=False)
     image_id = Column(String(36), ForeignKey('images.id'), nullable=False)
@@ -20,12 +20,22 @@ LRU Cache for Image Data
 """
 
 import hashlib
+import os
+import time
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import exception
 from glance.common import utils
+from glance.image_cache import admission
+from glance.image_cache import eviction
+from glance.image_cache import memory
+from glance.image_cache import partial
+from glance.image_cache import sharding
+from glance.image_cache import stats
 from glance.openstack.common import importutils
+from glance.openstack.common import jsonutils
 import glance.openstack.common.log as logging
 
 LOG = logging.getLogger(__name__)
@@ -38,20 +48,256 @@ image_cache_opts = [
     cfg.IntOpt('image_cache_stall_time', default=86400,  # 24 hours
                help=_('The amount of time to let an image remain in the '
                       'cache without being accessed')),
+    cfg.StrOpt('image_cache_eviction_policy', default='lru',
+               help=_('The policy used to pick the images removed when the '
+                      'cache is pruned: lru, lfu, arc, gdsf or the class '
+                      'path of a custom policy.')),
+    cfg.FloatOpt('image_cache_high_watermark', default=1.0,
+                 help=_('The fraction of image_cache_max_size the cache '
+                        'must reach before it is pruned.')),
+    cfg.FloatOpt('image_cache_low_watermark', default=1.0,
+                 help=_('The fraction of image_cache_max_size the cache is '
+                        'pruned down to.')),
     cfg.StrOpt('image_cache_dir',
                help=_('Base directory that the Image Cache uses.')),
+    cfg.ListOpt('image_cache_dirs', default=[],
+                help=_('Directories to spread the image cache over instead '
+                       'of image_cache_dir, typically one per disk. Each '
+                       'entry may end with a colon and the maximum size in '
+                       'bytes of the cache in that directory, which '
+                       'otherwise is image_cache_max_size.')),
+    cfg.BoolOpt('image_cache_coalesce_fills', default=True,
+                help=_('Let only the first request for an uncached image '
+                       'fetch it from the store, with concurrent requests '
+                       'for the same image reading it from the cache as '
+                       'it is written.')),
+    cfg.IntOpt('image_cache_fill_stall_timeout', default=30,
+               help=_('The number of seconds a request reading an image '
+                      'as it is written into the cache waits for more data '
+                      'before reading the rest of the image from the '
+                      'store instead.')),
+    cfg.IntOpt('image_cache_block_size', default=4 * 1024 * 1024,  # 4 MB
+               help=_('The size in bytes of the blocks in which partly '
+                      'downloaded images are cached, so that interrupted '
+                      'fills are kept and ranged downloads can be served '
+                      'from the cache. Set to 0 to only cache whole '
+                      'images.')),
+    cfg.IntOpt('image_cache_memory_size', default=0,
+               help=_('The maximum size in bytes of the image data each API '
+                      'process keeps in memory, in front of the image cache '
+                      'driver. Set to 0 to disable the memory cache.')),
+    cfg.IntOpt('image_cache_memory_max_image_size',
+               default=32 * 1024 * 1024,  # 32 MB
+               help=_('The size in bytes of the largest image kept in the '
+                      'memory cache.')),
+    cfg.IntOpt('image_cache_memory_promote_hits', default=2,
+               help=_('The number of times an image is read from the image '
+                      'cache driver before it is copied into the memory '
+                      'cache.')),
+    cfg.StrOpt('image_cache_memory_eviction_policy', default='lru',
+               help=_('The policy used to pick the images dropped from the '
+                      'memory cache when it is full: lru, lfu, arc, gdsf or '
+                      'the class path of a custom policy.')),
+    cfg.IntOpt('image_cache_stats_flush_interval', default=5,
+               help=_('The number of seconds each process adds up its '
+                      'image cache counters before writing them to the '
+                      'counters file shared by all processes.')),
+    cfg.IntOpt('image_cache_metadata_ttl', default=0,
+               help=_('The number of seconds the metadata of a cached '
+                      'image is kept with it, so that cache hits are '
+                      'served without asking the registry or database. '
+                      'Changes made through this API server are seen at '
+                      'once, changes made through other servers, such as '
+                      'deleting the image or making it private, once the '
+                      'metadata expires. Set to 0 to always ask.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(image_cache_opts)
 
 
+class CachedImageFile(object):
+
+    """
+    Iterates over a cached image file, or the `length` bytes of it
+    starting at `offset`, and also exposes the file handle, offset and
+    length so that cache hits can be sent with sendfile(2).
+
+    The file is opened with `ImageCache.open_for_read` on first use, and
+    the image's hit count is updated when the file is closed, unless an
+    iteration over it was abandoned part way through or `abort` was
+    called.
+    """
+
+    CHUNKSIZE = 65536
+
+    def __init__(self, cache, image_id, offset=0, length=None):
+        self.cache = cache
+        self.image_id = image_id
+        self.offset = offset
+        self.limit = length
+        self.reader = None
+        self.fp = None
+        self.aborted = False
+
+    def _open(self):
+        if self.fp is None:
+            self.reader = self.cache.open_for_read(self.image_id)
+            self.fp = self.reader.__enter__()
+        return self.fp
+
+    def fileno(self):
+        """Return the file descriptor of the cached image file"""
+        return self._open().fileno()
+
+    @property
+    def length(self):
+        if self.limit is not None:
+            return self.limit
+        return os.fstat(self.fileno()).st_size - self.offset
+
+    def __iter__(self):
+        self.aborted = True
+        try:
+            fp = self._open()
+            fp.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = fp.read(min(self.CHUNKSIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            self.aborted = False
+        finally:
+            self.close()
+
+    def abort(self):
+        """Close the cached image file without recording a hit"""
+        self.aborted = True
+        self.close()
+
+    def close(self):
+        """Close the cached image file, recording a hit if it was read"""
+        if self.reader is None:
+            return
+        reader = self.reader
+        if self.aborted:
+            self.reader = self.fp = None
+            msg = _("Read of cached image %s was abandoned") % self.image_id
+            reader.__exit__(IOError, IOError(msg), None)
+        else:
+            length = self.length
+            self.reader = self.fp = None
+            reader.__exit__(None, None, None)
+            self.cache.stats.incr('bytes_from_cache', length)
+            self.cache.record_disk_hit(self.image_id)
+
+
+class MemoryImageFile(object):
+
+    """
+    Iterates over the data of an image held in the memory cache, and
+    records a hit on the image in the cache driver once it was read.
+    """
+
+    def __init__(self, cache, image_id, data):
+        self.cache = cache
+        self.image_id = image_id
+        self.data = data
+
+    def __iter__(self):
+        chunk_size = CachedImageFile.CHUNKSIZE
+        for offset in xrange(0, len(self.data), chunk_size):
+            yield self.data[offset:offset + chunk_size]
+        self.cache.stats.incr('bytes_from_cache', len(self.data))
+        try:
+            with self.cache.driver.open_for_read(self.image_id):
+                pass
+        except (IOError, OSError):
+            # Pruned from the disk cache by another process
+            self.cache.memory.discard(self.image_id)
+
+
 class ImageCache(object):
 
     """Provides an LRU cache for image data."""
 
     def __init__(self):
         self.init_driver()
+        self.init_eviction_policy()
+        self.init_memory_tier()
+        self.admission = admission.AdmissionPolicy.from_config()
+        self.init_stats()
+
+    def init_stats(self):
+        """
+        Set up the counters of the cache, kept in the first cache directory
+        """
+        driver = self.get_cache_shards()[0][0]
+        self.stats = stats.get_stats(driver.stats_dir,
+                                     CONF.image_cache_stats_flush_interval)
+
+    def get_stats(self):
+        """
+        Returns a dict of the counters of the cache, summed over all the
+        processes using it, along with the ratios derived from them and
+        the current size of the cache.
+        """
+        counters = self.stats.get_counters()
+        requests = counters['hits'] + counters['misses']
+        counters['hit_ratio'] = (float(counters['hits']) / requests
+                                 if requests else None)
+        counters['fill_bytes_per_second'] = (
+            counters['fill_bytes'] / counters['fill_seconds']
+            if counters['fill_seconds'] else None)
+        counters['size'] = self.get_cache_size()
+        counters['max_size'] = sum(max_size for driver, max_size
+                                   in self.get_cache_shards())
+        counters['num_cached_images'] = len(self.get_cached_images())
+        counters['num_queued_images'] = len(self.get_queued_images())
+        return counters
+
+    def reset_stats(self):
+        """
+        Set the counters of the cache back to zero
+        """
+        self.stats.reset()
+
+    def init_memory_tier(self):
+        """
+        Create the in-memory tier in front of the driver, if configured
+        """
+        self.memory = None
+        if CONF.image_cache_memory_size <= 0:
+            return
+        policy_name = CONF.image_cache_memory_eviction_policy
+        try:
+            policy = eviction.get_policy(policy_name)
+        except ImportError as import_err:
+            LOG.warn(_("Memory cache eviction policy "
+                       "'%(policy_name)s' failed to load. "
+                       "Got error: '%(import_err)s.") % locals())
+            LOG.info(_("Defaulting to LRU eviction policy."))
+            policy = eviction.LRUPolicy()
+        self.memory = memory.MemoryTier(
+            CONF.image_cache_memory_size,
+            CONF.image_cache_memory_max_image_size,
+            CONF.image_cache_memory_promote_hits, policy)
+
+    def init_eviction_policy(self):
+        """
+        Create the eviction policy used when pruning the cache
+        """
+        policy_name = CONF.image_cache_eviction_policy
+        try:
+            self.eviction_policy = eviction.get_policy(policy_name)
+        except ImportError as import_err:
+            LOG.warn(_("Image cache eviction policy "
+                       "'%(policy_name)s' failed to load. "
+                       "Got error: '%(import_err)s.") % locals())
+            LOG.info(_("Defaulting to LRU eviction policy."))
+            self.eviction_policy = eviction.LRUPolicy()
 
     def init_driver(self):
         """
@@ -79,8 +325,7 @@ class ImageCache(object):
         fall back to using the SQLite driver which has no odd dependencies
         """
         try:
-            self.driver = self.driver_class()
-            self.driver.configure()
+            self.driver = self.create_driver(self.driver_class)
         except exception.BadDriverConfiguration as config_err:
             driver_module = self.driver_class.__module__
             LOG.warn(_("Image cache driver "
@@ -89,8 +334,31 @@ class ImageCache(object):
             LOG.info(_("Defaulting to SQLite driver."))
             default_module = __name__ + '.drivers.sqlite.Driver'
             self.driver_class = importutils.import_class(default_module)
-            self.driver = self.driver_class()
-            self.driver.configure()
+            self.driver = self.create_driver(self.driver_class)
+
+    def create_driver(self, driver_class):
+        """
+        Create and configure a driver of the supplied class, spread over
+        the image_cache_dirs if they are set.
+        """
+        if CONF.image_cache_dirs:
+            cache_dirs = sharding.parse_cache_dirs(CONF.image_cache_dirs,
+                                                   CONF.image_cache_max_size)
+            driver = sharding.ShardedDriver(driver_class, cache_dirs)
+        else:
+            driver = driver_class()
+        driver.configure()
+        return driver
+
+    def get_cache_shards(self):
+        """
+        Returns a list of (driver, max size) tuples, one per cache
+        directory.
+        """
+        if isinstance(self.driver, sharding.ShardedDriver):
+            return [(driver, self.driver.max_sizes[driver])
+                    for driver in self.driver.drivers]
+        return [(self.driver, CONF.image_cache_max_size)]
 
     def is_cached(self, image_id):
         """
@@ -134,14 +402,31 @@ class ImageCache(object):
         Removes all cached image files and any attributes about the images
         and returns the number of cached image files that were deleted.
         """
-        return self.driver.delete_all_cached_images()
+        if self.memory is not None:
+            self.memory.clear()
+        for driver, max_size in self.get_cache_shards():
+            partial.reap(driver.partial_dir, -1)
+            for fname in os.listdir(driver.metadata_dir):
+                utils.safe_remove(os.path.join(driver.metadata_dir, fname))
+        num_deleted = self.driver.delete_all_cached_images()
+        self.stats.incr('evictions_deleted', num_deleted)
+        return num_deleted
 
-    def delete_cached_image(self, image_id):
+    def delete_cached_image(self, image_id, reason='deleted'):
         """
         Removes a specific cached image file and any attributes about the image
 
         :param image_id: Image ID
+        :param reason: Why the image is removed, for the cache's counters:
+                       'deleted' when asked to, or 'stale' when the image
+                       no longer exists
         """
+        if self.memory is not None:
+            self.memory.discard(image_id)
+        partial.delete(self.driver.get_image_filepath(image_id, 'partial'))
+        self.delete_metadata_snapshots(image_id)
+        if self.driver.is_cached(image_id):
+            self.stats.incr('evictions_%s' % reason)
         self.driver.delete_cached_image(image_id)
 
     def delete_all_queued_images(self):
@@ -161,33 +446,57 @@ class ImageCache(object):
 
     def prune(self):
         """
-        Removes all cached image files above the cache's maximum
-        size. Returns a tuple containing the total number of cached
-        files removed and the total size of all pruned image files.
+        Removes cached image files, chosen by the cache's eviction policy,
+        once the cache grows past its high watermark, until it is below
+        its low watermark. Partly cached images are pruned along with the
+        cached images. When the cache is spread over several
+        directories, each directory is pruned against its own size limit.
+        Returns a tuple containing the total number of cached files removed
+        and the total size of all pruned image files.
         """
-        max_size = CONF.image_cache_max_size
-        current_size = self.driver.get_cache_size()
-        if max_size > current_size:
+        total_bytes_pruned = 0
+        total_files_pruned = 0
+        for driver, max_size in self.get_cache_shards():
+            files_pruned, bytes_pruned = self._prune_driver(driver, max_size)
+            total_files_pruned += files_pruned
+            total_bytes_pruned += bytes_pruned
+        return total_files_pruned, total_bytes_pruned
+
+    def _prune_driver(self, driver, max_size):
+        high_size = int(max_size * CONF.image_cache_high_watermark)
+        low_size = int(max_size * min(CONF.image_cache_low_watermark,
+                                      CONF.image_cache_high_watermark))
+        current_size = driver.get_cache_size()
+        if high_size > current_size:
             LOG.debug(_("Image cache has free space, skipping prune..."))
             return (0, 0)
 
-        overage = current_size - max_size
-        LOG.debug(_("Image cache currently %(overage)d bytes over max "
-                    "size. Starting prune to max size of %(max_size)d ") %
+        overage = current_size - low_size
+        LOG.debug(_("Image cache currently %(overage)d bytes over low "
+                    "watermark. Starting prune to size of %(low_size)d ") %
                   locals())
 
         total_bytes_pruned = 0
         total_files_pruned = 0
-        entry = self.driver.get_least_recently_accessed()
-        while entry and current_size > max_size:
-            image_id, size = entry
+        entries = driver.get_cached_images()
+        entries.extend(partial.get_partial_images(driver.partial_dir))
+        state_path = os.path.join(driver.stats_dir, 'eviction.json')
+        eviction.load_state(self.eviction_policy, state_path)
+        victims = self.eviction_policy.select_victims(entries, overage)
+        eviction.save_state(self.eviction_policy, state_path)
+        for entry in victims:
+            image_id, size = entry['image_id'], entry['size']
             LOG.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
                       {'image_id': image_id, 'size': size})
-            self.driver.delete_cached_image(image_id)
+            if 'path' in entry:
+                # A partly cached image
+                partial.delete(entry['path'])
+            else:
+                driver.delete_cached_image(image_id)
+            self.stats.incr('evictions_pruned')
+            self.stats.incr('pruned_bytes', size)
             total_bytes_pruned = total_bytes_pruned + size
             total_files_pruned = total_files_pruned + 1
-            current_size = current_size - size
-            entry = self.driver.get_least_recently_accessed()
 
         LOG.debug(_("Pruning finished pruning. "
                     "Pruned %(total_files_pruned)d and "
@@ -197,22 +506,319 @@ class ImageCache(object):
     def clean(self, stall_time=None):
         """
         Cleans up any invalid or incomplete cached images. The cache driver
-        decides what that means...
+        decides what that means... Partly cached images that have not been
+        written to for the stall time are removed too.
         """
         self.driver.clean(stall_time)
+        if stall_time is None:
+            stall_time = CONF.image_cache_stall_time
+        reaped = sum(partial.reap(driver.partial_dir, stall_time)
+                     for driver, max_size in self.get_cache_shards())
+        LOG.info(_("Reaped %d partial cache entries"), reaped)
+
+        now = time.time()
+        for image_id, (count, last_miss) in self.get_misses().items():
+            if now - last_miss > stall_time:
+                self.forget_misses(image_id)
+
+        for driver, max_size in self.get_cache_shards():
+            for fname in os.listdir(driver.metadata_dir):
+                path = os.path.join(driver.metadata_dir, fname)
+                try:
+                    age = now - os.path.getmtime(path)
+                except OSError:
+                    continue
+                if age > CONF.image_cache_metadata_ttl:
+                    utils.safe_remove(path)
+
+    def _get_snapshot_path(self, image_id, version):
+        return '%s.%s' % (self.driver.get_image_filepath(image_id,
+                                                         'metadata'),
+                          version)
 
-    def queue_image(self, image_id):
+    def get_metadata_snapshot(self, image_id, version):
+        """
+        Returns the metadata of an image as the `version` API showed it
+        less than image_cache_metadata_ttl seconds ago, or None.
+
+        :param image_id: Image ID
+        :param version: API version, 'v1' or 'v2'
+        """
+        if not CONF.image_cache_metadata_ttl:
+            return None
+        path = self._get_snapshot_path(image_id, version)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age > CONF.image_cache_metadata_ttl:
+                return None
+            with open(path) as snapshot_file:
+                return jsonutils.load(snapshot_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store_metadata_snapshot(self, image_id, version, image_meta):
+        """
+        Keep the metadata of an image as the `version` API shows it, for
+        `get_metadata_snapshot`.
+
+        :param image_id: Image ID
+        :param version: API version, 'v1' or 'v2'
+        :param image_meta: Mapping of image metadata
+        """
+        if not CONF.image_cache_metadata_ttl:
+            return
+        path = self._get_snapshot_path(image_id, version)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as snapshot_file:
+                snapshot_file.write(jsonutils.dumps(image_meta))
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            LOG.debug(_("Failed to keep the metadata of image "
+                        "'%(image_id)s': %(e)s"),
+                      {'image_id': image_id, 'e': e})
+
+    def delete_metadata_snapshots(self, image_id):
+        """
+        Forget the metadata kept for an image, e.g. because it changed.
+
+        :param image_id: Image ID
+        """
+        for version in ('v1', 'v2'):
+            utils.safe_remove(self._get_snapshot_path(image_id, version))
+
+    def record_miss(self, image_id):
+        """
+        Count a request for an image that was not cached, for the
+        prefetcher to pick the images worth caching ahead of requests.
+
+        :param image_id: Image ID
+        """
+        self.stats.incr('misses')
+        # NOTE: Every miss appends one byte to the image's misses file, so
+        # the file size is the number of misses and its mtime the time of
+        # the last one, shared by all processes without any locking.
+        path = self.driver.get_image_filepath(image_id, 'misses')
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        try:
+            if (time.time() - os.path.getmtime(path) >
+                    CONF.image_cache_admission_window):
+                # Start counting afresh
+                flags |= os.O_TRUNC
+        except OSError:
+            pass
+        try:
+            fd = os.open(path, flags)
+            try:
+                os.write(fd, '.')
+            finally:
+                os.close(fd)
+        except OSError as e:
+            LOG.debug(_("Failed to record cache miss of image '%(image_id)s':"
+                        " %(e)s"), {'image_id': image_id, 'e': e})
+
+    def get_miss_count(self, image_id):
+        """
+        Returns the number of cache misses of an image within the last
+        image_cache_admission_window seconds.
+
+        :param image_id: Image ID
+        """
+        path = self.driver.get_image_filepath(image_id, 'misses')
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 0
+        if time.time() - stat.st_mtime > CONF.image_cache_admission_window:
+            return 0
+        return stat.st_size
+
+    def may_admit(self, image_id):
+        """
+        Returns True if an image missed the cache often enough to be
+        admitted into it, before its size and disk format are known, so
+        that requests for images that will not be admitted do not claim
+        filling the cache.
+
+        :param image_id: Image ID
+        """
+        return self.admission.check(None, None,
+                                    self.get_miss_count(image_id)) is None
+
+    def admit(self, image_id, image_size=None, disk_format=None,
+              queued=False):
+        """
+        Returns True if a downloaded image should be written into the
+        cache, according to the cache's admission policy, and logs why
+        it is not.
+
+        :param image_id: Image ID
+        :param image_size: Size of the image in bytes, if known
+        :param disk_format: Disk format of the image, if known
+        :param queued: True if the image was queued for prefetching, in
+                       which case its misses are not counted
+        """
+        misses = None if queued else self.get_miss_count(image_id)
+        reason = self.admission.check(image_size, disk_format, misses)
+        if reason is None:
+            LOG.debug(_("Admitting image '%s' into the cache"), image_id)
+            return True
+        LOG.info(_("Not admitting image '%(image_id)s' into the cache: "
+                   "%(reason)s"), {'image_id': image_id, 'reason': reason})
+        self.stats.incr('not_admitted')
+        return False
+
+    def get_misses(self):
+        """
+        Returns a dict mapping the IDs of images that missed the cache to
+        (number of misses, time of the last miss) tuples.
+        """
+        misses = {}
+        for driver, max_size in self.get_cache_shards():
+            for image_id in os.listdir(driver.misses_dir):
+                path = os.path.join(driver.misses_dir, image_id)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                count, last_miss = misses.get(image_id, (0, 0))
+                misses[image_id] = (count + stat.st_size,
+                                    max(last_miss, stat.st_mtime))
+        return misses
+
+    def forget_misses(self, image_id):
+        """
+        Stop counting the misses of an image
+
+        :param image_id: Image ID
+        """
+        for driver, max_size in self.get_cache_shards():
+            utils.safe_remove(driver.get_image_filepath(image_id, 'misses'))
+
+    def queue_image(self, image_id, priority=0, planned=False):
         """
         This adds a image to be cache to the queue.
 
         If the image already exists in the queue or has already been
-        cached, we return False, True otherwise
+        cached, we return False, True otherwise. The priority of an image
+        that is already queued is raised if it is asked for a higher one.
 
         :param image_id: Image ID
+        :param priority: Images of higher priority are prefetched first
+        :param planned: True for the images picked by the prefetch planner,
+                        which are prefetched after the images queued by
+                        hand
         """
-        return self.driver.queue_image(image_id)
+        if self.driver.queue_image(image_id):
+            if priority or planned:
+                self._set_queue_rank(image_id, priority, planned)
+            return True
+        if (self.driver.is_queued(image_id) and
+                (not planned, priority) > self._get_queue_rank(image_id)):
+            self._set_queue_rank(image_id, priority, planned)
+        return False
 
-    def get_caching_iter(self, image_id, image_checksum, image_iter):
+    def _set_queue_rank(self, image_id, priority, planned):
+        path = self.driver.get_image_filepath(image_id, 'queue')
+        try:
+            queued = os.stat(path)
+            with open(path, 'w') as queue_file:
+                queue_file.write(('planned:%s' if planned else '%s') %
+                                 priority)
+            # The queueing time orders images of the same priority
+            os.utime(path, (queued.st_atime, queued.st_mtime))
+        except (IOError, OSError) as e:
+            # NOTE: The image may have been taken off the queue meanwhile
+            LOG.debug(_("Failed to set the queue priority of image "
+                        "'%(image_id)s': %(e)s"),
+                      {'image_id': image_id, 'e': e})
+
+    def _get_queue_rank(self, image_id):
+        """
+        Returns a tuple of whether an image was queued by hand and of its
+        priority, by which images are prefetched.
+        """
+        try:
+            with open(self.driver.get_image_filepath(image_id,
+                                                     'queue')) as queue_file:
+                content = queue_file.read()
+        except IOError:
+            return (True, 0)
+        planned = content.startswith('planned:')
+        if planned:
+            content = content[len('planned:'):]
+        try:
+            return (not planned, float(content or 0))
+        except ValueError:
+            return (not planned, 0)
+
+    def get_queue_priority(self, image_id):
+        """
+        Returns the priority an image was queued with.
+
+        :param image_id: Image ID
+        """
+        return self._get_queue_rank(image_id)[1]
+
+    def get_prefetch_queue(self):
+        """
+        Returns the IDs of the queued images in the order they should be
+        prefetched, by priority and then by the time they were queued.
+        """
+        images = self.get_queued_images()
+        # NOTE: sort() is stable, so images of equal priority keep their
+        # queueing order
+        images.sort(key=self._get_queue_rank, reverse=True)
+        return images
+
+    def claim_fill(self, image_id):
+        """
+        Try to become the one request that writes an image into the cache.
+
+        Returns True if the caller should fetch the image and pass it to
+        `get_caching_iter` with `claimed=True`. Returns False if the image
+        is already cached or another fill is still making progress. A fill
+        that has stalled for longer than image_cache_fill_stall_timeout is
+        abandoned and claimed afresh.
+
+        :param image_id: Image ID
+        """
+        if self.driver.is_cached(image_id):
+            return False
+        if self.driver.claim_for_write(image_id):
+            return True
+
+        path = self.driver.get_image_filepath(image_id, 'incomplete')
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return False
+        if time.time() - mtime < CONF.image_cache_fill_stall_timeout:
+            return False
+
+        LOG.warn(_("Cache fill of image '%s' has stalled, taking it "
+                   "over"), image_id)
+        self.driver.abandon_write(image_id)
+        return self.driver.claim_for_write(image_id)
+
+    def release_fill(self, image_id):
+        """
+        Give up a claim made with `claim_fill` without filling the cache.
+
+        :param image_id: Image ID
+        """
+        self.driver.abandon_write(image_id)
+
+    def is_being_filled(self, image_id):
+        """
+        Returns True if the image is currently being written into the cache.
+
+        :param image_id: Image ID
+        """
+        return self.driver.is_being_cached(image_id)
+
+    def get_caching_iter(self, image_id, image_checksum, image_iter,
+                         claimed=False):
         """
         Returns an iterator that caches the contents of an image
         while the image contents are read through the supplied
@@ -222,8 +828,10 @@ class ImageCache(object):
         :param image_checksum: checksum expected to be generated while
                                iterating over image data
         :param image_iter: Iterator that will read image contents
+        :param claimed: True if the caller holds the claim on filling the
+                        cache with this image, see `claim_fill`
         """
-        if not self.driver.is_cacheable(image_id):
+        if not claimed and not self.driver.is_cacheable(image_id):
             return image_iter
 
         LOG.debug(_("Tee'ing image '%s' into cache"), image_id)
@@ -231,6 +839,10 @@ class ImageCache(object):
         return self.cache_tee_iter(image_id, image_iter, image_checksum)
 
     def cache_tee_iter(self, image_id, image_iter, image_checksum):
+        bytes_cached = 0
+        salvage = True
+        completed = False
+        start = time.time()
         try:
             current_checksum = hashlib.md5()
 
@@ -238,6 +850,9 @@ class ImageCache(object):
                 for chunk in image_iter:
                     try:
                         cache_file.write(chunk)
+                        # Make the data visible to get_tailing_iter readers
+                        cache_file.flush()
+                        bytes_cached += len(chunk)
                     finally:
                         current_checksum.update(chunk)
                         yield chunk
@@ -245,9 +860,14 @@ class ImageCache(object):
 
                 if (image_checksum and
                         image_checksum != current_checksum.hexdigest()):
+                    salvage = False
                     msg = _("Checksum verification failed. Aborted "
                             "caching of image '%s'.") % image_id
                     raise exception.GlanceException(msg)
+            salvage = False
+            partial.delete(self.driver.get_image_filepath(image_id,
+                                                          'partial'))
+            completed = True
 
         except exception.GlanceException as e:
             # image_iter has given us bad, (size_checked_iter has found a
@@ -263,6 +883,221 @@ class ImageCache(object):
             # caching failed.
             for chunk in image_iter:
                 yield chunk
+        finally:
+            if completed:
+                self.stats.incr('fills_completed')
+                self.stats.incr('fill_bytes', bytes_cached)
+                self.stats.incr('fill_seconds', time.time() - start)
+            else:
+                self.stats.incr('fills_aborted')
+            if salvage and bytes_cached:
+                self.salvage_fill(image_id, bytes_cached)
+
+    def salvage_fill(self, image_id, length):
+        """
+        Keep the blocks an interrupted fill wrote, which its driver moved
+        to the invalid directory, as a partly cached image.
+
+        :param image_id: Image ID
+        :param length: Number of bytes the fill wrote
+        """
+        block_size = CONF.image_cache_block_size
+        if not block_size:
+            return
+        invalid_path = self.driver.get_image_filepath(image_id, 'invalid')
+        if not os.path.exists(invalid_path):
+            return
+        partial_image = partial.PartialImage(
+            self.driver.get_image_filepath(image_id, 'partial'), block_size)
+        try:
+            if partial_image.adopt(invalid_path, length):
+                LOG.debug(_("Kept %(length)d bytes of the interrupted fill "
+                            "of image '%(image_id)s'"),
+                          {'length': length, 'image_id': image_id})
+        except (IOError, OSError) as e:
+            LOG.warn(_("Failed to keep the interrupted fill of image "
+                       "'%(image_id)s': %(e)s"),
+                     {'image_id': image_id, 'e': e})
+
+    def get_range_iter(self, image_id, image_size, image_checksum,
+                       start, stop, fetch, admitted=True):
+        """
+        Returns an iterator over the bytes `start` to `stop` of an image
+        that is not cached whole, reading the blocks that are cached from
+        its partial image and the others from the iterable returned by
+        `fetch`, which are then added to the partial image if the image
+        is admitted into the cache. Once all the blocks of the image are
+        cached, it is verified against `image_checksum` and moved into the
+        cache.
+
+        `fetch` is called before this method returns, so that a failure
+        to read the image from the store is raised to the caller.
+
+        :param image_id: Image ID
+        :param image_size: Size of the image
+        :param image_checksum: Checksum of the image
+        :param start: Offset of the first byte to return
+        :param stop: Offset after the last byte to return
+        :param fetch: Callable returning an iterable over the whole image
+        :param admitted: False if the blocks read from the store should
+                         not be cached, see `admit`
+        """
+        partial_image = partial.PartialImage(
+            self.driver.get_image_filepath(image_id, 'partial'),
+            CONF.image_cache_block_size)
+        partial_image.set_size(image_size)
+        first = start // partial_image.block_size
+        last = (stop - 1) // partial_image.block_size
+
+        store_reader = None
+        if not partial_image.has_blocks(first, last):
+            store_reader = partial.StoreBlockReader(partial_image, fetch(),
+                                                    write_blocks=admitted)
+
+        def range_iter():
+            try:
+                for index in xrange(first, last + 1):
+                    if partial_image.has_block(index):
+                        data = partial_image.read_block(index)
+                    else:
+                        data = store_reader.read_block(index)
+                    block_start = index * partial_image.block_size
+                    yield data[max(start - block_start, 0):
+                               stop - block_start]
+            finally:
+                if store_reader is not None:
+                    store_reader.close()
+
+            if partial_image.is_complete() and self.claim_fill(image_id):
+                eventlet.spawn_n(self._promote_partial_image, image_id,
+                                 partial_image, image_checksum)
+
+        return range_iter()
+
+    def resume_fill(self, image_id, image_size, image_checksum, fetch):
+        """
+        Finish caching an image of which some blocks are cached already,
+        e.g. by an interrupted fill, reading the missing blocks from the
+        iterable returned by `fetch`. Returns False if no blocks of the
+        image are cached, otherwise whether the image is now cached.
+
+        :param image_id: Image ID
+        :param image_size: Size of the image
+        :param image_checksum: Checksum of the image
+        :param fetch: Callable returning an iterable over the whole image
+        """
+        if not CONF.image_cache_block_size:
+            return False
+        partial_image = partial.PartialImage(
+            self.driver.get_image_filepath(image_id, 'partial'),
+            CONF.image_cache_block_size)
+        if not partial_image.num_present:
+            return False
+
+        LOG.debug(_("Resuming the cache fill of image '%(image_id)s' from "
+                    "%(present)d cached blocks"),
+                  {'image_id': image_id, 'present': partial_image.num_present})
+        partial_image.set_size(image_size)
+        if not partial_image.is_complete():
+            # NOTE: The store is read up to the last missing block only
+            store_reader = partial.StoreBlockReader(partial_image, fetch())
+            try:
+                for index in xrange(partial_image.num_blocks):
+                    if not partial_image.has_block(index):
+                        store_reader.read_block(index)
+            finally:
+                store_reader.close()
+
+        if self.claim_fill(image_id):
+            self._promote_partial_image(image_id, partial_image,
+                                        image_checksum)
+        return self.driver.is_cached(image_id)
+
+    def _promote_partial_image(self, image_id, partial_image,
+                               image_checksum):
+        try:
+            with open(partial_image.path, 'rb') as image_file:
+                image_iter = utils.chunkiter(image_file,
+                                             CachedImageFile.CHUNKSIZE)
+                for chunk in self.get_caching_iter(image_id, image_checksum,
+                                                   image_iter, claimed=True):
+                    pass
+        except exception.GlanceException:
+            # The blocks did not add up to the image, start over
+            partial_image.delete()
+        except (IOError, OSError) as e:
+            LOG.warn(_("Failed to move the cached blocks of image "
+                       "'%(image_id)s' into the cache: %(e)s"),
+                     {'image_id': image_id, 'e': e})
+            self.release_fill(image_id)
+        else:
+            LOG.debug(_("Moved the cached blocks of image '%s' into the "
+                        "cache"), image_id)
+
+    def get_tailing_iter(self, image_id, fallback):
+        """
+        Returns an iterator over an image that another request is writing
+        into the cache, yielding the data as it is appended to the cache
+        file.
+
+        If the fill fails or stalls, the rest of the image is read from the
+        iterable returned by `fallback`, skipping the data that was already
+        yielded.
+
+        :param image_id: Image ID
+        :param fallback: Callable returning an iterable over the whole image
+        """
+        incomplete_path = self.driver.get_image_filepath(image_id,
+                                                         'incomplete')
+        final_path = self.driver.get_image_filepath(image_id)
+
+        def inode(path):
+            try:
+                return os.stat(path).st_ino
+            except OSError:
+                return None
+
+        bytes_read = 0
+        try:
+            cache_file = open(incomplete_path, 'rb')
+        except IOError:
+            cache_file = None
+
+        if cache_file is not None:
+            with cache_file:
+                # NOTE: The writer renames the file we have open once it is
+                # complete, or moves it aside if the fill fails, so its
+                # inode tells us how the fill is going.
+                file_inode = os.fstat(cache_file.fileno()).st_ino
+                complete = False
+                last_read = time.time()
+                while True:
+                    chunk = cache_file.read(CachedImageFile.CHUNKSIZE)
+                    if chunk:
+                        bytes_read += len(chunk)
+                        last_read = time.time()
+                        yield chunk
+                    elif complete:
+                        return
+                    elif inode(final_path) == file_inode:
+                        # Drain anything written since the last read
+                        complete = True
+                    elif (inode(incomplete_path) != file_inode or
+                          time.time() - last_read >
+                          CONF.image_cache_fill_stall_timeout):
+                        break
+                    else:
+                        eventlet.sleep(0.1)
+        elif self.driver.is_cached(image_id):
+            for chunk in self.get_image_file(image_id):
+                yield chunk
+            return
+
+        LOG.info(_("Cache fill of image '%(image_id)s' failed after "
+                   "%(bytes_read)d bytes, reading the rest from the store"),
+                 {'image_id': image_id, 'bytes_read': bytes_read})
+        for chunk in utils.skip_bytes(fallback(), bytes_read):
+            yield chunk
 
     def cache_image_iter(self, image_id, image_iter, image_checksum=None):
         """
@@ -296,6 +1131,54 @@ class ImageCache(object):
         return self.cache_image_iter(image_id,
                                      utils.chunkiter(image_file, CHUNKSIZE))
 
+    def get_image_file(self, image_id):
+        """
+        Returns an iterable over the data of a cached image, served from
+        the memory cache if the image is held there.
+
+        :param image_id: Image ID
+        """
+        self.stats.incr('hits')
+        if self.memory is not None:
+            data = self.memory.get(image_id)
+            if data is not None:
+                self.stats.incr('memory_hits')
+                return MemoryImageFile(self, image_id, data)
+        return CachedImageFile(self, image_id)
+
+    def record_bytes_served(self, source, num_bytes):
+        """
+        Count bytes of image data served from outside the cache.
+
+        :param source: Where the data came from, 'backend' or 'peers'
+        :param num_bytes: Number of bytes
+        """
+        self.stats.incr('bytes_from_%s' % source, num_bytes)
+
+    def record_disk_hit(self, image_id):
+        """
+        Count a read of a cached image from the driver, copying the image
+        into the memory cache once it is read often enough.
+
+        :param image_id: Image ID
+        """
+        if self.memory is None:
+            return
+        try:
+            image_size = self.driver.get_image_size(image_id)
+            if not self.memory.record_disk_hit(image_id, image_size):
+                return
+            # NOTE: Images of up to image_cache_memory_max_image_size are
+            # read a chunk at a time, letting other green threads run in
+            # between, so the worker is not held up by the whole read.
+            with open(self.driver.get_image_filepath(image_id), 'rb') as f:
+                data = ''.join(utils.cooperative_iter(
+                    utils.chunkiter(f, CachedImageFile.CHUNKSIZE)))
+        except (IOError, OSError):
+            return
+        if len(data) == image_size:
+            self.memory.put(image_id, data)
+
     def open_for_read(self, image_id):
         """
         Open and yield file for reading the image file for an image
@@ -0,0 +1,129 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Decides which downloaded images are worth writing into the image cache.
+
+An image that is downloaded once should not evict images that are
+downloaded all the time. Images are admitted once they missed the cache
+often enough within a time window, and only if they are not larger than
+the limit for all images or for their disk format.
+"""
+
+from oslo.config import cfg
+
+from glance.common import exception
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+admission_opts = [
+    cfg.IntOpt('image_cache_admission_min_misses', default=1,
+               help=_('The number of requests that must miss the cache for '
+                      'an image within image_cache_admission_window seconds '
+                      'before the image is written into the cache.')),
+    cfg.IntOpt('image_cache_admission_window', default=3600,
+               help=_('The number of seconds after which the cache misses '
+                      'of an image are counted afresh.')),
+    cfg.IntOpt('image_cache_admission_max_image_size', default=0,
+               help=_('The size in bytes of the largest image written into '
+                      'the cache. Set to 0 for no limit.')),
+    cfg.ListOpt('image_cache_admission_disk_formats', default=[],
+                help=_('Limits on the size in bytes of the images of some '
+                       'disk formats written into the cache, as a list of '
+                       'disk_format:bytes entries. A limit of 0 keeps '
+                       'images of that format out of the cache.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(admission_opts)
+
+
+def parse_disk_format_limits(entries):
+    """
+    Parse the entries of the image_cache_admission_disk_formats option
+    into a dict mapping disk formats to size limits.
+    """
+    limits = {}
+    for entry in entries:
+        disk_format, sep, limit = entry.partition(':')
+        try:
+            limits[disk_format.strip()] = int(limit)
+        except ValueError:
+            msg = (_("Invalid image_cache_admission_disk_formats entry "
+                     "'%s', expected disk_format:bytes") % entry)
+            raise exception.BadDriverConfiguration(driver_name='admission',
+                                                   reason=msg)
+    return limits
+
+
+class AdmissionPolicy(object):
+
+    """
+    Decides whether a downloaded image is written into the cache.
+
+    :param min_misses: Misses needed within the window to be admitted
+    :param max_image_size: Size in bytes of the largest image admitted,
+                           or 0 for no limit
+    :param disk_format_limits: Dict mapping disk formats to the size in
+                               bytes of the largest image of that format
+                               admitted
+    """
+
+    def __init__(self, min_misses=1, max_image_size=0,
+                 disk_format_limits=None):
+        self.min_misses = min_misses
+        self.max_image_size = max_image_size
+        self.disk_format_limits = disk_format_limits or {}
+
+    @classmethod
+    def from_config(cls):
+        return cls(CONF.image_cache_admission_min_misses,
+                   CONF.image_cache_admission_max_image_size,
+                   parse_disk_format_limits(
+                       CONF.image_cache_admission_disk_formats))
+
+    @property
+    def needs_disk_format(self):
+        return bool(self.disk_format_limits)
+
+    def check(self, image_size, disk_format, misses):
+        """
+        Returns None if an image is admitted, otherwise the reason why not.
+
+        :param image_size: Size of the image in bytes, or None if unknown
+        :param disk_format: Disk format of the image, or None if unknown
+        :param misses: Number of cache misses of the image in the window,
+                       or None to admit the image regardless of its misses
+        """
+        if (self.min_misses > 1 and misses is not None and
+                misses < self.min_misses):
+            return (_("missed the cache %(misses)d of %(min_misses)d times") %
+                    {'misses': misses, 'min_misses': self.min_misses})
+        if (self.max_image_size and image_size and
+                image_size > self.max_image_size):
+            return (_("%(size)d bytes is over the limit of %(limit)d") %
+                    {'size': image_size, 'limit': self.max_image_size})
+        limit = self.disk_format_limits.get(disk_format)
+        if limit == 0:
+            return _("disk format %s is not cached") % disk_format
+        if limit and image_size and image_size > limit:
+            return (_("%(size)d bytes is over the limit of %(limit)d for "
+                      "disk format %(disk_format)s") %
+                    {'size': image_size, 'limit': limit,
+                     'disk_format': disk_format})
+        return None
@@ -57,11 +57,14 @@ class CacheClient(base_client.BaseClient):
         num_deleted = data['num_deleted']
         return num_deleted
 
-    def queue_image_for_caching(self, image_id):
+    def queue_image_for_caching(self, image_id, priority=None):
         """
         Queue an image for prefetching into cache
         """
-        self.do_request("PUT", "/queued_images/%s" % image_id)
+        params = None
+        if priority is not None:
+            params = {'priority': priority}
+        self.do_request("PUT", "/queued_images/%s" % image_id, params=params)
         return True
 
     def delete_queued_image(self, image_id):
@@ -80,6 +83,21 @@ class CacheClient(base_client.BaseClient):
         num_deleted = data['num_deleted']
         return num_deleted
 
+    def get_cache_stats(self):
+        """
+        Returns a mapping of the image cache's counters
+        """
+        res = self.do_request("GET", "/cache_stats")
+        data = json.loads(res.read())['cache_stats']
+        return data
+
+    def reset_cache_stats(self):
+        """
+        Set the image cache's counters back to zero
+        """
+        self.do_request("DELETE", "/cache_stats")
+        return True
+
 
 def get_client(host, port=None, timeout=None, use_ssl=False, username=None,
                password=None, tenant=None,
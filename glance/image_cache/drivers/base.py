@@ -19,12 +19,14 @@
 Base attribute driver class
 """
 
+import errno
 import os.path
 
 from oslo.config import cfg
 
 from glance.common import exception
 from glance.common import utils
+from glance.image_cache import partial
 import glance.openstack.common.log as logging
 
 LOG = logging.getLogger(__name__)
@@ -32,8 +34,34 @@ LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
 
+def is_same_file(path, file_stat):
+    """
+    Returns True if `path` names the file `file_stat` was taken from with
+    os.fstat(), False if the path is gone or names another file.
+
+    A fill that stalls may be taken over by another request, which moves
+    the incomplete file aside and writes a new one. The stalled fill must
+    then neither commit nor roll back the file at the incomplete path.
+
+    :param path: Path to check
+    :param file_stat: Result of os.fstat() on an open file
+    """
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+    return ((path_stat.st_dev, path_stat.st_ino) ==
+            (file_stat.st_dev, file_stat.st_ino))
+
+
 class Driver(object):
 
+    def __init__(self, base_dir=None):
+        """
+        :param base_dir: Cache directory to use instead of image_cache_dir
+        """
+        self.base_dir = base_dir
+
     def configure(self):
         """
         Configure the driver to use the stored configuration options
@@ -51,7 +79,8 @@ class Driver(object):
         Creates all necessary directories under the base cache directory
         """
 
-        self.base_dir = CONF.image_cache_dir
+        if self.base_dir is None:
+            self.base_dir = CONF.image_cache_dir
         if self.base_dir is None:
             msg = _('Failed to read %s from config') % 'image_cache_dir'
             LOG.error(msg)
@@ -62,18 +91,31 @@ class Driver(object):
         self.incomplete_dir = os.path.join(self.base_dir, 'incomplete')
         self.invalid_dir = os.path.join(self.base_dir, 'invalid')
         self.queue_dir = os.path.join(self.base_dir, 'queue')
+        self.partial_dir = os.path.join(self.base_dir, 'partial')
+        self.misses_dir = os.path.join(self.base_dir, 'misses')
+        self.metadata_dir = os.path.join(self.base_dir, 'metadata')
+        self.stats_dir = os.path.join(self.base_dir, 'stats')
 
-        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir]
+        dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir,
+                self.partial_dir, self.misses_dir, self.metadata_dir,
+                self.stats_dir]
 
         for path in dirs:
             utils.safe_mkdirs(path)
 
     def get_cache_size(self):
         """
-        Returns the total size in bytes of the image cache.
+        Returns the total size in bytes of the image cache, including the
+        partly cached images, see `get_partial_size`.
         """
         raise NotImplementedError
 
+    def get_partial_size(self):
+        """
+        Returns the space in bytes taken by partly cached images.
+        """
+        return partial.get_size(self.partial_dir)
+
     def get_cached_images(self):
         """
         Returns a list of records about cached images.
@@ -189,6 +231,38 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def claim_for_write(self, image_id):
+        """
+        Atomically create the incomplete file for an image, so that only
+        one request writes the image into the cache. Returns True if the
+        claim succeeded, False if the image is already being written.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'incomplete')
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def abandon_write(self, image_id):
+        """
+        Move the incomplete file for an image to the invalid directory,
+        giving up the claim on writing it into the cache.
+
+        :param image_id: Image ID
+        """
+        incomplete_path = self.get_image_filepath(image_id, 'incomplete')
+        invalid_path = self.get_image_filepath(image_id, 'invalid')
+        try:
+            os.rename(incomplete_path, invalid_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def get_image_filepath(self, image_id, cache_status='active'):
         """
         This crafts an absolute path to a specific entry
@@ -20,12 +20,14 @@ Cache driver that uses SQLite to store information about cached images
 """
 
 from __future__ import absolute_import
+import atexit
 from contextlib import contextmanager
+import errno
 import os
 import stat
 import time
 
-from eventlet import sleep, timeout
+from eventlet import greenthread, semaphore, sleep, timeout
 from oslo.config import cfg
 import sqlite3
 
@@ -39,6 +41,11 @@ sqlite_opts = [
     cfg.StrOpt('image_cache_sqlite_db', default='cache.db',
                help=_('The path to the sqlite file database that will be '
                       'used for image cache management.')),
+    cfg.IntOpt('image_cache_sqlite_hit_flush_interval', default=5,
+               help=_('The number of seconds image hits and access times '
+                      'are buffered in memory before being written to the '
+                      'image cache database. Set to 0 to write each hit as '
+                      'it happens.')),
 ]
 
 CONF = cfg.CONF
@@ -77,6 +84,105 @@ class SqliteConnection(sqlite3.Connection):
         return self._timeout(lambda: sqlite3.Connection.commit(self))
 
 
+class Database(object):
+
+    """
+    A per-process connection to an image cache database, together with
+    the image hits that have not been written to it yet.
+
+    The connection is shared by all the drivers of a process using the
+    same database file, and is put in WAL mode so that readers in other
+    processes, like the cache pruner, do not block on it.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = semaphore.Semaphore()
+        self.pending_hits = {}
+        self.last_flush = time.time()
+        self.flush_timer = None
+        self.conn = sqlite3.connect(db_path, check_same_thread=False,
+                                    factory=SqliteConnection)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('PRAGMA count_changes = OFF')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+
+    def record_hit(self, image_id, accessed):
+        """
+        Buffer a hit on a cached image, flushing the buffered hits if they
+        are older than the configured flush interval. Otherwise a timer
+        flushes them once the interval has passed, even if no other hit
+        comes in.
+        """
+        hits, _last_accessed = self.pending_hits.get(image_id, (0, 0))
+        self.pending_hits[image_id] = (hits + 1, accessed)
+        interval = CONF.image_cache_sqlite_hit_flush_interval
+        if accessed - self.last_flush >= interval:
+            self.flush_hits()
+        elif self.flush_timer is None:
+            self.flush_timer = greenthread.spawn_after(interval,
+                                                       self.flush_hits)
+
+    def discard_hits(self, image_id=None):
+        """Drop the buffered hits of one, or all, images"""
+        if image_id is None:
+            self.pending_hits.clear()
+        else:
+            self.pending_hits.pop(image_id, None)
+
+    def flush_hits(self):
+        """Write all buffered hits to the database in one transaction"""
+        if self.flush_timer is not None:
+            # Does nothing if the timer is what is flushing the hits
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        self.last_flush = time.time()
+        if not self.pending_hits:
+            return
+        pending = self.pending_hits
+        self.pending_hits = {}
+        with self.lock:
+            try:
+                self.conn.executemany("""UPDATE cached_images
+                                      SET hits = hits + ?, last_accessed = ?
+                                      WHERE image_id = ?""",
+                                      [(hits, accessed, image_id)
+                                       for image_id, (hits, accessed)
+                                       in pending.items()])
+                self.conn.commit()
+            except sqlite3.DatabaseError as e:
+                msg = _("Failed to record image cache hits. "
+                        "Got error: %s") % e
+                LOG.error(msg)
+                self.conn.rollback()
+
+
+_DATABASES = {}
+
+
+def get_database(db_path):
+    """
+    Return the `Database` of this process for the supplied path. A child
+    process never reuses a connection opened before it was forked.
+    """
+    key = (os.getpid(), db_path)
+    if key not in _DATABASES:
+        _DATABASES[key] = Database(db_path)
+    return _DATABASES[key]
+
+
+@atexit.register
+def flush_all_hits():
+    """Write the buffered hits of every database used by this process"""
+    pid = os.getpid()
+    for (db_pid, db_path), database in _DATABASES.items():
+        if db_pid == pid:
+            database.flush_hits()
+
+
 def dict_factory(cur, row):
     return dict(
         ((col[0], row[idx]) for idx, col in enumerate(cur.description)))
@@ -104,6 +210,9 @@ class Driver(base.Driver):
     def initialize_db(self):
         db = CONF.image_cache_sqlite_db
         self.db_path = os.path.join(self.base_dir, db)
+        # The database file and the journals SQLite keeps beside it
+        self.db_files = [self.db_path + suffix
+                         for suffix in ('', '-journal', '-wal', '-shm')]
         try:
             conn = sqlite3.connect(self.db_path, check_same_thread=False,
                                    factory=SqliteConnection)
@@ -131,11 +240,11 @@ class Driver(base.Driver):
         """
         sizes = []
         for path in self.get_cache_files(self.base_dir):
-            if path == self.db_path:
+            if path in self.db_files:
                 continue
             file_info = os.stat(path)
             sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        return sum(sizes) + self.get_partial_size()
 
     def get_hit_count(self, image_id):
         """
@@ -147,6 +256,7 @@ class Driver(base.Driver):
             return 0
 
         hits = 0
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT hits FROM cached_images
                              WHERE image_id = ?""",
@@ -159,6 +269,7 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         LOG.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT
                              image_id, hits, last_accessed, last_modified, size
@@ -211,6 +322,7 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
+        self.database.discard_hits()
         with self.get_db() as db:
             for path in self.get_cache_files(self.base_dir):
                 delete_cached_file(path)
@@ -226,6 +338,7 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
+        self.database.discard_hits(image_id)
         with self.get_db() as db:
             delete_cached_file(path)
             db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
@@ -271,6 +384,7 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT image_id FROM cached_images
                              ORDER BY last_accessed LIMIT 1""")
@@ -293,8 +407,18 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
+        # The stat of the file this fill opened, see base.is_same_file
+        file_stat = []
+
+        def owns_file():
+            return (not file_stat or
+                    base.is_same_file(incomplete_path, file_stat[0]))
 
         def commit():
+            if not owns_file():
+                LOG.warn(_("Cache fill of image '%s' was taken over by "
+                           "another request, discarding it"), image_id)
+                return
             with self.get_db() as db:
                 final_path = self.get_image_filepath(image_id)
                 LOG.debug(_("Fetch finished, moving "
@@ -317,6 +441,8 @@ class Driver(base.Driver):
                 db.commit()
 
         def rollback(e):
+            if not owns_file():
+                return
             with self.get_db() as db:
                 if os.path.exists(incomplete_path):
                     invalid_path = self.get_image_filepath(image_id, 'invalid')
@@ -332,6 +458,7 @@ class Driver(base.Driver):
 
         try:
             with open(incomplete_path, 'wb') as cache_file:
+                file_stat.append(os.fstat(cache_file.fileno()))
                 yield cache_file
         except Exception as e:
             rollback(e)
@@ -344,7 +471,7 @@ class Driver(base.Driver):
             # nor commit will have been called, so the incomplete file
             # will persist - in that case remove it as it is unusable
             # example: ^c from client fetch
-            if os.path.exists(incomplete_path):
+            if os.path.exists(incomplete_path) and owns_file():
                 rollback('incomplete fetch')
 
     @contextmanager
@@ -358,36 +485,33 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
             yield cache_file
-        now = time.time()
-        with self.get_db() as db:
-            db.execute("""UPDATE cached_images
-                       SET hits = hits + 1, last_accessed = ?
-                       WHERE image_id = ?""",
-                       (now, image_id))
-            db.commit()
+        self.database.record_hit(image_id, time.time())
+
+    def flush_hits(self):
+        """
+        Write the image hits buffered by this process to the database
+        """
+        self.database.flush_hits()
 
     @contextmanager
     def get_db(self):
         """
-        Returns a context manager that produces a database connection that
-        self-closes and calls rollback if an error occurs while using the
-        database connection
-        """
-        conn = sqlite3.connect(self.db_path, check_same_thread=False,
-                               factory=SqliteConnection)
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = str
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA count_changes = OFF')
-        conn.execute('PRAGMA temp_store = MEMORY')
-        try:
-            yield conn
-        except sqlite3.DatabaseError as e:
-            msg = _("Error executing SQLite call. Got error: %s") % e
-            LOG.error(msg)
-            conn.rollback()
-        finally:
-            conn.close()
+        Returns a context manager that produces the process's database
+        connection, holding its lock, and calls rollback if an error occurs
+        while using the database connection
+        """
+        database = self.database
+        with database.lock:
+            try:
+                yield database.conn
+            except sqlite3.DatabaseError as e:
+                msg = _("Error executing SQLite call. Got error: %s") % e
+                LOG.error(msg)
+                database.conn.rollback()
+
+    @property
+    def database(self):
+        return get_database(self.db_path)
 
     def queue_image(self, image_id):
         """
@@ -458,7 +582,13 @@ class Driver(base.Driver):
         files = [f for f in self.get_cache_files(self.queue_dir)]
         items = []
         for path in files:
-            mtime = os.path.getmtime(path)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError as e:
+                # The image was taken off the queue since it was listed
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
             items.append((mtime, os.path.basename(path)))
 
         items.sort()
@@ -472,7 +602,7 @@ class Driver(base.Driver):
         """
         for fname in os.listdir(basepath):
             path = os.path.join(basepath, fname)
-            if path != self.db_path and os.path.isfile(path):
+            if path not in self.db_files and os.path.isfile(path):
                 yield path
 
 
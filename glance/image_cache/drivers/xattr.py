@@ -57,10 +57,13 @@ from __future__ import absolute_import
 from contextlib import contextmanager
 import datetime
 import errno
+import heapq
 import os
 import stat
 import time
 
+import eventlet
+from eventlet import tpool
 from oslo.config import cfg
 import xattr
 
@@ -73,6 +76,206 @@ LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
 
+class CacheIndex(object):
+
+    """
+    An in-process index of the size, access time and hits of the images in
+    a cache directory, so that the driver does not have to stat and read
+    the xattrs of every cached file to answer size and LRU queries.
+
+    The index is built by scanning the directory, and kept current by the
+    driver's own writes, reads and deletes, after which the directory's
+    new mtime is recorded. Images added, replaced or removed by other
+    processes change the directory's mtime; when the driver next notices
+    it, the directory is listed again and only the files that appeared or
+    changed inode or size since are read. Hits and access times recorded
+    by other processes are only picked up on a rebuild.
+    """
+
+    # Seconds during which a directory mtime may still be shared by later
+    # changes, on filesystems with coarse timestamps
+    MTIME_GRANULARITY = 1
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.entries = {}
+        # The inode and size of the file of each entry
+        self.files = {}
+        self.lru_heap = []
+        self.total_size = 0
+        self.dir_mtime = None
+        # Whether the directory is to be listed once more after
+        # MTIME_GRANULARITY, as changes may have kept dir_mtime as it is
+        self.recheck = False
+
+    def _dir_mtime(self):
+        return os.stat(self.base_dir).st_mtime
+
+    def _set_dir_mtime(self, dir_mtime):
+        # NOTE: Filesystems with coarse timestamps give whole seconds, and a
+        # change made within the same second may keep the mtime as it is.
+        # Such a recent mtime is only trusted once the directory has been
+        # listed again after the granularity has passed.
+        self.dir_mtime = dir_mtime
+        self.recheck = (dir_mtime == int(dir_mtime) and
+                        time.time() - dir_mtime <= self.MTIME_GRANULARITY)
+
+    def refresh(self):
+        """Update the index if the cache directory has changed under it"""
+        dir_mtime = self._dir_mtime()
+        if (dir_mtime != self.dir_mtime or
+                (self.recheck and
+                 time.time() - dir_mtime > self.MTIME_GRANULARITY)):
+            self._sync(dir_mtime)
+
+    def rebuild(self):
+        """
+        Scan the cache directory, reading the files' stats and xattrs in
+        eventlet's pool of native threads.
+        """
+        LOG.debug(_("Building image cache index of %s"), self.base_dir)
+        self.clear()
+        self._sync(self._dir_mtime())
+
+    def _sync(self, dir_mtime):
+        """
+        Bring the index in line with the files in the cache directory,
+        which had the supplied mtime before it was listed. Our own changes
+        are in the index already, so only the files of images added,
+        replaced or removed by other processes are read or dropped.
+        """
+        # NOTE: The mtime is read before listing the directory, so a change
+        # made while it is listed is seen on the next refresh.
+        self._set_dir_mtime(dir_mtime)
+        paths = list(get_all_regular_files(self.base_dir))
+        image_ids = set(os.path.basename(path) for path in paths)
+        for image_id in set(self.entries) - image_ids:
+            self.remove(image_id)
+        pool = eventlet.GreenPool()
+        changed = []
+        for path, file_info in zip(paths, pool.imap(
+                lambda path: tpool.execute(_stat_file, path), paths)):
+            image_id = os.path.basename(path)
+            if file_info is None:
+                # Deleted since the directory was listed
+                self.remove(image_id)
+                continue
+            identity = (file_info.st_ino, file_info.st_size)
+            if self.files.get(image_id) != identity:
+                self.remove(image_id)
+                self.files[image_id] = identity
+                changed.append(path)
+        for entry in pool.imap(lambda path: tpool.execute(_read_entry, path),
+                               changed):
+            if entry is not None and entry['image_id'] not in self.entries:
+                self.entries[entry['image_id']] = entry
+                self.total_size += entry['size']
+                heapq.heappush(self.lru_heap,
+                               (entry['last_accessed'], entry['image_id']))
+
+    def record_change(self):
+        """
+        Record the mtime of the cache directory after a change this process
+        made to it and to the index, so that the change does not make the
+        next refresh list the directory.
+        """
+        self._set_dir_mtime(self._dir_mtime())
+
+    def add(self, image_id, file_info, now):
+        """
+        Record an image that was moved into the cache directory, with the
+        stat of its file.
+        """
+        self.remove(image_id)
+        self.entries[image_id] = {'image_id': image_id,
+                                  'last_modified': now,
+                                  'last_accessed': now,
+                                  'size': file_info.st_size,
+                                  'hits': 0}
+        self.files[image_id] = (file_info.st_ino, file_info.st_size)
+        self.total_size += file_info.st_size
+        heapq.heappush(self.lru_heap, (now, image_id))
+
+    def remove(self, image_id):
+        """Forget an image that was deleted from the cache directory"""
+        self.files.pop(image_id, None)
+        entry = self.entries.pop(image_id, None)
+        if entry is not None:
+            self.total_size -= entry['size']
+
+    def clear(self):
+        """Forget all images after the cache directory was emptied"""
+        self.entries = {}
+        self.files = {}
+        self.lru_heap = []
+        self.total_size = 0
+
+    def record_hit(self, image_id, now):
+        """Record a read of a cached image"""
+        entry = self.entries.get(image_id)
+        if entry is None:
+            return
+        entry['hits'] += 1
+        entry['last_accessed'] = now
+        heapq.heappush(self.lru_heap, (now, image_id))
+        # Drop the entries left behind by earlier hits once they dominate
+        if len(self.lru_heap) > 2 * len(self.entries) + 64:
+            self.lru_heap = [(entry['last_accessed'], image_id)
+                             for image_id, entry in self.entries.items()]
+            heapq.heapify(self.lru_heap)
+
+    def least_recently_accessed(self):
+        """Return the entry of the least recently accessed image, or None"""
+        heap = self.lru_heap
+        while heap:
+            accessed, image_id = heap[0]
+            entry = self.entries.get(image_id)
+            if entry is not None and entry['last_accessed'] == accessed:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+
+_INDEXES = {}
+
+
+def get_index(base_dir):
+    """
+    Return the `CacheIndex` of this process for the supplied cache
+    directory, building it on first use.
+    """
+    key = (os.getpid(), base_dir)
+    if key not in _INDEXES:
+        index = CacheIndex(base_dir)
+        index.rebuild()
+        _INDEXES[key] = index
+    return _INDEXES[key]
+
+
+def _stat_file(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _read_entry(path):
+    try:
+        file_info = os.stat(path)
+    except OSError:
+        # Deleted since the directory was listed
+        return None
+    try:
+        hits = int(get_xattr(path, 'hits', default=0))
+    except ValueError:
+        hits = 0
+    return {'image_id': os.path.basename(path),
+            'last_modified': file_info[stat.ST_MTIME],
+            'last_accessed': file_info[stat.ST_ATIME],
+            'size': file_info[stat.ST_SIZE],
+            'hits': hits}
+
+
 class Driver(base.Driver):
 
     """
@@ -116,15 +319,18 @@ class Driver(base.Driver):
             if os.path.exists(fake_image_filepath):
                 os.unlink(fake_image_filepath)
 
+    @property
+    def index(self):
+        """The up to date `CacheIndex` of the cache directory"""
+        index = get_index(self.base_dir)
+        index.refresh()
+        return index
+
     def get_cache_size(self):
         """
         Returns the total size in bytes of the image cache.
         """
-        sizes = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        return self.index.total_size + self.get_partial_size()
 
     def get_hit_count(self, image_id):
         """
@@ -143,21 +349,8 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         LOG.debug(_("Gathering cached image entries."))
-        entries = []
-        for path in get_all_regular_files(self.base_dir):
-            image_id = os.path.basename(path)
-
-            entry = {}
-            entry['image_id'] = image_id
-
-            file_info = os.stat(path)
-            entry['last_modified'] = file_info[stat.ST_MTIME]
-            entry['last_accessed'] = file_info[stat.ST_ATIME]
-            entry['size'] = file_info[stat.ST_SIZE]
-            entry['hits'] = self.get_hit_count(image_id)
-
-            entries.append(entry)
-        entries.sort()  # Order by ID
+        entries = [dict(entry) for entry in self.index.entries.values()]
+        entries.sort(key=lambda entry: entry['image_id'])  # Order by ID
         return entries
 
     def is_cached(self, image_id):
@@ -205,6 +398,9 @@ class Driver(base.Driver):
         for path in get_all_regular_files(self.base_dir):
             delete_cached_file(path)
             deleted += 1
+        index = get_index(self.base_dir)
+        index.clear()
+        index.record_change()
         return deleted
 
     def delete_cached_image(self, image_id):
@@ -214,7 +410,10 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
+        index = self.index
         delete_cached_file(path)
+        index.remove(str(image_id))
+        index.record_change()
 
     def delete_all_queued_images(self):
         """
@@ -240,18 +439,10 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
-        stats = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            stats.append((file_info[stat.ST_ATIME],  # access time
-                          file_info[stat.ST_SIZE],   # size in bytes
-                          path))                     # absolute path
-
-        if not stats:
+        entry = self.index.least_recently_accessed()
+        if entry is None:
             return None
-
-        stats.sort()
-        return os.path.basename(stats[0][2]), stats[0][1]
+        return entry['image_id'], entry['size']
 
     @contextmanager
     def open_for_write(self, image_id):
@@ -262,11 +453,21 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
+        # The stat of the file this fill opened, see base.is_same_file
+        file_stat = []
+
+        def owns_file():
+            return (not file_stat or
+                    base.is_same_file(incomplete_path, file_stat[0]))
 
         def set_attr(key, value):
             set_xattr(incomplete_path, key, value)
 
         def commit():
+            if not owns_file():
+                LOG.warn(_("Cache fill of image '%s' was taken over by "
+                           "another request, discarding it"), image_id)
+                return
             set_attr('hits', 0)
 
             final_path = self.get_image_filepath(image_id)
@@ -274,7 +475,11 @@ class Driver(base.Driver):
                         "'%(incomplete_path)s' to '%(final_path)s'"),
                       dict(incomplete_path=incomplete_path,
                            final_path=final_path))
+            file_info = os.stat(incomplete_path)
+            index = self.index
             os.rename(incomplete_path, final_path)
+            index.add(str(image_id), file_info, time.time())
+            index.record_change()
 
             # Make sure that we "pop" the image from the queue...
             if self.is_queued(image_id):
@@ -283,6 +488,8 @@ class Driver(base.Driver):
                 os.unlink(self.get_image_filepath(image_id, 'queue'))
 
         def rollback(e):
+            if not owns_file():
+                return
             set_attr('error', "%s" % e)
 
             invalid_path = self.get_image_filepath(image_id, 'invalid')
@@ -293,6 +500,7 @@ class Driver(base.Driver):
 
         try:
             with open(incomplete_path, 'wb') as cache_file:
+                file_stat.append(os.fstat(cache_file.fileno()))
                 yield cache_file
         except Exception as e:
             rollback(e)
@@ -305,7 +513,7 @@ class Driver(base.Driver):
             # nor commit will have been called, so the incomplete file
             # will persist - in that case remove it as it is unusable
             # example: ^c from client fetch
-            if os.path.exists(incomplete_path):
+            if os.path.exists(incomplete_path) and owns_file():
                 rollback('incomplete fetch')
 
     @contextmanager
@@ -321,6 +529,7 @@ class Driver(base.Driver):
             yield cache_file
         path = self.get_image_filepath(image_id)
         inc_xattr(path, 'hits', 1)
+        self.index.record_hit(str(image_id), time.time())
 
     def queue_image(self, image_id):
         """
@@ -365,7 +574,13 @@ class Driver(base.Driver):
         files = [f for f in get_all_regular_files(self.queue_dir)]
         items = []
         for path in files:
-            mtime = os.path.getmtime(path)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError as e:
+                # The image was taken off the queue since it was listed
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
             items.append((mtime, os.path.basename(path)))
 
         items.sort()
@@ -0,0 +1,250 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Eviction policies used when pruning the image cache.
+
+A policy is handed the records returned by the cache driver's
+`get_cached_images()` call (dicts with image_id, size, hits,
+last_accessed and last_modified keys) and picks the images to remove
+in a single pass. Policies that learn from past prunes, like ARC, keep
+what they learnt in a state file next to the cache counters, as the
+pruner runs as a new process every time.
+"""
+
+import os
+
+from glance.common.ordereddict import OrderedDict
+from glance.openstack.common import importutils
+from glance.openstack.common import jsonutils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def _last_used(entry):
+    return (entry['last_accessed'] or entry['last_modified'] or 0,
+            entry['image_id'])
+
+
+class EvictionPolicy(object):
+
+    """Base class for image cache eviction policies"""
+
+    def order(self, entries):
+        """
+        Return the supplied cache entries sorted so that the entries to
+        evict first come first.
+
+        :param entries: list of cached image records
+        """
+        raise NotImplementedError
+
+    def select_victims(self, entries, bytes_to_free):
+        """
+        Return the entries that should be removed from the cache in order
+        to free at least `bytes_to_free` bytes, in eviction order.
+
+        :param entries: list of cached image records
+        :param bytes_to_free: number of bytes that must be freed
+        """
+        victims = []
+        freed = 0
+        for entry in self.order(entries):
+            if freed >= bytes_to_free:
+                break
+            victims.append(entry)
+            freed += entry['size']
+        return victims
+
+    def get_state(self):
+        """
+        Return what the policy learnt from the prunes so far, as a JSON
+        serializable value, or None if the policy keeps no state.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restore the state returned by `get_state()`, or start afresh if
+        `state` is None.
+        """
+        pass
+
+
+class LRUPolicy(EvictionPolicy):
+
+    """Evicts the least recently accessed images first"""
+
+    def order(self, entries):
+        return sorted(entries, key=_last_used)
+
+
+class LFUPolicy(EvictionPolicy):
+
+    """
+    Evicts the least frequently accessed images first, using the least
+    recently accessed image to break ties.
+    """
+
+    def order(self, entries):
+        return sorted(entries, key=lambda e: (e['hits'], _last_used(e)))
+
+
+class GDSFPolicy(EvictionPolicy):
+
+    """
+    Greedy-Dual-Size-Frequency eviction.
+
+    Images are ranked by (hits + 1) / size, so a large image needs
+    proportionally more hits than a small one to stay in the cache. Every
+    image costs the same to fetch again, and the ranking is recomputed on
+    each prune from the hit counts the driver keeps, so the inflation
+    value of the original algorithm is not needed.
+    """
+
+    def order(self, entries):
+        def priority(entry):
+            size = max(entry['size'], 1)
+            return (float(entry['hits'] + 1) / size, _last_used(entry))
+        return sorted(entries, key=priority)
+
+
+class ARCPolicy(EvictionPolicy):
+
+    """
+    Adaptive Replacement Cache eviction.
+
+    Cached images hit at most once form the recency list (T1) and images
+    hit more often form the frequency list (T2). Evicted images are
+    remembered in the ghost lists B1 and B2; when one of them is cached
+    again, the target size of T1 is grown or shrunk accordingly. The ghost
+    lists and the target size are part of the policy's state, so they
+    outlive the process running the pruner.
+    """
+
+    def __init__(self):
+        self.set_state(None)
+
+    def get_state(self):
+        return {'target': self.target,
+                'recent_ghosts': self.recent_ghosts.items(),
+                'frequent_ghosts': self.frequent_ghosts.items()}
+
+    def set_state(self, state):
+        state = state or {}
+        self.target = state.get('target', 0)
+        self.recent_ghosts = OrderedDict(state.get('recent_ghosts', []))
+        self.frequent_ghosts = OrderedDict(state.get('frequent_ghosts', []))
+
+    def _adapt(self, entries, capacity):
+        recent_size = sum(self.recent_ghosts.values())
+        frequent_size = sum(self.frequent_ghosts.values())
+        for entry in entries:
+            image_id = entry['image_id']
+            if image_id in self.recent_ghosts:
+                ratio = max(float(frequent_size) / max(recent_size, 1), 1)
+                self.target = min(capacity,
+                                  self.target + ratio * entry['size'])
+                recent_size -= self.recent_ghosts.pop(image_id)
+            elif image_id in self.frequent_ghosts:
+                ratio = max(float(recent_size) / max(frequent_size, 1), 1)
+                self.target = max(0, self.target - ratio * entry['size'])
+                frequent_size -= self.frequent_ghosts.pop(image_id)
+
+    def _trim_ghosts(self, capacity):
+        for ghosts in (self.recent_ghosts, self.frequent_ghosts):
+            while ghosts and sum(ghosts.values()) > capacity:
+                ghosts.popitem(last=False)
+
+    def select_victims(self, entries, bytes_to_free):
+        capacity = max(sum(e['size'] for e in entries) - bytes_to_free, 0)
+        self._adapt(entries, capacity)
+
+        recent = sorted([e for e in entries if e['hits'] <= 1],
+                        key=_last_used)
+        frequent = sorted([e for e in entries if e['hits'] > 1],
+                          key=_last_used)
+        recent_size = sum(e['size'] for e in recent)
+
+        victims = []
+        freed = 0
+        while freed < bytes_to_free and (recent or frequent):
+            if recent and (recent_size > self.target or not frequent):
+                entry = recent.pop(0)
+                recent_size -= entry['size']
+                self.recent_ghosts[entry['image_id']] = entry['size']
+            else:
+                entry = frequent.pop(0)
+                self.frequent_ghosts[entry['image_id']] = entry['size']
+            victims.append(entry)
+            freed += entry['size']
+
+        self._trim_ghosts(capacity)
+        return victims
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gdsf': GDSFPolicy,
+    'arc': ARCPolicy,
+}
+
+
+def load_state(policy, path):
+    """
+    Restore the state of a policy from the supplied file, if there is one.
+    """
+    try:
+        with open(path) as state_file:
+            state = jsonutils.load(state_file)
+    except (IOError, ValueError):
+        state = None
+    policy.set_state(state)
+
+
+def save_state(policy, path):
+    """
+    Write the state of a policy to the supplied file, if it has any.
+    """
+    state = policy.get_state()
+    if state is None:
+        return
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as state_file:
+            state_file.write(jsonutils.dumps(state))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        LOG.warn(_("Failed to write the eviction policy state to "
+                   "%(path)s: %(e)s"), {'path': path, 'e': e})
+
+
+def get_policy(name):
+    """
+    Return an eviction policy instance for the supplied name, which is
+    either one of the built in policies or the dotted path of an
+    `EvictionPolicy` subclass.
+
+    :param name: policy name or class path
+    :raises `ImportError` if the policy cannot be loaded
+    """
+    policy_class = POLICIES.get(name.lower())
+    if policy_class is None:
+        policy_class = importutils.import_class(name)
+    return policy_class()
@@ -0,0 +1,122 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory tier of the image cache.
+
+Small images that are read from the disk cache often are copied into the
+memory of the API process, and served from there until the tier's
+eviction policy demotes them to the disk cache only. The disk cache
+keeps its copy of every image held in memory.
+"""
+
+import time
+
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class MemoryTier(object):
+
+    """
+    A bounded, per-process store of the data of small, hot cached images.
+
+    :param max_size: Total number of bytes of image data held in memory
+    :param max_image_size: Size in bytes of the largest image held
+    :param promote_hits: Number of reads from disk after which an image
+                         is copied into memory
+    :param policy: `glance.image_cache.eviction.EvictionPolicy` used to
+                   pick the images demoted when the tier is full
+    """
+
+    def __init__(self, max_size, max_image_size, promote_hits, policy):
+        self.max_size = max_size
+        self.max_image_size = min(max_image_size, max_size)
+        self.promote_hits = promote_hits
+        self.policy = policy
+        self.images = {}
+        self.entries = {}
+        self.disk_hits = {}
+        self.size = 0
+
+    def get(self, image_id):
+        """Return the data of an image held in memory, or None"""
+        data = self.images.get(image_id)
+        if data is not None:
+            entry = self.entries[image_id]
+            entry['hits'] += 1
+            entry['last_accessed'] = time.time()
+        return data
+
+    def record_disk_hit(self, image_id, image_size):
+        """
+        Count a read of an image from the disk cache. Returns True if the
+        image should now be promoted into memory.
+        """
+        if image_id in self.images or image_size > self.max_image_size:
+            return False
+        hits = self.disk_hits.get(image_id, 0) + 1
+        if hits < self.promote_hits:
+            # NOTE: The counts only decide promotions, so they are simply
+            # started over once there are too many to keep.
+            if len(self.disk_hits) >= 10000:
+                self.disk_hits.clear()
+            self.disk_hits[image_id] = hits
+            return False
+        self.disk_hits.pop(image_id, None)
+        return True
+
+    def put(self, image_id, data):
+        """Hold the data of an image in memory, demoting others if needed"""
+        size = len(data)
+        if size > self.max_image_size:
+            return
+        self.discard(image_id)
+        now = time.time()
+        self.images[image_id] = data
+        self.entries[image_id] = {'image_id': image_id,
+                                  'size': size,
+                                  'hits': 0,
+                                  'last_accessed': now,
+                                  'last_modified': now}
+        self.size += size
+        LOG.debug(_("Promoted image '%s' to the memory cache"), image_id)
+
+        if self.size > self.max_size:
+            # NOTE: The new image is the most recently accessed one, and is
+            # only demoted right away by policies weighing other things.
+            victims = self.policy.select_victims(self.entries.values(),
+                                                 self.size - self.max_size)
+            for entry in victims:
+                LOG.debug(_("Demoted image '%s' to the disk cache"),
+                          entry['image_id'])
+                self.discard(entry['image_id'])
+
+    def discard(self, image_id):
+        """Stop holding an image in memory"""
+        self.disk_hits.pop(image_id, None)
+        data = self.images.pop(image_id, None)
+        if data is not None:
+            del self.entries[image_id]
+            self.size -= len(data)
+
+    def clear(self):
+        self.images = {}
+        self.entries = {}
+        self.disk_hits = {}
+        self.size = 0
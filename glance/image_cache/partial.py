@@ -0,0 +1,322 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Partially cached images.
+
+An image of which only some fixed-size blocks are cached lives in the
+`partial` directory of the image cache, next to a block map recording
+which of its blocks are present:
+
+$image_cache_dir/
+  partial/
+    <image_id>         sparse file holding the cached blocks
+    <image_id>.blocks  JSON block map
+    .lock              lock taken to update any block map
+
+Partial images count towards the size of the cache, and are pruned like
+cached images.
+"""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import os
+import shutil
+import time
+
+from glance.openstack.common import jsonutils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+BLOCK_MAP_SUFFIX = '.blocks'
+LOCK_NAME = '.lock'
+
+
+class PartialImage(object):
+
+    """
+    The cached blocks of an image, and the map of which blocks are present.
+
+    The block map is re-read before it is updated, holding the lock of
+    the partial directory, so that processes filling different blocks of
+    the same image do not lose each other's blocks. It is written to a
+    temporary file that is renamed over the old map. Blocks are only ever
+    added to the file of a partial image, so that a block another process
+    found present stays readable until the image is deleted.
+    """
+
+    def __init__(self, path, block_size):
+        self.path = path
+        self.map_path = path + BLOCK_MAP_SUFFIX
+        self.block_size = block_size
+        self.size = None
+        self.blocks = ''
+        self.load()
+
+    def load(self):
+        """Read the block map, discarding it if it uses another block size"""
+        try:
+            with open(self.map_path) as map_file:
+                block_map = jsonutils.load(map_file)
+        except (IOError, ValueError):
+            return
+        if block_map.get('block_size') != self.block_size:
+            LOG.debug(_("Discarding block map '%s' of another block size"),
+                      self.map_path)
+            self.delete()
+            return
+        self.size = block_map.get('size') or self.size
+        self.blocks = block_map.get('blocks', '')
+
+    def save(self):
+        block_map = {'block_size': self.block_size,
+                     'size': self.size,
+                     'blocks': self.blocks}
+        tmp_path = self.map_path + '.tmp'
+        with open(tmp_path, 'w') as map_file:
+            map_file.write(jsonutils.dumps(block_map))
+        os.rename(tmp_path, self.map_path)
+
+    @property
+    def exists(self):
+        return os.path.exists(self.map_path)
+
+    @property
+    def num_blocks(self):
+        """The number of blocks of the image, or None if its size is unknown"""
+        if self.size is None:
+            return None
+        return (self.size + self.block_size - 1) // self.block_size
+
+    @property
+    def num_present(self):
+        return self.blocks.count('1')
+
+    def set_size(self, size):
+        self.size = size
+
+    def block_length(self, index):
+        """The length in bytes of the block with the supplied index"""
+        if self.size is None:
+            return self.block_size
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def has_block(self, index):
+        return index < len(self.blocks) and self.blocks[index] == '1'
+
+    def has_blocks(self, first, last):
+        return all(self.has_block(i) for i in xrange(first, last + 1))
+
+    def is_complete(self):
+        return (self.num_blocks is not None and
+                self.has_blocks(0, self.num_blocks - 1))
+
+    def read_block(self, index):
+        with open(self.path, 'rb') as image_file:
+            image_file.seek(index * self.block_size)
+            return image_file.read(self.block_length(index))
+
+    def write_block(self, index, data):
+        """Write a block of the image and mark it present"""
+        self._write(index, data)
+        self.mark_present(xrange(index, index + 1))
+
+    def _write(self, index, data):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
+        try:
+            os.lseek(fd, index * self.block_size, os.SEEK_SET)
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _locked(self):
+        lock_path = os.path.join(os.path.dirname(self.path), LOCK_NAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def mark_present(self, indexes):
+        with self._locked():
+            self._mark_present(indexes)
+
+    def _mark_present(self, indexes):
+        size = self.size
+        self.load()
+        self.size = self.size or size
+        blocks = list(self.blocks)
+        for index in indexes:
+            if index >= len(blocks):
+                blocks.extend('0' * (index + 1 - len(blocks)))
+            blocks[index] = '1'
+        self.blocks = ''.join(blocks)
+        self.save()
+
+    def adopt(self, path, length):
+        """
+        Take the blocks the partial image is missing from the file at
+        `path`, which holds the first `length` bytes of the image. The
+        file itself is left in place.
+
+        Returns True if any blocks were taken.
+        """
+        present = length // self.block_size
+        if self.size is not None and length >= self.size:
+            present = self.num_blocks
+        with self._locked():
+            self.load()
+            missing = [index for index in xrange(present)
+                       if not self.has_block(index)]
+            if not missing:
+                return False
+            if not self.num_present:
+                # Nothing to keep from an earlier partial image, so the
+                # file is linked rather than copied where possible
+                delete(self.path)
+                _link_or_copy(path, self.path)
+            else:
+                with open(path, 'rb') as image_file:
+                    for index in missing:
+                        image_file.seek(index * self.block_size)
+                        self._write(index, image_file.read(
+                            self.block_length(index)))
+            self._mark_present(missing)
+        return True
+
+    def delete(self):
+        delete(self.path)
+        self.blocks = ''
+
+
+class StoreBlockReader(object):
+
+    """
+    Splits an image iterator, which always starts at the beginning of the
+    image, into blocks, writing the blocks the partial image is missing
+    into it as they go by, unless `write_blocks` is False.
+    """
+
+    def __init__(self, partial, image_iter, write_blocks=True):
+        self.partial = partial
+        self.write_blocks = write_blocks
+        self.image_iter = image_iter
+        self.chunks = iter(image_iter)
+        self.buffer = ''
+        self.next_block = 0
+
+    def read_block(self, index):
+        """Read up to the block with the supplied index and return it"""
+        while self.next_block <= index:
+            length = self.partial.block_length(self.next_block)
+            while len(self.buffer) < length:
+                try:
+                    self.buffer += next(self.chunks)
+                except StopIteration:
+                    raise IOError(_("Image data ended before block %d") %
+                                  self.next_block)
+            data, self.buffer = self.buffer[:length], self.buffer[length:]
+            if (self.write_blocks and
+                    not self.partial.has_block(self.next_block)):
+                self.partial.write_block(self.next_block, data)
+            self.next_block += 1
+        return data
+
+    def close(self):
+        if hasattr(self.image_iter, 'close'):
+            self.image_iter.close()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _image_paths(partial_dir):
+    for fname in os.listdir(partial_dir):
+        if fname == LOCK_NAME or fname.endswith(
+                (BLOCK_MAP_SUFFIX, BLOCK_MAP_SUFFIX + '.tmp')):
+            continue
+        yield os.path.join(partial_dir, fname)
+
+
+def get_partial_images(partial_dir):
+    """
+    Returns records about the partial images in the supplied directory,
+    like the ones drivers return about cached images. The size of a
+    partial image is the space its cached blocks take on disk.
+    """
+    entries = []
+    for path in _image_paths(partial_dir):
+        try:
+            file_info = os.stat(path)
+        except OSError:
+            continue
+        entries.append({'image_id': os.path.basename(path),
+                        'last_accessed': file_info.st_mtime,
+                        'last_modified': file_info.st_mtime,
+                        'size': min(file_info.st_size,
+                                    file_info.st_blocks * 512),
+                        'hits': 0,
+                        'path': path})
+    return entries
+
+
+def get_size(partial_dir):
+    """
+    Returns the space taken on disk by the partial images in the supplied
+    directory.
+    """
+    return sum(entry['size'] for entry in get_partial_images(partial_dir))
+
+
+def reap(partial_dir, grace):
+    """
+    Remove the partial images that have not been written to for `grace`
+    seconds, returning how many were removed.
+    """
+    now = time.time()
+    reaped = 0
+    for path in _image_paths(partial_dir):
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+        if age > grace:
+            LOG.debug(_("Partial cache entry '%s' exceeds grace period"),
+                      path)
+            delete(path)
+            reaped += 1
+    return reaped
+
+
+def delete(path):
+    """Remove a partial image and its block map"""
+    for file_path in (path + BLOCK_MAP_SUFFIX, path):
+        try:
+            os.unlink(file_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
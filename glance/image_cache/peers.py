@@ -0,0 +1,200 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Fetching images from the caches of peer API nodes.
+
+Every image is owned by one node of the peer group, picked with a
+consistent hash ring over image IDs. A node missing an image in its cache
+downloads it through the owner's API, so that the owner, which caches it
+on the way, is the only node reading the image from the backend store.
+"""
+
+import httplib
+import urlparse
+
+import eventlet
+from oslo.config import cfg
+
+from glance.common import exception
+from glance.common import utils
+from glance.image_cache import sharding
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+peer_opts = [
+    cfg.ListOpt('image_cache_peers', default=[],
+                help=_('The URLs of the API servers, this one included, '
+                       'that fetch uncached images from the image caches '
+                       'of each other before falling back to the store.')),
+    cfg.StrOpt('image_cache_peer_self',
+               help=_('The URL under which this API server is listed in '
+                      'image_cache_peers.')),
+    cfg.IntOpt('image_cache_peer_timeout', default=10,
+               help=_('The number of seconds to wait for a peer API server '
+                      'to start sending an image before reading it from '
+                      'the store instead.')),
+    cfg.IntOpt('image_cache_peer_read_timeout', default=30,
+               help=_('The number of seconds to wait for each chunk of an '
+                      'image a peer API server is sending before reading '
+                      'the rest of the image from the store instead.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(peer_opts)
+
+# Marks requests made by a peer, which must not be passed on to another peer
+PEER_HEADER = 'X-Image-Cache-Peer'
+
+# Request headers passed on to the peer
+FORWARDED_HEADERS = ('X-Auth-Token',)
+
+CHUNKSIZE = 65536
+
+
+def _normalize(url):
+    if '://' not in url:
+        url = 'http://' + url
+    return url.rstrip('/')
+
+
+class PeerGroup(object):
+
+    """
+    The API servers that share their image caches.
+
+    :param peers: URLs of the API servers of the group
+    :param self_url: URL of this API server among `peers`
+    :param timeout: Seconds to wait for a peer's response
+    :param read_timeout: Seconds to wait for each chunk of the image a
+                         peer is sending
+    """
+
+    def __init__(self, peers, self_url, timeout, read_timeout):
+        self.peers = [_normalize(peer) for peer in peers]
+        self.self_url = _normalize(self_url)
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.ring = sharding.HashRing(self.peers)
+
+    @classmethod
+    def from_config(cls):
+        """
+        Returns the configured peer group, or None if peer fetching is
+        not configured.
+        """
+        if not CONF.image_cache_peers:
+            return None
+        if not CONF.image_cache_peer_self:
+            LOG.warn(_("image_cache_peers is set without "
+                       "image_cache_peer_self, not fetching images from "
+                       "peers"))
+            return None
+        return cls(CONF.image_cache_peers, CONF.image_cache_peer_self,
+                   CONF.image_cache_peer_timeout,
+                   CONF.image_cache_peer_read_timeout)
+
+    def get_owner(self, image_id):
+        """
+        Returns the URL of the peer owning an image, or None if this API
+        server owns it.
+        """
+        owner = self.ring.get_node(image_id)
+        if owner == self.self_url:
+            return None
+        return owner
+
+    def fetch(self, peer, request, fallback):
+        """
+        Download the image a request is for from a peer, returning an
+        iterator over the image data and the response headers.
+
+        If the peer fails or stalls while sending the image, the rest of
+        the image is read from the iterable returned by `fallback`,
+        skipping the data that was already yielded.
+
+        :param peer: URL of the peer
+        :param request: The webob Request for the image
+        :param fallback: Callable returning an iterable over the whole image
+        :raises `glance.common.exception.GlanceException` if the peer
+                does not answer with the image
+        """
+        url = urlparse.urlparse(peer)
+        conn_class = {'http': httplib.HTTPConnection,
+                      'https': httplib.HTTPSConnection}[url.scheme]
+        headers = dict((name, request.headers[name])
+                       for name in FORWARDED_HEADERS
+                       if name in request.headers)
+        headers[PEER_HEADER] = self.self_url
+        # NOTE: The socket has no timeout of its own, as the wait for the
+        # peer to answer and each read of the image are bounded separately
+        conn = conn_class(url.netloc)
+        try:
+            with eventlet.Timeout(self.timeout,
+                                  IOError(_("Timed out waiting for an "
+                                            "answer"))):
+                conn.request('GET', url.path + request.path_qs,
+                             headers=headers)
+                resp = conn.getresponse()
+        except (IOError, httplib.HTTPException) as e:
+            conn.close()
+            raise exception.GlanceException(
+                _("Failed to reach peer %(peer)s: %(e)s") %
+                {'peer': peer, 'e': e})
+
+        if resp.status != httplib.OK:
+            conn.close()
+            raise exception.GlanceException(
+                _("Peer %(peer)s answered with status %(status)s") %
+                {'peer': peer, 'status': resp.status})
+
+        headers = dict(resp.getheaders())
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            length = None
+
+        def read():
+            with eventlet.Timeout(self.read_timeout,
+                                  IOError(_("Timed out reading image"))):
+                return resp.read(CHUNKSIZE)
+
+        def image_iter():
+            bytes_read = 0
+            try:
+                chunk = read()
+                while chunk:
+                    bytes_read += len(chunk)
+                    yield chunk
+                    chunk = read()
+                if length is None or bytes_read >= length:
+                    return
+                error = _("Connection closed")
+            except (IOError, httplib.HTTPException) as e:
+                error = e
+            finally:
+                conn.close()
+
+            LOG.info(_("Peer %(peer)s failed after %(bytes_read)d bytes: "
+                       "%(error)s, reading the rest from the store"),
+                     {'peer': peer, 'bytes_read': bytes_read,
+                      'error': error})
+            for chunk in utils.skip_bytes(fallback(), bytes_read):
+                yield chunk
+
+        return image_iter(), headers
@@ -0,0 +1,165 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Picks the images the prefetcher should cache without being asked to.
+
+Images are scored by the requests that missed the cache for them, with
+older misses counting for less, and by whether they are public images
+that were created or updated recently. The best scoring images are queued
+for prefetching as long as they fit in the space left below the pruner's
+high watermark, so that prefetching never makes the pruner evict images.
+"""
+
+import datetime
+import time
+
+from oslo.config import cfg
+
+from glance.common import exception
+import glance.openstack.common.log as logging
+from glance.openstack.common import timeutils
+import glance.registry.client.v1.api as registry
+
+LOG = logging.getLogger(__name__)
+
+planner_opts = [
+    cfg.IntOpt('image_cache_prefetch_budget', default=0,
+               help=_('The maximum number of bytes of images the '
+                      'prefetcher queues by itself on each run, based on '
+                      'cache misses and recently created public images. '
+                      'Set to 0 to only prefetch images queued by hand.')),
+    cfg.IntOpt('image_cache_prefetch_min_misses', default=2,
+               help=_('The number of requests that must have missed the '
+                      'cache for an image before the prefetcher picks it.')),
+    cfg.IntOpt('image_cache_prefetch_new_image_age', default=86400,
+               help=_('The number of seconds after being created or '
+                      'updated during which public images are picked by '
+                      'the prefetcher. Set to 0 to not pick new images.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(planner_opts)
+CONF.import_opt('image_cache_high_watermark', 'glance.image_cache')
+
+# Seconds after which a cache miss counts for half as much
+MISS_HALF_LIFE = 3600
+
+# Score of a new public image, equal to that many recent cache misses
+NEW_IMAGE_SCORE = 10.0
+
+# Number of new public images considered
+NEW_IMAGE_LIMIT = 100
+
+
+class PrefetchPlanner(object):
+
+    """
+    Scores the images that are not cached and queues the best ones.
+
+    :param cache: The `glance.image_cache.ImageCache` to fill
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_budget(self):
+        """
+        Return the number of bytes of images that may be queued, which
+        is bounded by the space left below the pruner's high watermark.
+        """
+        max_size = sum(max_size for driver, max_size
+                       in self.cache.get_cache_shards())
+        high_size = int(max_size * CONF.image_cache_high_watermark)
+        free = high_size - self.cache.get_cache_size()
+        return max(0, min(CONF.image_cache_prefetch_budget, free))
+
+    def get_candidates(self, context):
+        """
+        Return a list of (score, image metadata) tuples for the active
+        images that are neither cached nor queued, best first.
+        """
+        now = time.time()
+        scores = {}
+        metadata = {}
+
+        for image_id, (count, last_miss) in self.cache.get_misses().items():
+            if count < CONF.image_cache_prefetch_min_misses:
+                continue
+            age = max(now - last_miss, 0)
+            scores[image_id] = count * 0.5 ** (age / MISS_HALF_LIFE)
+
+        if CONF.image_cache_prefetch_new_image_age > 0:
+            since = timeutils.utcnow() - datetime.timedelta(
+                seconds=CONF.image_cache_prefetch_new_image_age)
+            filters = {'is_public': True,
+                       'status': 'active',
+                       'changes-since': timeutils.isotime(since)}
+            for image_meta in registry.get_images_detail(
+                    context, filters=filters, sort_key='created_at',
+                    sort_dir='desc', limit=NEW_IMAGE_LIMIT):
+                image_id = image_meta['id']
+                metadata[image_id] = image_meta
+                scores[image_id] = scores.get(image_id, 0) + NEW_IMAGE_SCORE
+
+        candidates = []
+        for image_id, score in scores.items():
+            if (self.cache.is_cached(image_id) or
+                    self.cache.is_queued(image_id)):
+                continue
+            image_meta = metadata.get(image_id)
+            if image_meta is None:
+                try:
+                    image_meta = registry.get_image_metadata(context,
+                                                             image_id)
+                except exception.NotFound:
+                    self.cache.forget_misses(image_id)
+                    continue
+            if image_meta['status'] != 'active' or image_meta['deleted']:
+                self.cache.forget_misses(image_id)
+                continue
+            candidates.append((score, image_meta))
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return candidates
+
+    def plan(self, context):
+        """
+        Queue the best scoring images that fit in the budget, returning
+        their IDs.
+        """
+        budget = self.get_budget()
+        queued = []
+        if not budget:
+            LOG.debug(_("No room left in the image cache to prefetch into"))
+            return queued
+
+        for score, image_meta in self.get_candidates(context):
+            size = image_meta['size'] or 0
+            if size > budget:
+                continue
+            if self.cache.queue_image(image_meta['id'], priority=score,
+                                     planned=True):
+                LOG.debug(_("Queueing image '%(image_id)s' for prefetching, "
+                            "with a score of %(score).2f"),
+                          {'image_id': image_meta['id'], 'score': score})
+                self.cache.forget_misses(image_meta['id'])
+                queued.append(image_meta['id'])
+                budget -= size
+
+        LOG.info(_("Queued %d images for prefetching"), len(queued))
+        return queued
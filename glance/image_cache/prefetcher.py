@@ -19,11 +19,16 @@
 Prefetches images into the Image Cache
 """
 
+import time
+
 import eventlet
+from oslo.config import cfg
 
 from glance.common import exception
 from glance import context
 from glance.image_cache import base
+from glance.image_cache import planner
+from glance.openstack.common import excutils
 import glance.openstack.common.log as logging
 import glance.registry.client.v1.api as registry
 import glance.store
@@ -31,6 +36,49 @@ import glance.store
 
 LOG = logging.getLogger(__name__)
 
+prefetcher_opts = [
+    cfg.IntOpt('image_cache_prefetch_workers', default=4,
+               help=_('The number of images the prefetcher reads from the '
+                      'store at the same time.')),
+    cfg.IntOpt('image_cache_prefetch_rate_limit', default=0,
+               help=_('The number of bytes per second the prefetcher reads '
+                      'from the store at most, over all images. Set to 0 '
+                      'for no limit.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(prefetcher_opts)
+
+
+class RateLimiter(object):
+
+    """
+    Limits the rate at which iterators shared by several green threads
+    are read, by making each chunk wait for its turn.
+
+    :param rate: Bytes per second, or 0 for no limit
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = 0
+
+    def consume(self, num_bytes):
+        """Wait until `num_bytes` more bytes may be read"""
+        if not self.rate:
+            return
+        now = time.time()
+        start = max(self.next_time, now)
+        self.next_time = start + float(num_bytes) / self.rate
+        if start > now:
+            eventlet.sleep(start - now)
+
+    def limit(self, image_iter):
+        """Returns an iterator reading `image_iter` at the limited rate"""
+        for chunk in image_iter:
+            self.consume(len(chunk))
+            yield chunk
+
 
 class Prefetcher(base.CacheApp):
 
@@ -38,6 +86,7 @@ class Prefetcher(base.CacheApp):
         super(Prefetcher, self).__init__()
         registry.configure_registry_client()
         registry.configure_registry_admin_creds()
+        self.rate_limiter = RateLimiter(CONF.image_cache_prefetch_rate_limit)
 
     def fetch_image_into_cache(self, image_id):
         ctx = context.RequestContext(is_admin=True, show_deleted=True)
@@ -53,19 +102,66 @@ class Prefetcher(base.CacheApp):
             LOG.warn(_("No metadata found for image '%s'"), image_id)
             return False
 
+        if not self.cache.admit(image_id, image_meta['size'],
+                                image_meta.get('disk_format'), queued=True):
+            # NOTE: The image would be refused again on every run
+            self.cache.delete_queued_image(image_id)
+            return False
+
         location = image_meta['location']
-        image_data, image_size = glance.store.get_from_backend(ctx, location)
+
+        def fetch():
+            image_data, image_size = glance.store.get_from_backend(ctx,
+                                                                   location)
+            return self.rate_limiter.limit(image_data)
+
+        if self.cache.resume_fill(image_id, image_meta['size'],
+                                  image_meta['checksum'], fetch):
+            LOG.debug(_("Resumed caching image '%s'"), image_id)
+            return True
+
+        if not self.cache.claim_fill(image_id):
+            # NOTE: The request filling the cache with the image takes it
+            # off the queue once it is done
+            LOG.info(_("Image '%s' is already being cached, skipping it"),
+                     image_id)
+            return True
+
         LOG.debug(_("Caching image '%s'"), image_id)
-        cache_tee_iter = self.cache.cache_tee_iter(image_id, image_data,
-                                                   image_meta['checksum'])
+        try:
+            image_iter = fetch()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.cache.release_fill(image_id)
+        caching_iter = self.cache.get_caching_iter(image_id,
+                                                   image_meta['checksum'],
+                                                   image_iter, claimed=True)
         # Image is tee'd into cache and checksum verified
         # as we iterate
-        list(cache_tee_iter)
+        list(caching_iter)
         return True
 
+    def _fetch_image(self, image_id):
+        # NOTE: A failed image stays queued, and the blocks it got into
+        # the cache are kept for the next run to resume from, so it must
+        # not stop the other images from being fetched.
+        try:
+            return self.fetch_image_into_cache(image_id)
+        except Exception as e:
+            LOG.error(_("Failed to prefetch image '%(image_id)s': %(e)s"),
+                      {'image_id': image_id, 'e': e})
+            return False
+
     def run(self):
 
-        images = self.cache.get_queued_images()
+        if CONF.image_cache_prefetch_budget:
+            ctx = context.RequestContext(is_admin=True, show_deleted=True)
+            try:
+                planner.PrefetchPlanner(self.cache).plan(ctx)
+            except exception.GlanceException as e:
+                LOG.error(_("Failed to pick images to prefetch: %s"), e)
+
+        images = self.cache.get_prefetch_queue()
         if not images:
             LOG.debug(_("Nothing to prefetch."))
             return True
@@ -73,8 +169,10 @@ class Prefetcher(base.CacheApp):
         num_images = len(images)
         LOG.debug(_("Found %d images to prefetch"), num_images)
 
-        pool = eventlet.GreenPool(num_images)
-        results = pool.imap(self.fetch_image_into_cache, images)
+        # NOTE: imap() starts the images in queue order as workers free up,
+        # so images of higher priority are fetched first.
+        pool = eventlet.GreenPool(max(CONF.image_cache_prefetch_workers, 1))
+        results = pool.imap(self._fetch_image, images)
         successes = sum([1 for r in results if r is True])
         if successes != num_images:
             LOG.error(_("Failed to successfully cache all "
@@ -0,0 +1,215 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Spreads the image cache over several directories, typically one per disk.
+
+Every directory is managed by its own instance of the configured cache
+driver. Images are placed on a directory by consistent hashing, so adding
+or removing a directory only moves the images that hash to it.
+"""
+
+import bisect
+import errno
+import hashlib
+import heapq
+import os
+
+from glance.common import exception
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_cache_dirs(cache_dirs, default_max_size):
+    """
+    Parse the entries of the image_cache_dirs option, each a directory
+    optionally followed by a colon and the maximum size in bytes of the
+    cache in that directory, into a list of (directory, max size) tuples.
+    """
+    parsed = []
+    for entry in cache_dirs:
+        path, sep, max_size = entry.rpartition(':')
+        if not sep:
+            parsed.append((entry, default_max_size))
+            continue
+        try:
+            parsed.append((path, int(max_size)))
+        except ValueError:
+            msg = _("Invalid size in image_cache_dirs entry "
+                    "'%s'") % entry
+            raise exception.BadDriverConfiguration(driver_name='sharded',
+                                                   reason=msg)
+    return parsed
+
+
+class HashRing(object):
+
+    """
+    A consistent hash ring mapping image IDs onto a list of nodes, each
+    of which is placed on the ring several times to even out the load.
+    """
+
+    REPLICAS = 128
+
+    def __init__(self, nodes):
+        self.ring = []
+        for node in nodes:
+            for replica in xrange(self.REPLICAS):
+                key = self._hash('%s-%d' % (node, replica))
+                self.ring.append((key, node))
+        self.ring.sort()
+        self.keys = [key for key, node in self.ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def get_node(self, image_id):
+        index = bisect.bisect(self.keys, self._hash(str(image_id)))
+        return self.ring[index % len(self.ring)][1]
+
+
+class ShardedDriver(object):
+
+    """
+    A cache driver spreading the image cache over several directories,
+    each managed by its own instance of a cache driver class.
+
+    Requests about one image go to the driver of the directory the image
+    hashes to. Stats are summed over all directories, and pruning is done
+    directory by directory against each directory's own size limit.
+
+    :param driver_class: Cache driver class used for every directory
+    :param cache_dirs: List of (directory, max size) tuples
+    """
+
+    def __init__(self, driver_class, cache_dirs):
+        self.drivers = []
+        self.max_sizes = {}
+        for base_dir, max_size in cache_dirs:
+            driver = driver_class(base_dir=base_dir)
+            self.drivers.append(driver)
+            self.max_sizes[driver] = max_size
+        self.by_dir = dict((driver.base_dir, driver)
+                           for driver in self.drivers)
+        self.ring = HashRing(sorted(self.by_dir))
+
+    def configure(self):
+        for driver in self.drivers:
+            driver.configure()
+
+    def driver_for(self, image_id):
+        """Return the driver of the directory the image is placed on"""
+        return self.by_dir[self.ring.get_node(image_id)]
+
+    def get_cache_size(self):
+        return sum(driver.get_cache_size() for driver in self.drivers)
+
+    def get_hit_count(self, image_id):
+        return self.driver_for(image_id).get_hit_count(image_id)
+
+    def get_cached_images(self):
+        entries = []
+        for driver in self.drivers:
+            entries.extend(driver.get_cached_images())
+        entries.sort(key=lambda entry: entry['image_id'])
+        return entries
+
+    def is_cached(self, image_id):
+        return self.driver_for(image_id).is_cached(image_id)
+
+    def is_cacheable(self, image_id):
+        return self.driver_for(image_id).is_cacheable(image_id)
+
+    def is_being_cached(self, image_id):
+        return self.driver_for(image_id).is_being_cached(image_id)
+
+    def is_queued(self, image_id):
+        return self.driver_for(image_id).is_queued(image_id)
+
+    def delete_all_cached_images(self):
+        return sum(driver.delete_all_cached_images()
+                   for driver in self.drivers)
+
+    def delete_cached_image(self, image_id):
+        # NOTE: Copies cached before a directory was added or removed may
+        # be left in a directory the image no longer hashes to.
+        for driver in self.drivers:
+            if driver.is_cached(image_id):
+                driver.delete_cached_image(image_id)
+
+    def delete_all_queued_images(self):
+        return sum(driver.delete_all_queued_images()
+                   for driver in self.drivers)
+
+    def delete_queued_image(self, image_id):
+        self.driver_for(image_id).delete_queued_image(image_id)
+
+    def queue_image(self, image_id):
+        return self.driver_for(image_id).queue_image(image_id)
+
+    def get_queued_images(self):
+        queues = []
+        for driver in self.drivers:
+            queue = []
+            for image_id in driver.get_queued_images():
+                path = driver.get_image_filepath(image_id, 'queue')
+                try:
+                    queue.append((os.path.getmtime(path), image_id))
+                except OSError as e:
+                    # NOTE: Another process may have taken the image off
+                    # the queue since the driver listed it
+                    if e.errno != errno.ENOENT:
+                        raise
+            queues.append(queue)
+        return [image_id for mtime, image_id in heapq.merge(*queues)]
+
+    def clean(self, stall_time=None):
+        for driver in self.drivers:
+            driver.clean(stall_time)
+
+    def get_least_recently_accessed(self):
+        oldest = None
+        for driver in self.drivers:
+            entries = driver.get_cached_images()
+            for entry in entries:
+                accessed = entry['last_accessed'] or entry['last_modified']
+                if oldest is None or accessed < oldest[0]:
+                    oldest = (accessed, entry['image_id'], entry['size'])
+        if oldest is None:
+            return None
+        return oldest[1], oldest[2]
+
+    def open_for_write(self, image_id):
+        return self.driver_for(image_id).open_for_write(image_id)
+
+    def open_for_read(self, image_id):
+        return self.driver_for(image_id).open_for_read(image_id)
+
+    def claim_for_write(self, image_id):
+        return self.driver_for(image_id).claim_for_write(image_id)
+
+    def abandon_write(self, image_id):
+        self.driver_for(image_id).abandon_write(image_id)
+
+    def get_image_filepath(self, image_id, cache_status='active'):
+        return self.driver_for(image_id).get_image_filepath(image_id,
+                                                            cache_status)
+
+    def get_image_size(self, image_id):
+        return self.driver_for(image_id).get_image_size(image_id)
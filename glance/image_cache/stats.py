@@ -0,0 +1,139 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Counters of what the image cache does, shared by all the processes using
+the cache: the API workers, the pruner and the prefetcher.
+
+Every process adds up its counts in memory and adds them to the counters
+file under the cache directory every few seconds, holding a lock on the
+file so that no process loses the counts of another.
+"""
+
+import atexit
+from contextlib import contextmanager
+import fcntl
+import os
+import time
+
+from glance.openstack.common import jsonutils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Counters shown even before they are first incremented
+COUNTERS = ('hits', 'memory_hits', 'misses', 'bytes_from_cache',
+            'bytes_from_backend', 'bytes_from_peers', 'fills_completed',
+            'fills_aborted', 'fill_bytes', 'fill_seconds', 'not_admitted',
+            'evictions_pruned', 'evictions_deleted', 'evictions_stale',
+            'pruned_bytes')
+
+_STATS = {}
+
+
+class CacheStats(object):
+
+    """
+    The counters of an image cache, with the counts of this process that
+    are not written to the counters file yet.
+
+    :param stats_dir: Directory holding the counters file
+    :param flush_interval: Seconds between writes of the counters file
+    """
+
+    def __init__(self, stats_dir, flush_interval):
+        self.path = os.path.join(stats_dir, 'counters.json')
+        self.lock_path = os.path.join(stats_dir, 'counters.lock')
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def incr(self, name, amount=1):
+        """Add `amount` to a counter"""
+        self.pending[name] = self.pending.get(name, 0) + amount
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as counters_file:
+                return jsonutils.load(counters_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, counters):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as counters_file:
+            counters_file.write(jsonutils.dumps(counters))
+        os.rename(tmp_path, self.path)
+
+    def flush(self):
+        """Add the counts of this process to the counters file"""
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            with self._locked():
+                counters = self._read()
+                for name, amount in pending.items():
+                    counters[name] = counters.get(name, 0) + amount
+                self._write(counters)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Failed to write the image cache counters to "
+                       "%(path)s: %(e)s"), {'path': self.path, 'e': e})
+
+    def get_counters(self):
+        """Return a dict of the counters, including this process' counts"""
+        self.flush()
+        counters = dict.fromkeys(COUNTERS, 0)
+        counters.update(self._read())
+        return counters
+
+    def reset(self):
+        """Set all counters back to zero"""
+        self.pending = {}
+        with self._locked():
+            self._write({})
+
+
+def get_stats(stats_dir, flush_interval):
+    """
+    Return the `CacheStats` of this process for the supplied directory.
+    """
+    key = (os.getpid(), stats_dir)
+    if key not in _STATS:
+        _STATS[key] = CacheStats(stats_dir, flush_interval)
+    return _STATS[key]
+
+
+@atexit.register
+def flush_all_stats():
+    """Write the counts of this process to every counters file it uses"""
+    pid = os.getpid()
+    for (stats_pid, stats_dir), stats in _STATS.items():
+        if stats_pid == pid:
+            stats.flush()
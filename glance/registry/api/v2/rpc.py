@@ -53,6 +53,6 @@ class Controller(rpc.Controller):
 
 def create_resource():
     """Images resource factory method."""
-    deserializer = rpc.RPCJSONDeserializer()
-    serializer = rpc.RPCJSONSerializer()
+    deserializer = rpc.RPCRequestDeserializer()
+    serializer = rpc.RPCResponseSerializer()
     return wsgi.Resource(Controller(), deserializer, serializer)
@@ -26,6 +26,7 @@ from oslo.config import cfg
 
 from glance.common import exception
 import glance.openstack.common.log as logging
+from glance.registry.client.v1 import cache
 from glance.registry.client.v1 import client
 
 LOG = logging.getLogger(__name__)
@@ -43,8 +44,22 @@ registry_client_ctx_opts = [
                        "auth_token middleware.")),
 ]
 
+registry_client_cache_opts = [
+    cfg.IntOpt('registry_client_metadata_cache_ttl', default=0,
+               help=_("The number of seconds during which the image "
+                      "metadata returned by the registry is served again "
+                      "without asking the registry. Changes made through "
+                      "this API server are seen at once, changes made "
+                      "through other servers once the metadata expires. "
+                      "Set to 0 to disable the cache.")),
+    cfg.IntOpt('registry_client_metadata_cache_size', default=1000,
+               help=_("The maximum number of image metadata entries held "
+                      "in the registry client's cache.")),
+]
+
 CONF = cfg.CONF
 CONF.register_opts(registry_client_ctx_opts)
+CONF.register_opts(registry_client_cache_opts)
 _registry_client = 'glance.registry.client'
 CONF.import_opt('registry_client_protocol', _registry_client)
 CONF.import_opt('registry_client_key_file', _registry_client)
@@ -67,6 +82,8 @@ _CLIENT_PORT = None
 _CLIENT_KWARGS = {}
 # AES key used to encrypt 'location' metadata
 _METADATA_ENCRYPTION_KEY = None
+# Cache of image metadata, or None when disabled
+_METADATA_CACHE = None
 
 
 def configure_registry_client():
@@ -74,6 +91,7 @@ def configure_registry_client():
     Sets up a registry client for use in registry lookups
     """
     global _CLIENT_KWARGS, _CLIENT_HOST, _CLIENT_PORT, _METADATA_ENCRYPTION_KEY
+    global _METADATA_CACHE
     try:
         host, port = CONF.registry_host, CONF.registry_port
     except cfg.ConfigFileValueError:
@@ -97,6 +115,12 @@ def configure_registry_client():
         'timeout': CONF.registry_client_timeout,
     }
 
+    _METADATA_CACHE = None
+    if CONF.registry_client_metadata_cache_ttl > 0:
+        _METADATA_CACHE = cache.MetadataCache(
+            CONF.registry_client_metadata_cache_ttl,
+            CONF.registry_client_metadata_cache_size)
+
     if not CONF.use_user_token:
         configure_registry_admin_creds()
 
@@ -152,9 +176,30 @@ def get_images_detail(context, **kwargs):
     return c.get_images_detailed(**kwargs)
 
 
+def _get_cache_key(context, image_id):
+    # NOTE: the registry decides which images a request may see, and
+    # whether deleted ones are shown, from these attributes of the context
+    return (image_id, context.owner, context.is_admin, context.show_deleted)
+
+
+def _invalidate_image(image_id):
+    if _METADATA_CACHE is not None:
+        _METADATA_CACHE.invalidate(image_id)
+
+
 def get_image_metadata(context, image_id):
+    if _METADATA_CACHE is not None:
+        key = _get_cache_key(context, image_id)
+        image_meta = _METADATA_CACHE.get(key)
+        if image_meta is not None:
+            return image_meta
+
     c = get_registry_client(context)
-    return c.get_image(image_id)
+    image_meta = c.get_image(image_id)
+
+    if _METADATA_CACHE is not None:
+        _METADATA_CACHE.set(key, image_meta)
+    return image_meta
 
 
 def add_image_metadata(context, image_meta):
@@ -167,13 +212,19 @@ def update_image_metadata(context, image_id, image_meta,
                           purge_props=False):
     LOG.debug(_("Updating image metadata for image %s..."), image_id)
     c = get_registry_client(context)
-    return c.update_image(image_id, image_meta, purge_props)
+    try:
+        return c.update_image(image_id, image_meta, purge_props)
+    finally:
+        _invalidate_image(image_id)
 
 
 def delete_image_metadata(context, image_id):
     LOG.debug(_("Deleting image metadata for image %s..."), image_id)
     c = get_registry_client(context)
-    return c.delete_image(image_id)
+    try:
+        return c.delete_image(image_id)
+    finally:
+        _invalidate_image(image_id)
 
 
 def get_image_members(context, image_id):
@@ -188,14 +239,23 @@ def get_member_images(context, member_id):
 
 def replace_members(context, image_id, member_data):
     c = get_registry_client(context)
-    return c.replace_members(image_id, member_data)
+    try:
+        return c.replace_members(image_id, member_data)
+    finally:
+        _invalidate_image(image_id)
 
 
 def add_member(context, image_id, member_id, can_share=None):
     c = get_registry_client(context)
-    return c.add_member(image_id, member_id, can_share=can_share)
+    try:
+        return c.add_member(image_id, member_id, can_share=can_share)
+    finally:
+        _invalidate_image(image_id)
 
 
 def delete_member(context, image_id, member_id):
     c = get_registry_client(context)
-    return c.delete_member(image_id, member_id)
+    try:
+        return c.delete_member(image_id, member_id)
+    finally:
+        _invalidate_image(image_id)
@@ -0,0 +1,97 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process cache of the image metadata returned by the registry, so that
+API requests for images that did not change skip the registry round trip.
+"""
+
+import copy
+import time
+
+from glance.common.ordereddict import OrderedDict
+
+
+class MetadataCache(object):
+
+    """
+    A least recently used cache of image metadata whose entries expire.
+
+    Entries are keyed by tuples starting with the image ID, followed by
+    whatever decides which metadata the registry returns for a request.
+    All the entries of an image are dropped together when it changes.
+
+    :param ttl: Seconds during which an entry is served
+    :param max_entries: Number of entries above which the least recently
+                        used ones are dropped
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.keys_by_image = {}
+
+    def get(self, key):
+        """Return a copy of the cached metadata for a key, or None"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, image_meta = entry
+        if expires < time.time():
+            self._unindex(key)
+            return None
+        self.entries[key] = entry
+        return copy.deepcopy(image_meta)
+
+    def set(self, key, image_meta):
+        """Cache a copy of the metadata the registry returned for a key"""
+        image_id = key[0]
+        # NOTE: the entries cached for other contexts before the image
+        # was last updated are stale
+        for other_key in list(self.keys_by_image.get(image_id, ())):
+            if other_key == key:
+                continue
+            other_meta = self.entries[other_key][1]
+            if other_meta.get('updated_at') != image_meta.get('updated_at'):
+                self.entries.pop(other_key)
+                self._unindex(other_key)
+
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl,
+                             copy.deepcopy(image_meta))
+        self.keys_by_image.setdefault(image_id, set()).add(key)
+
+        while len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self._unindex(old_key)
+
+    def invalidate(self, image_id):
+        """Drop all the entries of an image"""
+        for key in self.keys_by_image.pop(image_id, ()):
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.keys_by_image.clear()
+
+    def _unindex(self, key):
+        keys = self.keys_by_image.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_image[key[0]]
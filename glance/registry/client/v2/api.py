@@ -29,7 +29,18 @@ from glance.registry.client.v2 import client
 
 LOG = logging.getLogger(__name__)
 
+registry_client_rpc_opts = [
+    cfg.BoolOpt('registry_client_rpc_msgpack', default=False,
+                help=_("Whether to send commands to the v2 registry and "
+                       "receive their results packed with msgpack instead "
+                       "of JSON. Requires the msgpack library on the API "
+                       "server. Registries that can not unpack msgpack, "
+                       "because they lack the library or predate msgpack "
+                       "support, are sent JSON instead.")),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(registry_client_rpc_opts)
 _registry_client = 'glance.registry.client'
 CONF.import_opt('registry_client_protocol', _registry_client)
 CONF.import_opt('registry_client_key_file', _registry_client)
@@ -76,6 +87,7 @@ def configure_registry_client():
         'ca_file': CONF.registry_client_ca_file,
         'insecure': CONF.registry_client_insecure,
         'timeout': CONF.registry_client_timeout,
+        'use_msgpack': CONF.registry_client_rpc_msgpack,
     }
 
     if not CONF.use_user_token:
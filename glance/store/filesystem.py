@@ -83,21 +83,37 @@ class ChunkedFile(object):
     """
     We send this back to the Glance API server as
     something that can iterate over a large file
+
+    The file handle, ``offset`` and ``length`` are exposed as well so
+    that the API server can hand the open file straight to sendfile(2)
+    instead of iterating over it.
     """
 
     CHUNKSIZE = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, length=None):
         self.filepath = filepath
         self.fp = open(self.filepath, 'rb')
+        self.offset = offset
+        if length is None:
+            length = os.fstat(self.fp.fileno()).st_size - offset
+        self.length = length
+
+    def fileno(self):
+        """Return the file descriptor of the underlying image file"""
+        return self.fp.fileno()
 
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
             if self.fp:
-                while True:
-                    chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+                self.fp.seek(self.offset)
+                remaining = self.length
+                while remaining > 0:
+                    chunk = self.fp.read(min(ChunkedFile.CHUNKSIZE,
+                                             remaining))
                     if chunk:
+                        remaining -= len(chunk)
                         yield chunk
                     else:
                         break
@@ -251,6 +251,18 @@ class DriverTests(object):
         image = self.db_api.image_get(self.context, UUID1)
         self.assertEquals(image['id'], self.fixtures[0]['id'])
 
+    def test_image_get_with_tags(self):
+        self.db_api.image_tag_create(self.context, UUID1, 'snap')
+        image, tags = self.db_api.image_get_with_tags(self.context, UUID1)
+        self.assertEquals(image['id'], self.fixtures[0]['id'])
+        self.assertEqual(['snap'], tags)
+
+    def test_image_get_with_tags_not_found(self):
+        bad_image_id = uuidutils.generate_uuid()
+        self.assertRaises(exception.NotFound,
+                          self.db_api.image_get_with_tags,
+                          self.context, bad_image_id)
+
     def test_image_get_disallow_deleted(self):
         self.db_api.image_destroy(self.adm_context, UUID1)
         self.assertRaises(exception.NotFound, self.db_api.image_get,
@@ -655,6 +667,16 @@ class DriverTests(object):
                                            })
         self.assertEquals(len(images), 0)
 
+    def test_image_get_all_with_filter_tags_and_property(self):
+        self.db_api.image_tag_create(self.context, UUID1, 'x86')
+        self.db_api.image_tag_create(self.context, UUID1, '64bit')
+        self.db_api.image_tag_create(self.context, UUID2, '64bit')
+        images = self.db_api.image_get_all(self.context, limit=2,
+                                           filters={'tags': ['x86', '64bit'],
+                                                    'foo': 'bar'})
+        self.assertEquals([UUID1], [image['id'] for image in images])
+        self.assertEquals(1, len(images[0]['properties']))
+
     def test_image_get_all_with_filter_undefined_tags(self):
         images = self.db_api.image_get_all(self.context,
                                            filters={'tags': ['fake']})
@@ -679,6 +701,27 @@ class DriverTests(object):
         page = self.db_api.image_get_all(self.context, limit=2, marker=UUID2)
         self.assertEquals([UUID1], [i['id'] for i in page])
 
+    def test_image_paginate_created_at_ties(self):
+        """Paginate through images created at the same time"""
+        created_at = timeutils.utcnow() + datetime.timedelta(days=1)
+        extra_uuids = sorted(uuidutils.generate_uuid() for i in range(4))
+        extra_images = [build_image_fixture(id=_id, created_at=created_at)
+                        for _id in extra_uuids]
+        self.create_images(extra_images)
+
+        # UUID3 is the newest fixture created before the extra images
+        for sort_dir, marker, expected in (
+                ('asc', UUID3, extra_uuids),
+                ('desc', None, list(reversed(extra_uuids)))):
+            seen = []
+            for i in range(len(expected)):
+                page = self.db_api.image_get_all(self.context, limit=1,
+                                                 marker=marker,
+                                                 sort_dir=sort_dir)
+                marker = page[0]['id']
+                seen.append(marker)
+            self.assertEquals(expected, seen)
+
     def test_image_get_all_invalid_sort_key(self):
         self.assertRaises(exception.InvalidSortKey, self.db_api.image_get_all,
                           self.context, sort_key='blah')
@@ -833,6 +876,32 @@ class DriverTests(object):
         images = self.db_api.image_get_all(ctxt2, member_status='all')
         self.assertEquals(4, len(images))
 
+    def test_image_get_all_public_shared_image(self):
+        """A public image shared with a tenant is listed once"""
+        TENANT1 = uuidutils.generate_uuid()
+        TENANT2 = uuidutils.generate_uuid()
+        ctxt1 = context.RequestContext(is_admin=False, tenant=TENANT1,
+                                       auth_tok='user:%s:user' % TENANT1)
+        ctxt2 = context.RequestContext(is_admin=False, tenant=TENANT2,
+                                       auth_tok='user:%s:user' % TENANT2)
+        UUIDX = uuidutils.generate_uuid()
+        self.db_api.image_create(ctxt1, {'id': UUIDX,
+                                         'status': 'queued',
+                                         'is_public': True,
+                                         'owner': TENANT1})
+        values = {'image_id': UUIDX, 'member': TENANT2, 'can_share': False,
+                  'status': 'accepted'}
+        self.db_api.image_member_create(ctxt1, values)
+
+        images = self.db_api.image_get_all(ctxt2)
+        image_ids = [image['id'] for image in images]
+        self.assertEquals(1, image_ids.count(UUIDX))
+        self.assertEquals(4, len(images))
+
+        images = self.db_api.image_get_all(ctxt2,
+                                           filters={'visibility': 'shared'})
+        self.assertEquals([UUIDX], [image['id'] for image in images])
+
     def test_is_image_visible(self):
         TENANT1 = uuidutils.generate_uuid()
         TENANT2 = uuidutils.generate_uuid()
@@ -891,6 +960,18 @@ class DriverTests(object):
         expected = ['snarf']
         self.assertEqual(expected, tags)
 
+    def test_image_tag_get_all_for_images(self):
+        self.db_api.image_tag_create(self.context, UUID1, 'snap')
+        self.db_api.image_tag_create(self.context, UUID1, 'snarf')
+        self.db_api.image_tag_create(self.context, UUID2, 'snarf')
+        self.db_api.image_tag_delete(self.context, UUID2, 'snarf')
+        bad_image_id = uuidutils.generate_uuid()
+
+        tags = self.db_api.image_tag_get_all_for_images(
+            self.context, [UUID1, UUID2, bad_image_id])
+        expected = {UUID1: ['snap', 'snarf'], UUID2: [], bad_image_id: []}
+        self.assertEqual(expected, tags)
+
     def test_image_tag_get_all_no_tags(self):
         actual = self.db_api.image_tag_get_all(self.context, UUID1)
         self.assertEqual([], actual)
@@ -1163,6 +1244,23 @@ class DriverQuotaTests(test_utils.BaseTestCase):
         x = self.db_api.user_get_storage_usage(self.context1, self.owner_id1)
         self.assertEqual(total, x)
 
+    def test_storage_quota_replaced_locations(self):
+        locations = [{'url': 'file:///some/path/file', 'metadata': {}}]
+        self.db_api.image_update(self.context1, UUID1,
+                                 {'locations': locations})
+        self.db_api.image_update(self.context1, UUID1,
+                                 {'locations': locations})
+
+        total = reduce(lambda x, y: x + y,
+                       [f['size'] for f in self.owner1_fixtures])
+        x = self.db_api.user_get_storage_usage(self.context1, self.owner_id1)
+        self.assertEqual(total, x)
+
+    def test_storage_quota_no_images(self):
+        x = self.db_api.user_get_storage_usage(self.context1,
+                                               uuidutils.generate_uuid())
+        self.assertEqual(0, x)
+
 
 class TestVisibility(test_utils.BaseTestCase):
     def setUp(self):
@@ -131,6 +131,55 @@ class TestSizeCheckedIter(testtools.TestCase):
         self.assertRaises(exception.GlanceException, checked_image.next)
 
 
+class FakeFileSource(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.length = len(data)
+
+    def fileno(self):
+        return 0
+
+    def __iter__(self):
+        return iter([self.data])
+
+
+class TestImageBody(test_utils.BaseTestCase):
+    def _get_webob_response(self):
+        request = webob.Request.blank('/')
+        request.environ['eventlet.posthooks'] = []
+        response = webob.Response()
+        response.request = request
+        return response
+
+    def test_image_body_iterator(self):
+        resp = self._get_webob_response()
+        meta = {'id': 'e31cb99c-fe89-49fb-9cc5-f5104fffa636'}
+        body = glance.api.common.image_body(resp, meta, 4, ['AB', 'CD'],
+                                            None)
+        self.assertFalse(isinstance(body, wsgi.SendFileBody))
+        self.assertEqual('ABCD', ''.join(body))
+
+    def test_image_body_file_source(self):
+        self.stubs.Set(wsgi, 'SENDFILE_SUPPORTED', True)
+        resp = self._get_webob_response()
+        meta = {'id': 'e31cb99c-fe89-49fb-9cc5-f5104fffa636'}
+        body = glance.api.common.image_body(resp, meta, 4,
+                                            FakeFileSource('ABCD'), None)
+        self.assertTrue(isinstance(body, wsgi.SendFileBody))
+        self.assertEqual(1, len(resp.request.environ['eventlet.posthooks']))
+        # Not attached to a server socket, so the data is iterated
+        self.assertEqual('ABCD', ''.join(body))
+
+    def test_image_body_sendfile_disabled(self):
+        self.config(use_sendfile=False)
+        resp = self._get_webob_response()
+        meta = {'id': 'e31cb99c-fe89-49fb-9cc5-f5104fffa636'}
+        body = glance.api.common.image_body(resp, meta, 4,
+                                            FakeFileSource('ABCD'), None)
+        self.assertFalse(isinstance(body, wsgi.SendFileBody))
+
+
 class TestMalformedRequest(test_utils.BaseTestCase):
     def setUp(self):
         """Establish a clean test environment"""
@@ -14,13 +14,18 @@
 #    under the License.
 
 import httplib
+import socket
 import StringIO
+import time
 
+from eventlet import patcher
 import mox
+import stubout
 import testtools
 
 from glance.common import auth
 from glance.common import client
+from glance.common import exception
 from glance.tests import utils
 
 
@@ -90,3 +95,211 @@ class TestClient(testtools.TestCase):
         resp = self.client.do_request('GET', '/v1/images/detail',
                                       params=params)
         self.assertEqual(resp, fake)
+
+
+class FakeSocket(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO.StringIO(self.data)
+
+
+class FakeConnection(object):
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(testtools.TestCase):
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = client.ConnectionPool(idle_timeout=30, max_idle=2)
+        self.key = ('example.com', 9191)
+        self.socketpairs = []
+
+    def _get_socketpair(self):
+        # NOTE: the pool polls connections with the unpatched select, so
+        # the sockets are unpatched too. Both ends are kept until the test
+        # ends, so that no peer is closed when it is garbage collected.
+        sock, peer = patcher.original('socket').socketpair()
+        self.socketpairs.append((sock, peer))
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        return sock, peer
+
+    def _get_response(self, data):
+        response = httplib.HTTPResponse(FakeSocket(data))
+        response.begin()
+        return response
+
+    def test_get_put(self):
+        self.assertEqual(None, self.pool.get(self.key))
+        connection = FakeConnection(self._get_socketpair()[0])
+        self.pool.put(self.key, connection)
+        self.assertEqual(connection, self.pool.get(self.key))
+        self.assertEqual(None, self.pool.get(self.key))
+
+    def test_get_closed_by_server(self):
+        sock, peer = self._get_socketpair()
+        connection = FakeConnection(sock)
+        self.pool.put(self.key, connection)
+        peer.close()
+        self.assertEqual(None, self.pool.get(self.key))
+        self.assertTrue(connection.closed)
+
+    def test_get_expired(self):
+        connection = FakeConnection(self._get_socketpair()[0])
+        self.pool.put(self.key, connection)
+        now = time.time()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(time, 'time', lambda: now + 31)
+        self.assertEqual(None, self.pool.get(self.key))
+        self.assertTrue(connection.closed)
+
+    def test_put_max_idle(self):
+        connections = [FakeConnection(self._get_socketpair()[0])
+                       for i in range(3)]
+        for connection in connections:
+            self.pool.put(self.key, connection)
+        self.assertTrue(connections[2].closed)
+        self.assertEqual(connections[1], self.pool.get(self.key))
+        self.assertEqual(connections[0], self.pool.get(self.key))
+
+    def test_release_on_close(self):
+        connection = FakeConnection(self._get_socketpair()[0])
+        response = self._get_response('HTTP/1.1 200 OK\r\n'
+                                      'Content-Length: 2\r\n\r\nOk')
+        self.pool.release_on_close(self.key, connection, response)
+        self.assertEqual('Ok', response.read())
+        self.assertEqual(connection, self.pool.get(self.key))
+
+    def test_release_on_close_unread(self):
+        connection = FakeConnection(self._get_socketpair()[0])
+        response = self._get_response('HTTP/1.1 200 OK\r\n'
+                                      'Content-Length: 2\r\n\r\nOk')
+        self.pool.release_on_close(self.key, connection, response)
+        response.close()
+        self.assertEqual(None, self.pool.get(self.key))
+
+    def test_release_on_close_connection_closing(self):
+        connection = FakeConnection(self._get_socketpair()[0])
+        response = self._get_response('HTTP/1.1 200 OK\r\n'
+                                      'Connection: close\r\n'
+                                      'Content-Length: 2\r\n\r\nOk')
+        self.pool.release_on_close(self.key, connection, response)
+        response.read()
+        self.assertEqual(None, self.pool.get(self.key))
+
+
+class TestResend(testtools.TestCase):
+
+    def setUp(self):
+        super(TestResend, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.client = client.BaseClient('example.com', port=9191)
+        self.sent = []
+        test = self
+
+        class BrokenConnection(FakeConnection):
+
+            def __init__(self, *args, **kwargs):
+                super(BrokenConnection, self).__init__()
+
+            def request(self, method, path, body, headers):
+                test.sent.append(method)
+                raise socket.error('connection reset by peer')
+
+        self.stubs.Set(self.client, 'get_connection_type',
+                       lambda: BrokenConnection)
+        self.stubs.Set(client._POOL, 'get',
+                       lambda key: BrokenConnection())
+
+    def test_idempotent_request_resent(self):
+        self.assertRaises(exception.ClientConnectionError,
+                          self.client.do_request,
+                          'GET', '/v1/images/detail')
+        self.assertEqual(['GET', 'GET'], self.sent)
+
+    def test_post_not_resent(self):
+        self.assertRaises(exception.ClientConnectionError,
+                          self.client.do_request,
+                          'POST', '/v1/images', body='data')
+        self.assertEqual(['POST'], self.sent)
+
+    def _stub_new_connection(self):
+        test = self
+
+        class Connection(FakeConnection):
+
+            def __init__(self, *args, **kwargs):
+                super(Connection, self).__init__()
+
+            def request(self, method, path, body, headers):
+                test.sent.append(method)
+
+            def getresponse(self):
+                return utils.FakeHTTPResponse(data='Ok')
+
+        self.stubs.Set(self.client, 'get_connection_type',
+                       lambda: Connection)
+
+    def test_post_resent_on_connection_closed_by_server(self):
+        sock, peer = patcher.original('socket').socketpair()
+        self.addCleanup(sock.close)
+        peer.close()
+        stale = httplib.HTTPConnection('example.com', 9191)
+        stale.sock = sock
+        self.stubs.Set(client._POOL, 'get', lambda key: stale)
+        self._stub_new_connection()
+
+        res = self.client.do_request('POST', '/v1/images', body='data')
+        self.assertEqual('Ok', res.read())
+        self.assertEqual(['POST'], self.sent)
+
+    def test_post_resent_on_empty_response(self):
+        test = self
+
+        class EmptyResponseConnection(FakeConnection):
+
+            def request(self, method, path, body, headers):
+                test.sent.append(method)
+
+            def getresponse(self):
+                raise httplib.BadStatusLine('')
+
+        self.stubs.Set(client._POOL, 'get',
+                       lambda key: EmptyResponseConnection())
+        self._stub_new_connection()
+
+        res = self.client.do_request('POST', '/v1/images', body='data')
+        self.assertEqual('Ok', res.read())
+        self.assertEqual(['POST', 'POST'], self.sent)
+
+    def test_post_not_resent_on_bad_response(self):
+        test = self
+
+        class BadResponseConnection(FakeConnection):
+
+            def request(self, method, path, body, headers):
+                test.sent.append(method)
+
+            def getresponse(self):
+                raise httplib.BadStatusLine('garbage')
+
+        self.stubs.Set(client._POOL, 'get',
+                       lambda key: BadResponseConnection())
+        self.stubs.Set(self.client, 'get_connection_type',
+                       lambda: BadResponseConnection)
+
+        self.assertRaises(httplib.BadStatusLine, self.client.do_request,
+                          'POST', '/v1/images', body='data')
+        self.assertEqual(['POST'], self.sent)
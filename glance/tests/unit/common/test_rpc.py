@@ -18,6 +18,7 @@
 import json
 import datetime
 
+import eventlet
 import mox
 from oslo.config import cfg
 import routes
@@ -55,12 +56,17 @@ class FakeResource(object):
             pass
         raise WeirdError("Weirdness")
 
+    def sleep(self, context, seconds):
+        eventlet.sleep(seconds)
+        self.slept.append(seconds)
+        return seconds
 
-def create_api():
-    deserializer = rpc.RPCJSONDeserializer()
-    serializer = rpc.RPCJSONSerializer()
+
+def create_api(resource=None):
+    deserializer = rpc.RPCRequestDeserializer()
+    serializer = rpc.RPCResponseSerializer()
     controller = rpc.Controller()
-    controller.register(FakeResource())
+    controller.register(resource or FakeResource())
     res = wsgi.Resource(controller, deserializer, serializer)
 
     mapper = routes.Mapper()
@@ -134,6 +140,35 @@ class TestRPCController(base.IsolatedUnitTest):
         self.assertTrue(isinstance(returned, list))
         self.assertEquals(returned[0], 1)
 
+    def _sleep_request(self, parallel):
+        resource = FakeResource()
+        resource.slept = []
+        api = create_api(resource)
+        req = webob.Request.blank('/rpc')
+        req.method = 'POST'
+        if parallel:
+            req.headers[rpc.PARALLEL_HEADER] = 'true'
+        req.body = json.dumps([{"command": "sleep",
+                                "kwargs": {"seconds": seconds}}
+                               for seconds in (0.03, 0.02, 0.01)])
+        res = req.get_response(api)
+        return json.loads(res.body), resource.slept
+
+    def test_request_sequential(self):
+        returned, slept = self._sleep_request(parallel=False)
+        self.assertEquals([0.03, 0.02, 0.01], returned)
+        self.assertEquals([0.03, 0.02, 0.01], slept)
+
+    def test_request_parallel(self):
+        returned, slept = self._sleep_request(parallel=True)
+        self.assertEquals([0.03, 0.02, 0.01], returned)
+        self.assertEquals([0.01, 0.02, 0.03], slept)
+
+    def test_request_parallel_disabled(self):
+        self.config(rpc_parallel_commands=1)
+        returned, slept = self._sleep_request(parallel=True)
+        self.assertEquals([0.03, 0.02, 0.01], slept)
+
     def test_request_exc(self):
         api = create_api()
         req = webob.Request.blank('/rpc')
@@ -151,6 +186,34 @@ class TestRPCController(base.IsolatedUnitTest):
         returned = json.loads(res.body)
         self.assertIn("_error", returned[0])
 
+    def test_request_msgpack(self):
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+        api = create_api()
+        req = webob.Request.blank('/rpc')
+        req.method = 'POST'
+        req.content_type = rpc.MSGPACK_CONTENT_TYPE
+        req.headers['Accept'] = rpc.MSGPACK_CONTENT_TYPE
+        req.body = rpc.RPCMsgPackSerializer().to_msgpack([
+            {"command": "get_images", "kwargs": {"keyword": u"\u2603"}}])
+        res = req.get_response(api)
+        self.assertEquals(rpc.MSGPACK_CONTENT_TYPE, res.content_type)
+        returned = rpc.RPCMsgPackDeserializer().from_msgpack(res.body)
+        self.assertEquals([u"\u2603"], returned)
+
+    def test_request_msgpack_json_response(self):
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+        api = create_api()
+        req = webob.Request.blank('/rpc')
+        req.method = 'POST'
+        req.content_type = rpc.MSGPACK_CONTENT_TYPE
+        req.body = rpc.RPCMsgPackSerializer().to_msgpack([
+            {"command": "get_images", "kwargs": {"keyword": 1}}])
+        res = req.get_response(api)
+        self.assertEquals('application/json', res.content_type)
+        self.assertEquals([1], json.loads(res.body))
+
     def test_rpc_errors(self):
         api = create_api()
         req = webob.Request.blank('/rpc')
@@ -213,7 +276,7 @@ class TestRPCClient(base.IsolatedUnitTest):
         self.client._do_request = self.fake_request
 
     def fake_request(self, method, url, body, headers):
-        req = webob.Request.blank(url.path)
+        req = webob.Request.blank(url.path, headers=headers)
         req.body = body
         req.method = method
 
@@ -254,6 +317,142 @@ class TestRPCClient(base.IsolatedUnitTest):
         self.assertEquals(rst, 4)
         self.assertTrue(isinstance(rst, int))
 
+    def test_batch(self):
+        requests = []
+        fake_request = self.client._do_request
+
+        def count_requests(*args, **kwargs):
+            requests.append(args)
+            return fake_request(*args, **kwargs)
+
+        self.client._do_request = count_requests
+        with self.client.batch() as batch:
+            keyword = batch.get_images(keyword='fake')
+            count = batch.count_images(images=[1, 2, 3])
+            error = batch.raise_value_error()
+            self.assertEquals(0, len(requests))
+
+        self.assertEquals(1, len(requests))
+        self.assertEquals('fake', keyword.result())
+        self.assertEquals(3, count.result())
+        self.assertRaises(ValueError, error.result)
+
+    def test_batch_sent_on_result(self):
+        batch = self.client.batch()
+        keyword = batch.get_images(keyword='fake')
+        count = batch.count_images(images=[1, 2])
+        self.assertEquals(2, count.result())
+        self.assertEquals('fake', keyword.result())
+
+    def test_batch_parallel(self):
+        requests = []
+
+        def fake_request(method, url, body, headers):
+            requests.append(headers)
+            return self.fake_request(method, url, body, headers)
+
+        self.client._do_request = fake_request
+        with self.client.batch(parallel=True) as batch:
+            count = batch.count_images(images=[1, 2])
+        self.assertEquals(2, count.result())
+        self.assertEquals('true', requests[0][rpc.PARALLEL_HEADER])
+
+    def test_msgpack(self):
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+        requests = []
+
+        def fake_request(method, url, body, headers):
+            requests.append(headers)
+            return self.fake_request(method, url, body, headers)
+
+        client = rpc.RPCClient(host="http://127.0.0.1:9191",
+                               use_msgpack=True)
+        client._do_request = fake_request
+        self.assertEquals(3, client.count_images(images=[1, 2, 3]))
+        self.assertRaises(ValueError, client.raise_value_error)
+        self.assertEquals(rpc.MSGPACK_CONTENT_TYPE,
+                          requests[0]['Content-Type'])
+
+    def _fake_json_only_request(self, requests, error):
+        def fake_request(method, url, body, headers):
+            requests.append(headers)
+            if (headers or {}).get('Content-Type') == rpc.MSGPACK_CONTENT_TYPE:
+                raise error
+            return self.fake_request(method, url, body, headers)
+        return fake_request
+
+    def _test_msgpack_unsupported(self, error):
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+        self.addCleanup(rpc._JSON_ONLY_SERVERS.clear)
+        requests = []
+        client = rpc.RPCClient(host="127.0.0.1", port=9191,
+                               use_msgpack=True)
+        client._do_request = self._fake_json_only_request(requests, error)
+        self.assertEquals(3, client.count_images(images=[1, 2, 3]))
+        self.assertFalse(client.use_msgpack)
+        self.assertEquals(2, client.count_images(images=[1, 2]))
+        self.assertEquals(3, len(requests))
+
+        # Later clients of the same server send JSON right away
+        client = rpc.RPCClient(host="127.0.0.1", port=9191,
+                               use_msgpack=True)
+        self.assertFalse(client.use_msgpack)
+        client = rpc.RPCClient(host="127.0.0.1", port=9292,
+                               use_msgpack=True)
+        self.assertTrue(client.use_msgpack)
+
+    def test_msgpack_unsupported_by_server(self):
+        self._test_msgpack_unsupported(
+            exception.UnsupportedMediaType(status=415, body=''))
+
+    def test_msgpack_server_predates_msgpack(self):
+        # Such servers read the body as JSON and answer 400
+        self._test_msgpack_unsupported(
+            exception.Invalid('Malformed JSON in request body.'))
+
+    def test_msgpack_bad_request(self):
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+        self.addCleanup(rpc._JSON_ONLY_SERVERS.clear)
+        requests = []
+
+        def fake_request(method, url, body, headers):
+            requests.append(headers)
+            raise exception.Invalid('Bad Command')
+
+        client = rpc.RPCClient(host="127.0.0.1", port=9191,
+                               use_msgpack=True)
+        client._do_request = fake_request
+        self.assertRaises(exception.Invalid, client.count_images)
+        self.assertEquals(2, len(requests))
+        self.assertTrue(client.use_msgpack)
+        self.assertFalse(rpc._JSON_ONLY_SERVERS)
+
+    def test_batch_request_failed(self):
+        def fail_request(*args, **kwargs):
+            raise exception.ServerError()
+
+        self.client._do_request = fail_request
+        batch = self.client.batch()
+        keyword = batch.get_images(keyword='fake')
+        count = batch.count_images(images=[1, 2])
+        self.assertRaises(exception.ServerError, keyword.result)
+        self.assertRaises(exception.ServerError, count.result)
+
+    def test_batch_not_sent_on_error(self):
+        def fail_request(*args, **kwargs):
+            self.fail("Batch sent")
+
+        self.client._do_request = fail_request
+        try:
+            with self.client.batch() as batch:
+                batch.get_images(keyword='fake')
+                raise ValueError()
+        except ValueError:
+            pass
+
 
 class TestRPCJSONSerializer(test_utils.BaseTestCase):
 
@@ -288,6 +487,40 @@ class TestRPCJSONSerializer(test_utils.BaseTestCase):
         self.assertEqual(response.body, '{"key": "value"}')
 
 
+class TestRPCMsgPackSerializer(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRPCMsgPackSerializer, self).setUp()
+        if not rpc.MSGPACK_SUPPORTED:
+            self.skipTest('msgpack module not available')
+
+    def test_round_trip(self):
+        fixture = {"date": datetime.datetime(1900, 3, 8, 2, 0, 0, 12),
+                   "tags": set([u"ping", u"pong"]),
+                   "name": u"\u2603",
+                   "size": 2 ** 40,
+                   "properties": [{"deleted": False, "value": None}]}
+        packed = rpc.RPCMsgPackSerializer().to_msgpack(fixture)
+        actual = rpc.RPCMsgPackDeserializer().from_msgpack(packed)
+        self.assertEqual(fixture, actual)
+
+    def test_default(self):
+        request = webob.Request.blank('/')
+        request.headers['Accept'] = 'application/json;q=0.5, %s' % (
+            rpc.MSGPACK_CONTENT_TYPE)
+        response = webob.Response(request=request)
+        rpc.RPCResponseSerializer().default(response, {"key": "value"})
+        self.assertEqual(rpc.MSGPACK_CONTENT_TYPE, response.content_type)
+        self.assertEqual({"key": "value"},
+                         rpc.RPCMsgPackDeserializer().from_msgpack(
+                             response.body))
+
+    def test_malformed(self):
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          rpc.RPCMsgPackDeserializer().from_msgpack,
+                          '\xc1')
+
+
 class TestRPCJSONDeserializer(test_utils.BaseTestCase):
 
     def test_has_body_no_content_length(self):
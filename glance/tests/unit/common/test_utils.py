@@ -75,6 +75,15 @@ class TestUtils(test_utils.BaseTestCase):
         meat = ''.join(chunks)
         self.assertEqual(meat, '')
 
+    def test_skip_bytes(self):
+        """Ensure skip_bytes leaves out the first bytes of an iterator"""
+        chunks = ['ab', 'cde', 'f']
+        self.assertEqual(chunks, list(utils.skip_bytes(iter(chunks), 0)))
+        self.assertEqual(['e', 'f'],
+                         list(utils.skip_bytes(iter(chunks), 4)))
+        self.assertEqual(['f'], list(utils.skip_bytes(iter(chunks), 5)))
+        self.assertEqual([], list(utils.skip_bytes(iter(chunks), 6)))
+
     def test_limiting_reader(self):
         """Ensure limiting reader class accesses all bytes of file"""
         BYTES = 1024
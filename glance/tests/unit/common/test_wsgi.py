@@ -16,10 +16,14 @@
 #    under the License.
 
 import socket
+import StringIO
+import tempfile
 import time
 
 import datetime
+import eventlet
 import eventlet.patcher
+import eventlet.wsgi
 import httplib2
 import webob
 
@@ -279,6 +283,116 @@ class ServerTest(test_utils.BaseTestCase):
         self.assertTrue(isinstance(actual, eventlet.greenpool.GreenPool))
 
 
+class FileSource(object):
+    def __init__(self, fp, offset, length):
+        self.fp = fp
+        self.offset = offset
+        self.length = length
+
+        self.aborted = False
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def abort(self):
+        self.aborted = True
+
+
+class SendFileBodyTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(SendFileBodyTest, self).setUp()
+        self.fp = tempfile.TemporaryFile()
+        self.fp.write('0123456789')
+        self.fp.flush()
+        self.addCleanup(self.fp.close)
+
+    def test_fallback_when_not_attached(self):
+        source = FileSource(self.fp, 2, 4)
+        body = wsgi.SendFileBody(source, fallback=['23', '45'])
+        self.assertFalse(body.attached)
+        self.assertEqual('2345', ''.join(body))
+        self.assertEqual(0, body.bytes_sent)
+
+    def test_sendfile_when_attached(self):
+        if not wsgi.SENDFILE_SUPPORTED:
+            self.skipTest('sendfile module not available')
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        self.addCleanup(writer.close)
+        wfile = writer.makefile('wb', 0)
+
+        source = FileSource(self.fp, 2, 4)
+        body = wsgi.SendFileBody(source, fallback=['not', 'used'])
+        body.attach(writer, wfile, wfile.write)
+        self.assertTrue(body.attached)
+        self.assertEqual([], list(body))
+        self.assertEqual(4, body.bytes_sent)
+        self.assertEqual('2345', reader.recv(10))
+        body.close()
+        self.assertFalse(source.aborted)
+
+    def test_sendfile_short_file(self):
+        if not wsgi.SENDFILE_SUPPORTED:
+            self.skipTest('sendfile module not available')
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        self.addCleanup(writer.close)
+
+        wfile = writer.makefile('wb', 0)
+
+        body = wsgi.SendFileBody(FileSource(self.fp, 8, 4))
+        body.attach(writer, wfile, wfile.write)
+        self.assertRaises(IOError, list, body)
+        self.assertEqual(2, body.bytes_sent)
+
+    def test_sendfile_client_gone(self):
+        if not wsgi.SENDFILE_SUPPORTED:
+            self.skipTest('sendfile module not available')
+        reader, writer = socket.socketpair()
+        self.addCleanup(writer.close)
+        reader.close()
+        wfile = writer.makefile('wb', 0)
+
+        source = FileSource(self.fp, 2, 4)
+        body = wsgi.SendFileBody(source)
+        body.attach(writer, wfile, lambda data: None)
+        self.assertEqual([], list(body))
+        self.assertTrue(body.client_gone)
+        self.assertEqual(0, body.bytes_sent)
+        body.close()
+        self.assertTrue(source.aborted)
+
+    def test_sendfile_through_server(self):
+        if not wsgi.SENDFILE_SUPPORTED:
+            self.skipTest('sendfile module not available')
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '4')])
+            return wsgi.SendFileBody(FileSource(self.fp, 2, 4),
+                                     fallback=['not', 'used'])
+
+        server_sock = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(server_sock.close)
+        server = eventlet.spawn(eventlet.wsgi.server, server_sock, app,
+                                protocol=wsgi.HttpProtocol,
+                                log=StringIO.StringIO())
+        self.addCleanup(server.kill)
+
+        client = eventlet.connect(server_sock.getsockname())
+        self.addCleanup(client.close)
+        client.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n'
+                       'Connection: close\r\n\r\n')
+        data = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertTrue(data.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(data.endswith('\r\n\r\n2345'))
+
+
 class TestHelpers(test_utils.BaseTestCase):
 
     def test_headers_are_unicode(self):
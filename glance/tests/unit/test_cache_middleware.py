@@ -18,8 +18,11 @@ import testtools
 import webob
 
 import glance.api.middleware.cache
+import glance.api.v1.images
 from glance.common import exception
 from glance import context
+from glance.image_cache import admission
+from glance.image_cache import peers
 import glance.db.sqlalchemy.api as db
 import glance.registry.client.v1.api as registry
 from glance.tests.unit import base
@@ -84,9 +87,18 @@ class TestCacheMiddlewareRequestStashCacheInfo(testtools.TestCase):
 class ChecksumTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
         class DummyCache(object):
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            admission = admission.AdmissionPolicy()
+
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 claimed=False):
                 self.image_checksum = image_checksum
 
+            def admit(self, image_id, image_size=None, disk_format=None):
+                return True
+
+            def record_bytes_served(self, source, num_bytes):
+                pass
+
         self.cache = DummyCache()
         self.policy = unit_test_utils.FakePolicyEnforcer()
 
@@ -117,6 +129,27 @@ class TestCacheMiddlewareChecksumVerification(base.IsolatedUnitTest):
 
         self.assertEqual("abcdefghi", cache_filter.cache.image_checksum)
 
+    def test_not_admitted(self):
+        cache_filter = ChecksumTestCacheFilter()
+        admitted = []
+
+        def fake_admit(image_id, image_size=None, disk_format=None):
+            admitted.append((image_size, disk_format))
+            return False
+
+        cache_filter.cache.admit = fake_admit
+        cache_filter.cache.release_fill = admitted.append
+        headers = {"x-image-meta-checksum": "1234567890",
+                   "x-image-meta-size": "1024",
+                   "x-image-meta-disk_format": "iso"}
+        resp = webob.Response(request=self.request, headers=headers)
+        self.request.environ['api.cache.fill_claimed'] = True
+        self.assertEqual(resp,
+                         cache_filter._process_GET_response(resp, 'test1'))
+
+        self.assertEqual([(1024, 'iso'), 'test1'], admitted)
+        self.assertFalse(hasattr(cache_filter.cache, 'image_checksum'))
+
     def test_checksum_missing_header(self):
         cache_filter = ChecksumTestCacheFilter()
         resp = webob.Response(request=self.request)
@@ -135,13 +168,22 @@ class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
         self.serializer = FakeImageSerializer()
 
         class DummyCache(object):
+            admission = admission.AdmissionPolicy()
+
             def __init__(self):
                 self.deleted_images = []
 
             def is_cached(self, image_id):
                 return True
 
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 claimed=False):
+                pass
+
+            def admit(self, image_id, image_size=None, disk_format=None):
+                return True
+
+            def record_bytes_served(self, source, num_bytes):
                 pass
 
             def delete_cached_image(self, image_id):
@@ -150,7 +192,22 @@ class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
             def get_image_size(self, image_id):
                 pass
 
+            def get_image_file(self, image_id):
+                return iter([])
+
+            def get_metadata_snapshot(self, image_id, version):
+                return self.snapshots.get((image_id, version))
+
+            def store_metadata_snapshot(self, image_id, version, image_meta):
+                self.snapshots[(image_id, version)] = dict(image_meta)
+
+            def delete_metadata_snapshots(self, image_id):
+                for key in self.snapshots.keys():
+                    if key[0] == image_id:
+                        del self.snapshots[key]
+
         self.cache = DummyCache()
+        self.cache.snapshots = {}
         self.policy = unit_test_utils.FakePolicyEnforcer()
 
 
@@ -213,6 +270,51 @@ class TestCacheMiddlewareProcessRequest(base.IsolatedUnitTest):
             request, image_id, dummy_img_iterator)
         self.assertEqual(True, actual)
 
+    def test_v1_process_request_uses_metadata_snapshot(self):
+        lookups = []
+
+        def fake_get_image_metadata(context, image_id):
+            lookups.append(image_id)
+            return {'id': image_id, 'is_public': True, 'owner': 'someone',
+                    'status': 'active', 'deleted': False, 'size': '20'}
+
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = ProcessRequestTestCacheFilter()
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+        for x in xrange(3):
+            cache_filter._process_v1_request(request, image_id, iter([]))
+        self.assertEqual([image_id], lookups)
+
+        resp = webob.Response(request=request)
+        cache_filter._process_PUT_response(resp, image_id)
+        cache_filter._process_v1_request(request, image_id, iter([]))
+        self.assertEqual([image_id, image_id], lookups)
+
+    def test_metadata_snapshot_of_private_image(self):
+        """
+        Test that the metadata kept for a private image is only used for
+        its owner, and that the registry decides for anyone else.
+        """
+        lookups = []
+
+        def fake_get_image_metadata(context, image_id):
+            lookups.append(context.owner)
+            return {'id': image_id, 'is_public': False, 'owner': 'owner1',
+                    'status': 'active', 'deleted': False, 'size': '20'}
+
+        image_id = 'test1'
+        cache_filter = ProcessRequestTestCacheFilter()
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+        for tenant in ('owner1', 'owner1', 'member', 'member'):
+            request = webob.Request.blank('/v1/images/%s' % image_id)
+            request.context = context.RequestContext(tenant=tenant)
+            cache_filter._process_v1_request(request, image_id, iter([]))
+        self.assertEqual(['owner1', 'member', 'member'], lookups)
+
     def test_v1_remove_location_image_fetch(self):
 
         class CheckNoLocationDataSerializer(object):
@@ -329,6 +431,377 @@ class TestCacheMiddlewareProcessRequest(base.IsolatedUnitTest):
 
         self.assertEqual(None, cache_filter.process_request(request))
 
+    def test_process_request_range(self):
+        """
+        Test that a Range request for a cached image is answered with the
+        requested range of the cached image.
+        """
+        image_id = 'test1'
+        request = webob.Request.blank('/v2/images/%s/file' % image_id,
+                                      headers={'Range': 'bytes=10-19'})
+        request.context = context.RequestContext()
+        cache_filter = ProcessRequestTestCacheFilter()
+
+        def fake_get_v2_image_meta(request, image_id):
+            return {'id': image_id, 'owner': '', 'status': 'active',
+                    'deleted': False, 'size': 100,
+                    'checksum': 'c352f4e7121c6eae958bc1570324f17e'}
+
+        self.stubs.Set(cache_filter, '_get_v2_image_meta',
+                       fake_get_v2_image_meta)
+        response = cache_filter.process_request(request)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('bytes 10-19/100', response.headers['Content-Range'])
+        self.assertEqual('10', response.headers['Content-Length'])
+        self.assertFalse('Content-MD5' in response.headers)
+
+    def test_process_request_range_v1_has_no_checksum(self):
+        """
+        Test that the partial response to a v1 Range request carries no
+        checksum of the whole image.
+        """
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=10-19'})
+        request.context = context.RequestContext()
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.serializer = glance.api.v1.images.ImageSerializer()
+
+        def fake_get_v1_image_meta(request, image_id):
+            return {'id': image_id, 'owner': '', 'status': 'active',
+                    'deleted': False, 'size': 100, 'properties': {},
+                    'checksum': 'c352f4e7121c6eae958bc1570324f17e'}
+
+        self.stubs.Set(cache_filter, '_get_v1_image_meta',
+                       fake_get_v1_image_meta)
+        response = cache_filter.process_request(request)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('100', response.headers['x-image-meta-size'])
+        self.assertFalse('Content-MD5' in response.headers)
+        self.assertFalse('ETag' in response.headers)
+        self.assertFalse('x-image-meta-checksum' in response.headers)
+
+
+class FillTestCacheFilter(glance.api.middleware.cache.CacheFilter):
+    def __init__(self, claimed):
+        self.serializer = FakeImageSerializer()
+
+        class DummyCache(object):
+            admission = admission.AdmissionPolicy()
+
+            def __init__(self):
+                self.released = []
+                self.misses = []
+                self.admitted = True
+
+            def is_cached(self, image_id):
+                return False
+
+            def record_miss(self, image_id):
+                self.misses.append(image_id)
+
+            def record_bytes_served(self, source, num_bytes):
+                pass
+
+            def may_admit(self, image_id):
+                return self.admitted
+
+            def admit(self, image_id, image_size=None, disk_format=None):
+                return self.admitted
+
+            def claim_fill(self, image_id):
+                return claimed
+
+            def release_fill(self, image_id):
+                self.released.append(image_id)
+
+            def is_being_filled(self, image_id):
+                return True
+
+            def get_tailing_iter(self, image_id, fallback):
+                return ['tail', image_id]
+
+        self.cache = DummyCache()
+        self.policy = unit_test_utils.FakePolicyEnforcer()
+
+
+class TestCacheMiddlewareCoalescedFill(base.IsolatedUnitTest):
+    def test_process_request_follows_fill(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=False)
+
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return image_iterator
+
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        actual = cache_filter.process_request(request)
+        self.assertEqual(['tail', image_id], actual)
+        self.assertEqual([image_id], cache_filter.cache.misses)
+
+    def test_process_request_claims_fill(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=True)
+
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertTrue(request.environ['api.cache.fill_claimed'])
+
+        resp = webob.Response(request=request, status=404)
+        cache_filter.process_response(resp)
+        self.assertEqual([image_id], cache_filter.cache.released)
+
+    def test_process_response_forbidden_releases_fill(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=True)
+        self.assertEqual(None, cache_filter.process_request(request))
+
+        self.set_policy_rules({'download_image': '!'})
+        cache_filter.policy = glance.api.policy.Enforcer()
+        resp = webob.Response(request=request)
+        self.assertRaises(webob.exc.HTTPForbidden,
+                          cache_filter.process_response, resp)
+        self.assertEqual([image_id], cache_filter.cache.released)
+
+    def test_app_error_releases_fill(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=True)
+
+        def failing_app(environ, start_response):
+            raise IOError('Backend failure')
+
+        cache_filter.application = failing_app
+        self.assertRaises(IOError, cache_filter, request)
+        self.assertFalse('api.cache.fill_claimed' in request.environ)
+        self.assertEqual([image_id], cache_filter.cache.released)
+
+    def test_process_request_not_admitted_does_not_claim_fill(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=True)
+        cache_filter.cache.admitted = False
+        cache_filter.cache.is_being_filled = lambda image_id: False
+
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertFalse('api.cache.fill_claimed' in request.environ)
+        self.assertEqual([image_id], cache_filter.cache.misses)
+
+    def test_process_request_coalescing_disabled(self):
+        self.config(image_cache_coalesce_fills=False)
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.context = context.RequestContext()
+        cache_filter = FillTestCacheFilter(claimed=True)
+
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertFalse('api.cache.fill_claimed' in request.environ)
+
+
+class FakePeerGroup(object):
+    def __init__(self, owner, fail=False):
+        self.owner = owner
+        self.fail = fail
+        self.fetched = []
+
+    def get_owner(self, image_id):
+        return self.owner
+
+    def fetch(self, peer, request, fallback):
+        self.fetched.append(peer)
+        if self.fail:
+            raise exception.GlanceException('peer down')
+        return iter(['peer', 'data']), {'content-md5': 'abc'}
+
+
+class FakePeerResponse(object):
+    def __init__(self, status, chunks, length=None):
+        self.status = status
+        self.chunks = list(chunks)
+        self.length = length
+
+    def getheaders(self):
+        headers = [('x-image-meta-checksum', 'abc')]
+        if self.length is not None:
+            headers.append(('content-length', str(self.length)))
+        return headers
+
+    def read(self, amt=None):
+        if not self.chunks:
+            return ''
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+
+class FakePeerConnection(object):
+    response = None
+    connections = []
+
+    def __init__(self, netloc, timeout=None):
+        self.netloc = netloc
+        self.timeout = timeout
+        self.closed = False
+        self.connections.append(self)
+
+    def request(self, method, path, headers=None):
+        self.method = method
+        self.path = path
+        self.headers = headers
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        self.closed = True
+
+
+class TestPeerGroupFetch(base.IsolatedUnitTest):
+    def setUp(self):
+        super(TestPeerGroupFetch, self).setUp()
+        FakePeerConnection.connections = []
+        self.stubs.Set(peers.httplib, 'HTTPConnection', FakePeerConnection)
+        self.peer_group = peers.PeerGroup(
+            ['http://node1:9292', 'http://node2:9292'], 'http://node1:9292',
+            timeout=10, read_timeout=30)
+        self.request = webob.Request.blank('/v1/images/test1',
+                                           headers={'X-Auth-Token': 'token'})
+
+    def _fetch(self, response, fallback=None):
+        FakePeerConnection.response = response
+
+        def fail():
+            self.fail('fallback should not be used')
+
+        return self.peer_group.fetch('http://node2:9292', self.request,
+                                     fallback or fail)
+
+    def test_fetch(self):
+        image_iter, headers = self._fetch(
+            FakePeerResponse(200, ['peer', 'data'], length=8))
+        self.assertEqual(['peer', 'data'], list(image_iter))
+        self.assertEqual('abc', headers['x-image-meta-checksum'])
+
+        conn = FakePeerConnection.connections[0]
+        self.assertEqual('node2:9292', conn.netloc)
+        self.assertEqual(None, conn.timeout)
+        self.assertEqual('/v1/images/test1', conn.path)
+        self.assertEqual('token', conn.headers['X-Auth-Token'])
+        self.assertEqual('http://node1:9292',
+                         conn.headers[peers.PEER_HEADER])
+        self.assertTrue(conn.closed)
+
+    def test_fetch_error_status(self):
+        self.assertRaises(exception.GlanceException, self._fetch,
+                          FakePeerResponse(404, []))
+        self.assertTrue(FakePeerConnection.connections[0].closed)
+
+    def test_fetch_fails_midway(self):
+        image_iter, headers = self._fetch(
+            FakePeerResponse(200, ['ab', IOError('connection reset')],
+                             length=4),
+            fallback=lambda: iter(['a', 'bcd']))
+        self.assertEqual(['ab', 'cd'], list(image_iter))
+        self.assertTrue(FakePeerConnection.connections[0].closed)
+
+    def test_fetch_truncated(self):
+        image_iter, headers = self._fetch(
+            FakePeerResponse(200, ['ab'], length=4),
+            fallback=lambda: iter(['abcd']))
+        self.assertEqual(['ab', 'cd'], list(image_iter))
+
+
+class TestCacheMiddlewarePeerFetch(base.IsolatedUnitTest):
+    def _make_filter(self, peer_group):
+        cache_filter = FillTestCacheFilter(claimed=True)
+        cache_filter.peers = peer_group
+        self.caching = []
+
+        def fake_get_caching_iter(image_id, image_checksum, image_iter,
+                                  claimed=False):
+            self.caching.append((image_id, image_checksum, claimed))
+            return image_iter
+
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return list(image_iterator)
+
+        cache_filter.cache.get_caching_iter = fake_get_caching_iter
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        return cache_filter
+
+    def _make_request(self, image_id, headers=None):
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers=headers or {})
+        request.context = context.RequestContext()
+        return request
+
+    def test_process_request_fetches_from_peer(self):
+        peer_group = FakePeerGroup('http://peer:9292')
+        cache_filter = self._make_filter(peer_group)
+        request = self._make_request('test1')
+
+        self.assertEqual(['peer', 'data'],
+                         cache_filter.process_request(request))
+        self.assertEqual(['http://peer:9292'], peer_group.fetched)
+        self.assertEqual([('test1', 'abc', True)], self.caching)
+        self.assertFalse('api.cache.fill_claimed' in request.environ)
+
+    def test_process_request_peer_image_not_admitted(self):
+        peer_group = FakePeerGroup('http://peer:9292')
+        cache_filter = self._make_filter(peer_group)
+        cache_filter.cache.admitted = False
+        request = self._make_request('test1')
+        request.environ['api.cache.fill_claimed'] = True
+        cache_filter._follow_fill = lambda request, image_id: False
+
+        self.assertEqual(['peer', 'data'],
+                         cache_filter.process_request(request))
+        self.assertEqual([], self.caching)
+        self.assertEqual(['test1'], cache_filter.cache.released)
+
+    def test_process_request_owned_image(self):
+        peer_group = FakePeerGroup(None)
+        cache_filter = self._make_filter(peer_group)
+
+        self.assertEqual(None, cache_filter.process_request(
+            self._make_request('test1')))
+        self.assertEqual([], peer_group.fetched)
+
+    def test_process_request_from_peer(self):
+        peer_group = FakePeerGroup('http://peer:9292')
+        cache_filter = self._make_filter(peer_group)
+        request = self._make_request(
+            'test1', {'X-Image-Cache-Peer': 'http://other:9292'})
+
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertEqual([], peer_group.fetched)
+
+    def test_process_request_peer_fails(self):
+        peer_group = FakePeerGroup('http://peer:9292', fail=True)
+        cache_filter = self._make_filter(peer_group)
+        request = self._make_request('test1')
+
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertEqual(['http://peer:9292'], peer_group.fetched)
+        self.assertTrue(request.environ['api.cache.fill_claimed'])
+
+    def test_peer_group_owner(self):
+        self.config(image_cache_peers=['node1:9292', 'http://node2:9292/'],
+                    image_cache_peer_self='http://node1:9292')
+        peer_group = peers.PeerGroup.from_config()
+        owners = set(peer_group.get_owner('image-%d' % x)
+                     for x in xrange(100))
+        self.assertEqual(set([None, 'http://node2:9292']), owners)
+
 
 class TestCacheMiddlewareProcessResponse(base.IsolatedUnitTest):
     def test_process_v1_DELETE_response(self):
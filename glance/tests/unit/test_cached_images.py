@@ -16,6 +16,7 @@
 
 import testtools
 import webob
+import webob.exc
 
 from glance.api import cached_images
 from glance.api import policy
@@ -44,6 +45,7 @@ class FakeCache(image_cache.ImageCache):
     def __init__(self):
         self.init_driver()
         self.deleted_images = []
+        self.queued_images = []
 
     def init_driver(self):
         pass
@@ -57,12 +59,16 @@ class FakeCache(image_cache.ImageCache):
     def get_queued_images(self):
         return {'test': 'passed'}
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
+        self.queued_images.append((image_id, priority))
         return 'pass'
 
     def delete_queued_image(self, image_id):
         self.deleted_images.append(image_id)
 
+    def get_stats(self):
+        return {'hits': 3, 'misses': 1, 'hit_ratio': 0.75}
+
 
 class FakeController(cached_images.Controller):
     def __init__(self):
@@ -104,6 +110,21 @@ class TestCachedImages(testtools.TestCase):
         req = webob.Request.blank('')
         req.context = 'test'
         self.controller.queue_image(req, image_id='test1')
+        self.assertEqual([('test1', 0)],
+                         self.controller.cache.queued_images)
+
+    def test_queue_image_priority(self):
+        req = webob.Request.blank('?priority=2.5')
+        req.context = 'test'
+        self.controller.queue_image(req, image_id='test1')
+        self.assertEqual([('test1', 2.5)],
+                         self.controller.cache.queued_images)
+
+    def test_queue_image_bad_priority(self):
+        req = webob.Request.blank('?priority=high')
+        req.context = 'test'
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.queue_image, req, image_id='test1')
 
     def test_delete_queued_image(self):
         req = webob.Request.blank('')
@@ -111,3 +132,10 @@ class TestCachedImages(testtools.TestCase):
         self.controller.delete_queued_image(req, 'deleted_img')
         self.assertEqual(['deleted_img'],
                          self.controller.cache.deleted_images)
+
+    def test_get_cache_stats(self):
+        req = webob.Request.blank('')
+        req.context = 'test'
+        result = self.controller.get_cache_stats(req)
+        self.assertEqual({'cache_stats': {'hits': 3, 'misses': 1,
+                                          'hit_ratio': 0.75}}, result)
@@ -156,6 +156,22 @@ class TestImageRepo(test_utils.BaseTestCase):
         image_ids = set([i.image_id for i in images])
         self.assertEqual(set([UUID1, UUID2, UUID3]), image_ids)
 
+    def test_list_tags(self):
+        tag_calls = []
+        orig_get_tags = self.db.image_tag_get_all_for_images
+
+        def fake_get_tags(context, image_ids):
+            tag_calls.append(image_ids)
+            return orig_get_tags(context, image_ids)
+
+        self.stubs.Set(self.db, 'image_tag_get_all_for_images',
+                       fake_get_tags)
+        images = self.image_repo.list()
+        tags = dict((i.image_id, i.tags) for i in images)
+        self.assertEqual(set(['ping', 'pong']), tags[UUID1])
+        self.assertEqual(set(), tags[UUID2])
+        self.assertEqual(1, len(tag_calls))
+
     def _do_test_list_status(self, status, expected):
         self.context = glance.context.RequestContext(
                         user=USER1, tenant=TENANT3)
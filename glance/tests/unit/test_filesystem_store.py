@@ -74,6 +74,27 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_file_range(self):
+        """Test the file handle and range exposed for sendfile"""
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        image_file = StringIO.StringIO(file_contents)
+        self.store.add(image_id, image_file, len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+
+        self.assertEqual(0, image_file.offset)
+        self.assertEqual(image_size, image_file.length)
+        self.assertEqual(file_contents,
+                         os.read(image_file.fileno(), image_size))
+        image_file.close()
+
+        image_file = ChunkedFile(os.path.join(self.test_dir, image_id),
+                                 offset=5, length=5)
+        self.assertEqual("00000", "".join(image_file))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
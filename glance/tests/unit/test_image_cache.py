@@ -23,11 +23,19 @@ import StringIO
 import tempfile
 import time
 
+import eventlet
 import fixtures
 import stubout
 
 from glance.common import exception
 from glance import image_cache
+from glance.image_cache import admission
+from glance.image_cache import eviction
+from glance.image_cache import partial
+from glance.image_cache import planner
+from glance.image_cache import prefetcher
+from glance.image_cache import sharding
+from glance.image_cache import stats
 #NOTE(bcwaldon): This is imported to load the registry config options
 import glance.registry
 import glance.store.filesystem as fs_store
@@ -89,6 +97,183 @@ class ImageCacheTestCase(object):
 
         self.assertEqual(FIXTURE_DATA, buff.getvalue())
 
+    @skip_if_disabled
+    def test_cached_image_file(self):
+        """
+        Test reading a cached image through CachedImageFile, which counts
+        a hit once the whole file has been read.
+        """
+        self._setup_fixture_file()
+
+        cached = image_cache.CachedImageFile(self.cache, 1)
+        self.assertEqual(0, cached.offset)
+        self.assertEqual(FIXTURE_LENGTH, cached.length)
+        self.assertEqual(FIXTURE_DATA,
+                         os.read(cached.fileno(), FIXTURE_LENGTH))
+        cached.close()
+        self.assertEqual(1, self.cache.get_hit_count(1))
+
+        cached = image_cache.CachedImageFile(self.cache, 1)
+        self.assertEqual(FIXTURE_DATA, ''.join(cached))
+        self.assertEqual(2, self.cache.get_hit_count(1))
+
+    @skip_if_disabled
+    def test_cached_image_file_abandoned(self):
+        """
+        Test that abandoning an iteration over a CachedImageFile does
+        not count as a hit.
+        """
+        self._setup_fixture_file()
+
+        cached = image_cache.CachedImageFile(self.cache, 1)
+        cached.CHUNKSIZE = 16
+        chunks = iter(cached)
+        chunks.next()
+        chunks.close()
+        self.assertEqual(0, self.cache.get_hit_count(1))
+
+        cached = image_cache.CachedImageFile(self.cache, 1)
+        cached.fileno()
+        cached.abort()
+        self.assertEqual(0, self.cache.get_hit_count(1))
+
+    @skip_if_disabled
+    def test_memory_tier(self):
+        """
+        Test that an image read from the disk cache often enough is served
+        from memory, still counting hits, until it is deleted.
+        """
+        self.config(image_cache_memory_size=FIXTURE_LENGTH,
+                    image_cache_memory_promote_hits=2)
+        self.cache.init_memory_tier()
+        self._setup_fixture_file()
+
+        for x in xrange(2):
+            image_file = self.cache.get_image_file(1)
+            self.assertTrue(isinstance(image_file,
+                                       image_cache.CachedImageFile))
+            self.assertEqual(FIXTURE_DATA, ''.join(image_file))
+
+        image_file = self.cache.get_image_file(1)
+        self.assertTrue(isinstance(image_file, image_cache.MemoryImageFile))
+        self.assertEqual(FIXTURE_DATA, ''.join(image_file))
+        self.assertEqual(3, self.cache.get_hit_count(1))
+
+        # A second image does not fit beside the first one
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file(2, FIXTURE_FILE))
+        for x in xrange(2):
+            ''.join(self.cache.get_image_file(2))
+        self.assertTrue(isinstance(self.cache.get_image_file(1),
+                                   image_cache.CachedImageFile))
+
+        self.cache.delete_cached_image(2)
+        self.assertTrue(isinstance(self.cache.get_image_file(2),
+                                   image_cache.CachedImageFile))
+        self.assertEqual(0, self.cache.memory.size)
+
+    @skip_if_disabled
+    def test_memory_tier_promotion_yields(self):
+        """
+        Test that an image is copied into the memory cache a chunk at a
+        time, letting other green threads run in between.
+        """
+        self.config(image_cache_memory_size=FIXTURE_LENGTH,
+                    image_cache_memory_promote_hits=1)
+        self.cache.init_memory_tier()
+        self._setup_fixture_file()
+        sleeps = []
+        self.stubs.Set(image_cache.utils, 'sleep', sleeps.append)
+        self.stubs.Set(image_cache.CachedImageFile, 'CHUNKSIZE',
+                       FIXTURE_LENGTH / 4)
+
+        self.cache.record_disk_hit(1)
+        self.assertEqual(FIXTURE_DATA, self.cache.memory.get(1))
+        self.assertEqual(4, len(sleeps))
+
+    @skip_if_disabled
+    def test_metadata_snapshot(self):
+        """
+        Test that the metadata of an image is kept for a while, and
+        forgotten when the image is deleted from the cache.
+        """
+        self._setup_fixture_file()
+        image_meta = {'id': 1, 'status': 'active', 'properties': {'a': 'b'}}
+        # Snapshots are off by default
+        self.cache.store_metadata_snapshot(1, 'v2', image_meta)
+        self.assertEqual(None, self.cache.get_metadata_snapshot(1, 'v2'))
+
+        self.config(image_cache_metadata_ttl=60)
+        self.cache.store_metadata_snapshot(1, 'v2', image_meta)
+        self.assertEqual(image_meta, self.cache.get_metadata_snapshot(1, 'v2'))
+        self.assertEqual(None, self.cache.get_metadata_snapshot(1, 'v1'))
+
+        self.config(image_cache_metadata_ttl=1)
+        path = self.cache._get_snapshot_path(1, 'v2')
+        os.utime(path, (time.time() - 5, time.time() - 5))
+        self.assertEqual(None, self.cache.get_metadata_snapshot(1, 'v2'))
+
+        os.utime(path, None)
+        self.cache.delete_cached_image(1)
+        self.assertEqual(None, self.cache.get_metadata_snapshot(1, 'v2'))
+
+    @skip_if_disabled
+    def test_admission(self):
+        """
+        Test that images are only admitted after enough recent misses
+        """
+        self.cache.admission = admission.AdmissionPolicy(min_misses=2)
+        self.cache.record_miss(1)
+        self.assertFalse(self.cache.admit(1, 1024))
+        self.assertFalse(self.cache.may_admit(1))
+        self.assertTrue(self.cache.admit(1, 1024, queued=True))
+        self.cache.record_miss(1)
+        self.assertTrue(self.cache.may_admit(1))
+        self.assertTrue(self.cache.admit(1, 1024))
+
+        self.config(image_cache_admission_window=1)
+        path = self.cache.driver.get_image_filepath(1, 'misses')
+        os.utime(path, (time.time() - 5, time.time() - 5))
+        self.assertEqual(0, self.cache.get_miss_count(1))
+        self.cache.record_miss(1)
+        self.assertEqual(1, self.cache.get_miss_count(1))
+
+    @skip_if_disabled
+    def test_stats(self):
+        """
+        Test that the cache counts hits, misses, fills and evictions
+        """
+        self.cache.reset_stats()
+        self.cache.record_miss('1')
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('1', FIXTURE_FILE))
+        for x in xrange(3):
+            self.assertEqual(FIXTURE_DATA,
+                             ''.join(self.cache.get_image_file('1')))
+        self.cache.delete_cached_image('1')
+
+        stats = self.cache.get_stats()
+        self.assertEqual(3, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.75, stats['hit_ratio'])
+        self.assertEqual(3 * FIXTURE_LENGTH, stats['bytes_from_cache'])
+        self.assertEqual(1, stats['fills_completed'])
+        self.assertEqual(FIXTURE_LENGTH, stats['fill_bytes'])
+        self.assertEqual(1, stats['evictions_deleted'])
+        self.assertEqual(0, stats['size'])
+
+    @skip_if_disabled
+    def test_stats_shared_by_processes(self):
+        """
+        Test that the counts of several processes are added up
+        """
+        self.cache.reset_stats()
+        other = stats.CacheStats(
+            self.cache.get_cache_shards()[0][0].stats_dir, 0)
+        self.cache.stats.incr('hits', 2)
+        other.incr('hits', 5)
+        self.assertEqual(7, self.cache.get_stats()['hits'])
+
     @skip_if_disabled
     def test_get_image_size(self):
         """
@@ -217,6 +402,59 @@ class ImageCacheTestCase(object):
             self.assertTrue(self.cache.is_cached(x),
                             "Image %s was not cached!" % x)
 
+    @skip_if_disabled
+    def test_prune_to_low_watermark(self):
+        """
+        Test that once the cache grows past its high watermark it is
+        pruned down to its low watermark in one go.
+        """
+        self.config(image_cache_high_watermark=0.8,
+                    image_cache_low_watermark=0.4)
+
+        for x in xrange(3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        # Below the high watermark of 4K, nothing is pruned
+        self.assertEqual((0, 0), self.cache.prune())
+
+        for x in xrange(3, 5):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        self.assertEqual((3, 3 * 1024), self.cache.prune())
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_prune_lfu(self):
+        """
+        Test that the pruner honours the configured eviction policy
+        """
+        self.config(image_cache_eviction_policy='lfu')
+        self.cache.init_eviction_policy()
+
+        for x in xrange(10):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        # Hit the older half of the images twice, so that a LRU policy
+        # would prune the other half
+        for x in xrange(10):
+            for i in xrange(2 if x < 5 else 1):
+                with self.cache.open_for_read(x) as cache_file:
+                    for chunk in cache_file:
+                        pass
+
+        self.cache.prune()
+
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+        for x in xrange(0, 5):
+            self.assertTrue(self.cache.is_cached(x),
+                            "Image %s was not cached!" % x)
+        for x in xrange(5, 10):
+            self.assertFalse(self.cache.is_cached(x),
+                             "Image %s was cached!" % x)
+
     @skip_if_disabled
     def test_prune_to_zero(self):
         """Test that an image_cache_max_size of 0 doesn't kill the pruner
@@ -282,6 +520,51 @@ class ImageCacheTestCase(object):
         self.assertEqual(self.cache.get_queued_images(),
                          ['0', '1', '2'])
 
+    def test_queue_priority(self):
+        """
+        Test that images are prefetched by priority, then queueing order
+        """
+        self.assertTrue(self.cache.queue_image('a-low'))
+        self.assertTrue(self.cache.queue_image('b-high', priority=2.5))
+        self.assertTrue(self.cache.queue_image('c-low'))
+        self.assertTrue(self.cache.queue_image('d-higher', priority=10))
+
+        self.assertEqual(2.5, self.cache.get_queue_priority('b-high'))
+        self.assertEqual(0, self.cache.get_queue_priority('a-low'))
+        self.assertEqual(['d-higher', 'b-high', 'a-low', 'c-low'],
+                         self.cache.get_prefetch_queue())
+
+    def test_queue_priority_raised(self):
+        """
+        Test that queueing a queued image again only raises its priority
+        """
+        self.assertTrue(self.cache.queue_image('a', priority=1))
+        self.assertTrue(self.cache.queue_image('b', priority=2))
+
+        self.assertFalse(self.cache.queue_image('a', priority=0.5))
+        self.assertEqual(1, self.cache.get_queue_priority('a'))
+        self.assertFalse(self.cache.queue_image('a', priority=3))
+        self.assertEqual(3, self.cache.get_queue_priority('a'))
+        self.assertEqual(['a', 'b'], self.cache.get_prefetch_queue())
+
+    def test_queue_planned_after_queued_by_hand(self):
+        """
+        Test that images queued by hand are prefetched before the images
+        the planner picked, whatever their score
+        """
+        self.assertTrue(self.cache.queue_image('planned', priority=50,
+                                               planned=True))
+        self.assertTrue(self.cache.queue_image('by-hand'))
+
+        self.assertEqual(50, self.cache.get_queue_priority('planned'))
+        self.assertEqual(['by-hand', 'planned'],
+                         self.cache.get_prefetch_queue())
+
+        # Queueing a planned image by hand moves it ahead
+        self.assertFalse(self.cache.queue_image('planned', priority=1))
+        self.assertEqual(['planned', 'by-hand'],
+                         self.cache.get_prefetch_queue())
+
     def test_open_for_write_good(self):
         """
         Test to see if open_for_write works in normal case
@@ -352,6 +635,254 @@ class ImageCacheTestCase(object):
         self.assertFalse(os.path.exists(incomplete_file_path))
         self.assertFalse(os.path.exists(invalid_file_path))
 
+    def test_claim_fill(self):
+        """
+        Test that only one request at a time can claim filling the cache
+        with an image, and that a stalled claim can be taken over.
+        """
+        image_id = '1'
+        self.assertTrue(self.cache.claim_fill(image_id))
+        self.assertTrue(self.cache.is_being_filled(image_id))
+        self.assertFalse(self.cache.claim_fill(image_id))
+
+        self.cache.release_fill(image_id)
+        self.assertFalse(self.cache.is_being_filled(image_id))
+        self.assertTrue(self.cache.claim_fill(image_id))
+
+        incomplete_file_path = os.path.join(self.cache_dir,
+                                            'incomplete', image_id)
+        stalled = time.time() - 60
+        os.utime(incomplete_file_path, (stalled, stalled))
+        self.config(image_cache_fill_stall_timeout=30)
+        self.assertTrue(self.cache.claim_fill(image_id))
+
+    def test_stalled_fill_resumes_after_takeover(self):
+        """
+        Test that a stalled fill that resumes after another request took
+        its claim over neither commits nor rolls back the new fill.
+        """
+        image_id = '1'
+        self.config(image_cache_fill_stall_timeout=30)
+        self.assertTrue(self.cache.claim_fill(image_id))
+        stalled_iter = self.cache.get_caching_iter(
+            image_id, None, iter(['a', 'b', 'c']), claimed=True)
+        self.assertEqual('a', stalled_iter.next())
+
+        incomplete_file_path = os.path.join(self.cache_dir,
+                                            'incomplete', image_id)
+        stalled = time.time() - 60
+        os.utime(incomplete_file_path, (stalled, stalled))
+        self.assertTrue(self.cache.claim_fill(image_id))
+        caching_iter = self.cache.get_caching_iter(
+            image_id, None, iter(['x', 'y', 'z']), claimed=True)
+        self.assertEqual('x', caching_iter.next())
+
+        self.assertEqual(['b', 'c'], list(stalled_iter))
+        self.assertFalse(self.cache.is_cached(image_id))
+        self.assertTrue(os.path.exists(incomplete_file_path))
+
+        self.assertEqual(['y', 'z'], list(caching_iter))
+        self.assertTrue(self.cache.is_cached(image_id))
+        with self.cache.open_for_read(image_id) as cache_file:
+            self.assertEqual('xyz', ''.join(cache_file))
+        self.assertEqual(3, self.cache.get_image_size(image_id))
+
+    def test_range_iterator(self):
+        """
+        Test that ranges of an image are read from its cached blocks, with
+        the missing blocks read from the store and added to the cache, and
+        that the image is cached once all of its blocks are.
+        """
+        self.config(image_cache_block_size=256)
+        image_id = '1'
+        data = ''.join(chr(i % 251) for i in xrange(FIXTURE_LENGTH))
+        checksum = hashlib.md5(data).hexdigest()
+        fetches = []
+
+        def fetch():
+            fetches.append(True)
+            return iter([data[i:i + 100]
+                         for i in xrange(0, FIXTURE_LENGTH, 100)])
+
+        def read_range(start, stop):
+            return ''.join(self.cache.get_range_iter(
+                image_id, FIXTURE_LENGTH, checksum, start, stop, fetch))
+
+        self.assertEqual(data[300:600], read_range(300, 600))
+        self.assertEqual(1, len(fetches))
+        self.assertFalse(self.cache.is_cached(image_id))
+
+        # Blocks 0 to 2 were cached on the way
+        self.assertEqual(data[10:700], read_range(10, 700))
+        self.assertEqual(1, len(fetches))
+
+        self.assertEqual(data[700:], read_range(700, FIXTURE_LENGTH))
+        self.assertEqual(2, len(fetches))
+        eventlet.sleep(0)
+        self.assertTrue(self.cache.is_cached(image_id))
+        partial_file_path = os.path.join(self.cache_dir, 'partial', image_id)
+        self.assertFalse(os.path.exists(partial_file_path))
+
+    def test_range_iterator_not_admitted(self):
+        """
+        Test that the blocks of an image that is not admitted into the
+        cache are read from the store without being cached.
+        """
+        self.config(image_cache_block_size=256)
+        image_id = '1'
+
+        def fetch():
+            return iter([FIXTURE_DATA])
+
+        for x in xrange(2):
+            self.assertEqual(FIXTURE_DATA[300:600], ''.join(
+                self.cache.get_range_iter(image_id, FIXTURE_LENGTH, None,
+                                          300, 600, fetch, admitted=False)))
+        partial_file_path = os.path.join(self.cache_dir, 'partial', image_id)
+        self.assertFalse(os.path.exists(partial_file_path))
+
+    def test_interrupted_fill_is_kept(self):
+        """
+        Test that the blocks an abandoned fill wrote are kept as a partly
+        cached image.
+        """
+        self.config(image_cache_block_size=256)
+        image_id = '1'
+        data = [FIXTURE_DATA[i:i + 100]
+                for i in xrange(0, FIXTURE_LENGTH, 100)]
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        for x in xrange(6):
+            next(caching_iter)
+        caching_iter.close()
+        self.assertFalse(self.cache.is_cached(image_id))
+
+        def fetch():
+            self.fail("Cached blocks were read from the store")
+
+        self.assertEqual(FIXTURE_DATA[:512], ''.join(
+            self.cache.get_range_iter(image_id, FIXTURE_LENGTH, None,
+                                      0, 512, fetch)))
+        invalid_file_path = os.path.join(self.cache_dir, 'invalid', image_id)
+        self.assertTrue(os.path.exists(invalid_file_path))
+
+    def test_interrupted_fill_is_merged(self):
+        """
+        Test that the blocks an abandoned fill wrote are added to those
+        already cached of the same image.
+        """
+        self.config(image_cache_block_size=256)
+        image_id = '1'
+        partial_image = partial.PartialImage(
+            os.path.join(self.cache_dir, 'partial', image_id), 256)
+        partial_image.set_size(FIXTURE_LENGTH)
+        partial_image.write_block(3, FIXTURE_DATA[768:])
+
+        data = [FIXTURE_DATA[i:i + 100]
+                for i in xrange(0, FIXTURE_LENGTH, 100)]
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        for x in xrange(6):
+            next(caching_iter)
+        caching_iter.close()
+
+        def fetch():
+            self.fail("Cached blocks were read from the store")
+
+        self.assertEqual(FIXTURE_DATA[:512] + FIXTURE_DATA[768:], ''.join(
+            [''.join(self.cache.get_range_iter(image_id, FIXTURE_LENGTH,
+                                               None, start, stop, fetch))
+             for start, stop in ((0, 512), (768, FIXTURE_LENGTH))]))
+
+    def test_partial_images_pruned(self):
+        """
+        Test that partly cached images count towards the size of the cache
+        and are pruned.
+        """
+        self.config(image_cache_block_size=256)
+        self._setup_fixture_file()
+        self.assertEqual(FIXTURE_DATA[:256], ''.join(
+            self.cache.get_range_iter('2', FIXTURE_LENGTH, None, 0, 256,
+                                      lambda: iter([FIXTURE_DATA]))))
+        partial_size = self.cache.get_cache_size() - FIXTURE_LENGTH
+        self.assertTrue(partial_size >= 256)
+        partial_file_path = os.path.join(self.cache_dir, 'partial', '2')
+        os.utime(partial_file_path, (time.time() - 5, time.time() - 5))
+
+        self.config(image_cache_max_size=FIXTURE_LENGTH)
+        self.assertEqual((1, partial_size), self.cache.prune())
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
+        self.assertTrue(self.cache.is_cached(1))
+
+    def test_resume_fill(self):
+        """
+        Test that an interrupted fill is resumed from its cached blocks.
+        """
+        self.config(image_cache_block_size=256)
+        image_id = '1'
+        self.assertFalse(self.cache.resume_fill(image_id, FIXTURE_LENGTH,
+                                                None, None))
+
+        data = [FIXTURE_DATA[i:i + 100]
+                for i in xrange(0, FIXTURE_LENGTH, 100)]
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        for x in xrange(6):
+            next(caching_iter)
+        caching_iter.close()
+        self.assertFalse(self.cache.is_cached(image_id))
+
+        checksum = hashlib.md5(FIXTURE_DATA).hexdigest()
+        self.assertTrue(self.cache.resume_fill(image_id, FIXTURE_LENGTH,
+                                               checksum, lambda: data))
+        self.assertTrue(self.cache.is_cached(image_id))
+        with self.cache.open_for_read(image_id) as cache_file:
+            self.assertEqual(FIXTURE_DATA, ''.join(cache_file))
+
+    def test_tailing_iterator(self):
+        """
+        Test that a request can read an image while another request is
+        writing it into the cache.
+        """
+        image_id = '1'
+        data = ['a', 'b', 'c', 'd']
+        self.assertTrue(self.cache.claim_fill(image_id))
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data), claimed=True)
+
+        def fallback():
+            self.fail('fallback should not be used')
+
+        tailing_iter = self.cache.get_tailing_iter(image_id, fallback)
+        self.assertEqual('a', caching_iter.next())
+        self.assertEqual('a', tailing_iter.next())
+        self.assertEqual(data[1:], list(caching_iter))
+        self.assertTrue(self.cache.is_cached(image_id))
+        self.assertEqual('bcd', ''.join(tailing_iter))
+
+    def test_tailing_iterator_fill_fails(self):
+        """
+        Test that a request reading an image as it is written into the
+        cache reads the rest from its fallback if the fill fails.
+        """
+        def faulty_backend():
+            yield 'ab'
+            raise exception.GlanceException('Backend failure')
+
+        image_id = '1'
+        self.assertTrue(self.cache.claim_fill(image_id))
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   faulty_backend(),
+                                                   claimed=True)
+        tailing_iter = self.cache.get_tailing_iter(
+            image_id, lambda: iter(['a', 'bc', 'd']))
+
+        self.assertEqual('ab', caching_iter.next())
+        self.assertEqual('ab', tailing_iter.next())
+        self.assertRaises(exception.GlanceException, caching_iter.next)
+        self.assertFalse(self.cache.is_cached(image_id))
+        self.assertEqual(['c', 'd'], list(tailing_iter))
+
     def test_caching_iterator_handles_backend_failure(self):
         """
         Test that when the backend fails, caching_iter does not continue trying
@@ -512,6 +1043,84 @@ class TestImageCacheXattr(test_utils.BaseTestCase,
             self.disabled_message = ("filesystem does not support xattr")
             return
 
+    @skip_if_disabled
+    def test_index(self):
+        """
+        Test that the driver's index follows its own writes, reads and
+        deletes, and picks up images added by other processes.
+        """
+        driver = self.cache.driver
+        for x in xrange(3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        with self.cache.open_for_read(0) as cache_file:
+            for chunk in cache_file:
+                pass
+
+        self.assertEqual(3 * 1024, self.cache.get_cache_size())
+        self.assertEqual(('1', 1024), driver.get_least_recently_accessed())
+        self.assertEqual([1, 0, 0], [entry['hits'] for entry in
+                                     self.cache.get_cached_images()])
+
+        self.cache.delete_cached_image(1)
+        self.assertEqual(('2', 1024), driver.get_least_recently_accessed())
+
+        # An image cached by another process
+        with open(os.path.join(self.cache_dir, 'other'), 'wb') as f:
+            f.write('X' * 512)
+        self.assertEqual(2 * 1024 + 512, self.cache.get_cache_size())
+        self.assertEqual(['0', '2', 'other'],
+                         [entry['image_id'] for entry in
+                          self.cache.get_cached_images()])
+
+        # And deleted by another process
+        os.unlink(os.path.join(self.cache_dir, '0'))
+        self.assertEqual(1024 + 512, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_index_replaced_file(self):
+        """
+        Test that the index picks up an image file another process replaced
+        under the same image ID.
+        """
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+        self.assertEqual(1024, self.cache.get_cache_size())
+
+        tmp_path = os.path.join(self.cache_dir, 'incomplete', '0')
+        with open(tmp_path, 'wb') as f:
+            f.write('X' * 512)
+        os.rename(tmp_path, os.path.join(self.cache_dir, '0'))
+        self.assertEqual(512, self.cache.get_cache_size())
+
+    @skip_if_disabled
+    def test_index_own_changes_not_relisted(self):
+        """
+        Test that the driver's own changes and repeated queries do not list
+        the cache directory again.
+        """
+        from glance.image_cache.drivers import xattr as xattr_driver
+
+        self.cache.get_cache_size()
+        listings = []
+        real_get_all_regular_files = xattr_driver.get_all_regular_files
+
+        def get_all_regular_files(basepath):
+            if basepath == self.cache.driver.base_dir:
+                listings.append(basepath)
+            return real_get_all_regular_files(basepath)
+
+        self.stubs.Set(xattr_driver, 'get_all_regular_files',
+                       get_all_regular_files)
+        for x in xrange(3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.cache.delete_cached_image(1)
+        for x in xrange(3):
+            self.assertEqual(2 * 1024, self.cache.get_cache_size())
+        self.assertEqual([], listings)
+
 
 class TestImageCacheSqlite(test_utils.BaseTestCase,
                            ImageCacheTestCase):
@@ -545,6 +1154,366 @@ class TestImageCacheSqlite(test_utils.BaseTestCase,
                     image_cache_max_size=1024 * 5)
         self.cache = image_cache.ImageCache()
 
+    @skip_if_disabled
+    def test_buffered_hits(self):
+        """
+        Test that hits are buffered in memory until the flush interval
+        passes or hit data is read, and that the WAL files of the database
+        are not counted as cached images.
+        """
+        import sqlite3
+
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self._setup_fixture_file()
+        db_path = self.cache.driver.db_path
+
+        def stored_hits():
+            conn = sqlite3.connect(db_path)
+            try:
+                cur = conn.execute("SELECT hits FROM cached_images")
+                return cur.fetchone()[0]
+            finally:
+                conn.close()
+
+        for x in xrange(3):
+            with self.cache.open_for_read(1) as cache_file:
+                for chunk in cache_file:
+                    pass
+
+        self.assertEqual(0, stored_hits())
+        self.assertEqual(3, self.cache.get_hit_count(1))
+        self.assertEqual(3, stored_hits())
+
+        self.assertTrue(os.path.exists(db_path + '-wal'))
+        self.assertEqual(FIXTURE_LENGTH, self.cache.get_cache_size())
+
+        self.config(image_cache_sqlite_hit_flush_interval=0)
+        with self.cache.open_for_read(1) as cache_file:
+            for chunk in cache_file:
+                pass
+        self.assertEqual(4, stored_hits())
+
+    @skip_if_disabled
+    def test_buffered_hits_flushed_on_timer(self):
+        """
+        Test that buffered hits are written out once the flush interval
+        passes, without waiting for another hit.
+        """
+        import sqlite3
+
+        self.config(image_cache_sqlite_hit_flush_interval=1)
+        self._setup_fixture_file()
+        db_path = self.cache.driver.db_path
+        with self.cache.open_for_read(1) as cache_file:
+            for chunk in cache_file:
+                pass
+
+        eventlet.sleep(1.1)
+        conn = sqlite3.connect(db_path)
+        try:
+            cur = conn.execute("SELECT hits FROM cached_images")
+            self.assertEqual(1, cur.fetchone()[0])
+        finally:
+            conn.close()
+
+
+class TestImageCacheShardedDirs(test_utils.BaseTestCase):
+
+    """Tests an image cache spread over several directories"""
+
+    def setUp(self):
+        super(TestImageCacheShardedDirs, self).setUp()
+        base_dir = self.useFixture(fixtures.TempDir()).path
+        self.cache_dirs = [os.path.join(base_dir, 'disk%d' % x)
+                           for x in xrange(3)]
+        self.config(image_cache_dirs=['%s:%d' % (path, 1024 * 3)
+                                      for path in self.cache_dirs],
+                    image_cache_driver='sqlite')
+        self.cache = image_cache.ImageCache()
+
+    def test_placement(self):
+        """
+        Test that images are spread over the directories, and that stats
+        cover all of them.
+        """
+        for x in xrange(12):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        for x in xrange(12):
+            self.assertTrue(self.cache.is_cached(x))
+            path = self.cache.driver.get_image_filepath(x)
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(path.startswith(
+                self.cache.driver.driver_for(x).base_dir))
+
+        used_dirs = [path for path in self.cache_dirs
+                     if any(name.isdigit() for name in os.listdir(path))]
+        self.assertTrue(len(used_dirs) > 1)
+        self.assertEqual(12 * 1024, self.cache.get_cache_size())
+        self.assertEqual(12, len(self.cache.get_cached_images()))
+
+    def test_prune_per_directory(self):
+        """
+        Test that each directory is pruned against its own size limit
+        """
+        for x in xrange(30):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        self.cache.prune()
+
+        for driver, max_size in self.cache.get_cache_shards():
+            self.assertEqual(1024 * 3, max_size)
+            self.assertTrue(driver.get_cache_size() <= max_size)
+
+    def test_adding_directory_moves_few_images(self):
+        """
+        Test that adding a directory only moves the images placed on it
+        """
+        image_ids = ['image-%d' % x for x in xrange(1000)]
+        ring = sharding.HashRing(self.cache_dirs)
+        bigger_ring = sharding.HashRing(self.cache_dirs + ['/disk3'])
+        moved = [image_id for image_id in image_ids
+                 if ring.get_node(image_id) !=
+                 bigger_ring.get_node(image_id)]
+        self.assertTrue(len(moved) < 400)
+        for image_id in moved:
+            self.assertEqual('/disk3', bigger_ring.get_node(image_id))
+
+    def test_queued_image_removed_while_listing(self):
+        """
+        Test that an image taken off the queue by another process while
+        the queues are listed is left out of the listing.
+        """
+        for image_id in ('a', 'b', 'c'):
+            self.assertTrue(self.cache.queue_image(image_id))
+        driver = self.cache.driver.driver_for('b')
+        listed = driver.get_queued_images()
+        os.unlink(driver.get_image_filepath('b', 'queue'))
+        self.stubs.Set(driver, 'get_queued_images', lambda: listed)
+
+        self.assertEqual(['a', 'c'], sorted(self.cache.get_queued_images()))
+
+    def test_parse_cache_dirs(self):
+        self.assertEqual([('/a', 10), ('/b', 20)],
+                         sharding.parse_cache_dirs(['/a', '/b:20'], 10))
+        self.assertRaises(exception.BadDriverConfiguration,
+                          sharding.parse_cache_dirs, ['/a:big'], 10)
+
+
+class TestPrefetchPlanner(test_utils.BaseTestCase):
+
+    """Tests picking the images to prefetch"""
+
+    def setUp(self):
+        super(TestPrefetchPlanner, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 10,
+                    image_cache_high_watermark=1.0,
+                    image_cache_prefetch_budget=1024 * 4)
+        self.cache = image_cache.ImageCache()
+        self.new_images = []
+        self.images = {}
+
+        def fake_get_images_detail(context, **kwargs):
+            self.assertEqual('active', kwargs['filters']['status'])
+            return self.new_images
+
+        def fake_get_image_metadata(context, image_id):
+            try:
+                return self.images[image_id]
+            except KeyError:
+                raise exception.NotFound()
+
+        self.stubs.Set(planner.registry, 'get_images_detail',
+                       fake_get_images_detail)
+        self.stubs.Set(planner.registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+
+    def _add_image(self, image_id, size=1024, status='active'):
+        self.images[image_id] = {'id': image_id, 'size': size,
+                                 'status': status, 'deleted': False}
+        return self.images[image_id]
+
+    def test_record_miss(self):
+        for x in xrange(3):
+            self.cache.record_miss('a')
+        self.cache.record_miss('b')
+        misses = self.cache.get_misses()
+        self.assertEqual(3, misses['a'][0])
+        self.assertEqual(1, misses['b'][0])
+
+        self.cache.forget_misses('a')
+        self.assertEqual(['b'], self.cache.get_misses().keys())
+
+    def test_plan_by_misses(self):
+        for image_id, misses in (('hot', 5), ('warm', 3), ('cold', 1)):
+            self._add_image(image_id)
+            for x in xrange(misses):
+                self.cache.record_miss(image_id)
+
+        queued = planner.PrefetchPlanner(self.cache).plan(None)
+        self.assertEqual(['hot', 'warm'], queued)
+        self.assertEqual(['hot', 'warm'],
+                         sorted(self.cache.get_queued_images()))
+        self.assertEqual(['cold'], self.cache.get_misses().keys())
+
+    def test_plan_after_images_queued_by_hand(self):
+        self.assertTrue(self.cache.queue_image('by-hand'))
+        self._add_image('hot')
+        for x in xrange(5):
+            self.cache.record_miss('hot')
+
+        queued = planner.PrefetchPlanner(self.cache).plan(None)
+        self.assertEqual(['hot'], queued)
+        self.assertEqual(['by-hand', 'hot'], self.cache.get_prefetch_queue())
+
+    def test_plan_skips_unusable_images(self):
+        self._add_image('big', size=1024 * 5)
+        self._add_image('killed', status='killed')
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('cached', FIXTURE_FILE))
+        for image_id in ('big', 'killed', 'cached', 'unknown'):
+            for x in xrange(3):
+                self.cache.record_miss(image_id)
+
+        self.assertEqual([], planner.PrefetchPlanner(self.cache).plan(None))
+        self.assertEqual(['big', 'cached'],
+                         sorted(self.cache.get_misses().keys()))
+
+    def test_plan_new_images(self):
+        self.new_images = [self._add_image('new')]
+        self._add_image('missed')
+        for x in xrange(3):
+            self.cache.record_miss('missed')
+
+        queued = planner.PrefetchPlanner(self.cache).plan(None)
+        self.assertEqual(['new', 'missed'], queued)
+
+    def test_plan_stays_below_high_watermark(self):
+        self.config(image_cache_high_watermark=0.3)
+        for x in xrange(2):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        for image_id in ('a', 'b'):
+            self._add_image(image_id)
+            for x in xrange(3):
+                self.cache.record_miss(image_id)
+
+        queued = planner.PrefetchPlanner(self.cache).plan(None)
+        self.assertEqual(1, len(queued))
+
+
+class TestPrefetchRateLimiter(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPrefetchRateLimiter, self).setUp()
+        self.now = 1000.0
+        self.sleeps = []
+
+        def fake_sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        self.stubs.Set(prefetcher.time, 'time', lambda: self.now)
+        self.stubs.Set(prefetcher.eventlet, 'sleep', fake_sleep)
+
+    def test_limit(self):
+        limiter = prefetcher.RateLimiter(100)
+        first = limiter.limit(['a' * 100, 'b' * 50])
+        second = limiter.limit(['c' * 100])
+        self.assertEqual('a' * 100, next(first))
+        self.assertEqual('c' * 100, next(second))
+        self.assertEqual('b' * 50, next(first))
+        self.assertEqual([1.0, 1.0], self.sleeps)
+
+    def test_no_limit(self):
+        limiter = prefetcher.RateLimiter(0)
+        self.assertEqual(['a'] * 3, list(limiter.limit(['a'] * 3)))
+        self.assertEqual([], self.sleeps)
+
+
+class TestPrefetcher(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 10)
+        self.stubs.Set(prefetcher.registry, 'configure_registry_client',
+                       lambda: None)
+        self.stubs.Set(prefetcher.registry, 'configure_registry_admin_creds',
+                       lambda: None)
+        self.image_meta = {'id': '1', 'status': 'active',
+                           'size': FIXTURE_LENGTH,
+                           'checksum': hashlib.md5(FIXTURE_DATA).hexdigest(),
+                           'location': 'file:///tmp/1'}
+        self.stubs.Set(prefetcher.registry, 'get_image_metadata',
+                       lambda context, image_id: self.image_meta)
+        self.store_reads = []
+
+        def fake_get_from_backend(context, location):
+            self.store_reads.append(location)
+            return iter([FIXTURE_DATA]), FIXTURE_LENGTH
+
+        self.stubs.Set(prefetcher.glance.store, 'get_from_backend',
+                       fake_get_from_backend)
+        self.prefetcher = prefetcher.Prefetcher()
+
+    def test_fetch_image_into_cache(self):
+        cache = self.prefetcher.cache
+        cache.queue_image('1')
+        self.assertTrue(self.prefetcher.fetch_image_into_cache('1'))
+        self.assertTrue(cache.is_cached('1'))
+        self.assertFalse(cache.is_queued('1'))
+
+    def test_fetch_image_into_cache_claim_held(self):
+        """
+        Test that an image another request is writing into the cache is
+        skipped rather than written a second time.
+        """
+        cache = self.prefetcher.cache
+        cache.queue_image('1')
+        self.assertTrue(cache.claim_fill('1'))
+
+        self.assertTrue(self.prefetcher.fetch_image_into_cache('1'))
+        self.assertEqual([], self.store_reads)
+        self.assertTrue(cache.is_being_filled('1'))
+        self.assertFalse(cache.is_cached('1'))
+        self.assertTrue(cache.is_queued('1'))
+
+
+class TestAdmissionPolicy(test_utils.BaseTestCase):
+
+    def test_default_admits_everything(self):
+        self.assertEqual(None, admission.AdmissionPolicy.from_config().check(
+            10 * 1024 ** 3, 'iso', 0))
+
+    def test_size_limits(self):
+        policy = admission.AdmissionPolicy(
+            max_image_size=1000,
+            disk_format_limits={'iso': 0, 'qcow2': 500})
+        self.assertEqual(None, policy.check(1000, 'raw', 1))
+        self.assertEqual(None, policy.check(None, 'raw', 1))
+        self.assertNotEqual(None, policy.check(1001, 'raw', 1))
+        self.assertNotEqual(None, policy.check(10, 'iso', 1))
+        self.assertEqual(None, policy.check(500, 'qcow2', 1))
+        self.assertNotEqual(None, policy.check(501, 'qcow2', 1))
+
+    def test_min_misses(self):
+        policy = admission.AdmissionPolicy(min_misses=3)
+        self.assertNotEqual(None, policy.check(10, 'raw', 2))
+        self.assertEqual(None, policy.check(10, 'raw', 3))
+
+    def test_parse_disk_format_limits(self):
+        self.assertEqual({'iso': 0, 'raw': 1024},
+                         admission.parse_disk_format_limits(
+                             ['iso:0', ' raw:1024']))
+        self.assertRaises(exception.BadDriverConfiguration,
+                          admission.parse_disk_format_limits, ['iso'])
+
 
 class TestImageCacheNoDep(test_utils.BaseTestCase):
 
@@ -556,8 +1525,13 @@ class TestImageCacheNoDep(test_utils.BaseTestCase):
         def init_driver(self2):
             self2.driver = self.driver
 
+        def init_stats(self2):
+            self2.stats = stats.CacheStats(self.test_dir, 5)
+
+        self.config(image_cache_block_size=0)
         self.stubs = stubout.StubOutForTesting()
         self.stubs.Set(image_cache.ImageCache, 'init_driver', init_driver)
+        self.stubs.Set(image_cache.ImageCache, 'init_stats', init_stats)
         self.addCleanup(self.stubs.UnsetAll)
 
     def test_get_caching_iter_when_write_fails(self):
@@ -601,3 +1575,88 @@ class TestImageCacheNoDep(test_utils.BaseTestCase):
 
         caching_iter = cache.get_caching_iter('dummy_id', None, iter(data))
         self.assertEqual(list(caching_iter), data)
+
+
+class TestEvictionPolicies(test_utils.BaseTestCase):
+
+    def _entry(self, image_id, size, hits, last_accessed):
+        return {'image_id': image_id, 'size': size, 'hits': hits,
+                'last_accessed': last_accessed, 'last_modified': 0}
+
+    def setUp(self):
+        super(TestEvictionPolicies, self).setUp()
+        # One large image hit a few times and many small ones hit once,
+        # the large image being the least recently used.
+        self.entries = [self._entry('large', 1000, 4, 1)]
+        self.entries.extend(self._entry('small%d' % x, 100, 1, 2 + x)
+                            for x in xrange(10))
+
+    def _victims(self, policy, bytes_to_free):
+        victims = policy.select_victims(self.entries, bytes_to_free)
+        return [entry['image_id'] for entry in victims]
+
+    def test_get_policy(self):
+        self.assertTrue(isinstance(eviction.get_policy('LRU'),
+                                   eviction.LRUPolicy))
+        policy = eviction.get_policy('glance.image_cache.eviction.GDSFPolicy')
+        self.assertTrue(isinstance(policy, eviction.GDSFPolicy))
+        self.assertRaises(ImportError, eviction.get_policy, 'bogus')
+
+    def test_unknown_policy_defaults_to_lru(self):
+        self.config(image_cache_dir=self.useFixture(fixtures.TempDir()).path,
+                    image_cache_eviction_policy='bogus')
+        cache = image_cache.ImageCache()
+        self.assertTrue(isinstance(cache.eviction_policy,
+                                   eviction.LRUPolicy))
+
+    def test_lru(self):
+        self.assertEqual(['large'], self._victims(eviction.LRUPolicy(), 1))
+        self.assertEqual(['large', 'small0'],
+                         self._victims(eviction.LRUPolicy(), 1001))
+        self.assertEqual([], self._victims(eviction.LRUPolicy(), 0))
+
+    def test_lfu(self):
+        self.assertEqual(['small0', 'small1'],
+                         self._victims(eviction.LFUPolicy(), 150))
+
+    def test_gdsf(self):
+        # The large image is worth (4 + 1) / 1000 per byte, each small
+        # image (1 + 1) / 100, so the large image goes first.
+        self.assertEqual(['large'], self._victims(eviction.GDSFPolicy(), 1))
+        self.entries[0]['hits'] = 40
+        self.assertEqual(['small0'], self._victims(eviction.GDSFPolicy(), 1))
+
+    def test_arc(self):
+        policy = eviction.ARCPolicy()
+        del self.entries[3:]
+        # With no history the recency list is evicted first
+        self.assertEqual(['small0', 'small1'], self._victims(policy, 200))
+        self.assertEqual(['small0', 'small1'],
+                         policy.recent_ghosts.keys())
+
+        # Ghosts of the recency list coming back grow its target size,
+        # so the frequency list is evicted instead
+        self.entries = [self.entries[0],
+                        self._entry('small0', 100, 1, 10),
+                        self._entry('small1', 100, 1, 11)]
+        self.assertEqual(['large'], self._victims(policy, 100))
+        self.assertEqual([], policy.recent_ghosts.keys())
+        self.assertEqual(['large'], policy.frequent_ghosts.keys())
+
+    def test_arc_state_saved(self):
+        policy = eviction.ARCPolicy()
+        del self.entries[3:]
+        self._victims(policy, 200)
+        state_path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                  'eviction.json')
+        eviction.save_state(policy, state_path)
+
+        # A new pruner process picks up the ghosts of the previous one
+        policy = eviction.ARCPolicy()
+        eviction.load_state(policy, state_path)
+        self.assertEqual(['small0', 'small1'],
+                         policy.recent_ghosts.keys())
+        self.entries = [self.entries[0],
+                        self._entry('small0', 100, 1, 10),
+                        self._entry('small1', 100, 1, 11)]
+        self.assertEqual(['large'], self._victims(policy, 100))
@@ -1040,3 +1040,43 @@ class TestMigrations(utils.BaseTestCase):
     def _post_downgrade_030(self, engine):
         self.assertRaises(sqlalchemy.exc.NoSuchTableError,
                           get_table, engine, 'tasks')
+
+    def _check_031(self, engine, data):
+        images_table = get_table(engine, 'images')
+        index_data = [(idx.name, idx.columns.keys())
+                      for idx in images_table.indexes]
+
+        self.assertIn(('ix_images_deleted_is_public_created_at',
+                       ['deleted', 'is_public', 'created_at', 'id']),
+                      index_data)
+        self.assertIn(('ix_images_owner_created_at',
+                       ['owner', 'created_at', 'id']), index_data)
+
+    def _post_downgrade_031(self, engine):
+        images_table = get_table(engine, 'images')
+        index_names = [idx.name for idx in images_table.indexes]
+
+        self.assertNotIn('ix_images_deleted_is_public_created_at',
+                         index_names)
+        self.assertNotIn('ix_images_owner_created_at', index_names)
+
+    def _check_032(self, engine, data):
+        # NOTE: indexes on expressions are not reflected on PostgreSQL
+        if engine.name != 'postgresql':
+            image_properties = get_table(engine, 'image_properties')
+            index_names = [idx.name for idx in image_properties.indexes]
+            self.assertIn('ix_image_properties_name_value', index_names)
+
+        image_tags = get_table(engine, 'image_tags')
+        index_data = [(idx.name, idx.columns.keys())
+                      for idx in image_tags.indexes]
+        self.assertIn(('ix_image_tags_value', ['value']), index_data)
+
+    def _post_downgrade_032(self, engine):
+        image_properties = get_table(engine, 'image_properties')
+        index_names = [idx.name for idx in image_properties.indexes]
+        self.assertNotIn('ix_image_properties_name_value', index_names)
+
+        image_tags = get_table(engine, 'image_tags')
+        index_names = [idx.name for idx in image_tags.indexes]
+        self.assertNotIn('ix_image_tags_value', index_names)
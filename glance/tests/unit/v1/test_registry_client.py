@@ -19,6 +19,7 @@ import copy
 import datetime
 import os
 import stubout
+import time
 
 import mox
 
@@ -917,6 +918,86 @@ class TestRegistryV1ClientApi(base.IsolatedUnitTest):
         self.assertEquals(rapi._CLIENT_CREDS, expected)
 
 
+class TestRegistryV1ClientMetadataCache(base.IsolatedUnitTest):
+
+    def setUp(self):
+        super(TestRegistryV1ClientMetadataCache, self).setUp()
+        reload(rapi)
+        self.config(registry_client_metadata_cache_ttl=60)
+        rapi.configure_registry_client()
+        self.context = context.RequestContext(tenant=UUID2)
+        self.fetched = []
+        self.updated_at = timeutils.utcnow()
+
+        def fake_get_image(client, image_id):
+            self.fetched.append(image_id)
+            return {'id': image_id, 'updated_at': self.updated_at,
+                    'properties': {}}
+
+        def fake_update_image(client, image_id, image_meta, purge_props):
+            return image_meta
+
+        self.stubs.Set(rclient.RegistryClient, 'get_image', fake_get_image)
+        self.stubs.Set(rclient.RegistryClient, 'update_image',
+                       fake_update_image)
+
+    def test_get_image_metadata_cached(self):
+        image_meta = rapi.get_image_metadata(self.context, UUID1)
+        image_meta['properties']['foo'] = 'bar'
+        image_meta = rapi.get_image_metadata(self.context, UUID1)
+        self.assertEqual({}, image_meta['properties'])
+        self.assertEqual([UUID1], self.fetched)
+
+    def test_get_image_metadata_cached_by_context(self):
+        other_context = context.RequestContext(tenant=_gen_uuid())
+        rapi.get_image_metadata(self.context, UUID1)
+        rapi.get_image_metadata(other_context, UUID1)
+        self.assertEqual([UUID1, UUID1], self.fetched)
+
+    def test_update_image_metadata_invalidates(self):
+        rapi.get_image_metadata(self.context, UUID1)
+        rapi.update_image_metadata(self.context, UUID1, {'name': 'new'})
+        rapi.get_image_metadata(self.context, UUID1)
+        self.assertEqual([UUID1, UUID1], self.fetched)
+
+    def test_get_image_metadata_expired(self):
+        self.config(registry_client_metadata_cache_ttl=1)
+        rapi.configure_registry_client()
+        now = time.time()
+        self.stubs.Set(time, 'time', lambda: now)
+        rapi.get_image_metadata(self.context, UUID1)
+        self.stubs.Set(time, 'time', lambda: now + 2)
+        rapi.get_image_metadata(self.context, UUID1)
+        self.assertEqual([UUID1, UUID1], self.fetched)
+
+    def test_get_image_metadata_newer_update_drops_other_contexts(self):
+        other_context = context.RequestContext(tenant=_gen_uuid())
+        rapi.get_image_metadata(self.context, UUID1)
+        self.updated_at = self.updated_at + datetime.timedelta(seconds=1)
+        rapi.get_image_metadata(other_context, UUID1)
+        rapi.get_image_metadata(self.context, UUID1)
+        self.assertEqual([UUID1, UUID1, UUID1], self.fetched)
+
+    def test_least_recently_used_dropped(self):
+        self.config(registry_client_metadata_cache_size=2)
+        rapi.configure_registry_client()
+        rapi.get_image_metadata(self.context, UUID1)
+        rapi.get_image_metadata(self.context, UUID2)
+        rapi.get_image_metadata(self.context, UUID1)
+        UUID3 = _gen_uuid()
+        rapi.get_image_metadata(self.context, UUID3)
+        rapi.get_image_metadata(self.context, UUID1)
+        rapi.get_image_metadata(self.context, UUID2)
+        self.assertEqual([UUID1, UUID2, UUID3, UUID2], self.fetched)
+
+    def test_cache_disabled(self):
+        self.config(registry_client_metadata_cache_ttl=0)
+        rapi.configure_registry_client()
+        rapi.get_image_metadata(self.context, UUID1)
+        rapi.get_image_metadata(self.context, UUID1)
+        self.assertEqual([UUID1, UUID1], self.fetched)
+
+
 class FakeResponse():
     status = 202
 
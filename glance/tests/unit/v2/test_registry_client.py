@@ -29,7 +29,9 @@ import mox
 
 from glance.common import config
 from glance.common import exception
+from glance.common import rpc
 from glance import context
+import glance.db.registry.api
 from glance.db.sqlalchemy import api as db_api
 from glance.openstack.common import timeutils
 from glance.openstack.common import uuidutils
@@ -90,6 +92,41 @@ class TestRegistryV2Client(base.IsolatedUnitTest,
         images = self.client.image_get_all()
         self.assertEquals(len(images), 2)
 
+    def test_image_get_with_tags(self):
+        self.config(registry_host='0.0.0.0', registry_port=9191)
+        glance.db.registry.api.setup_db_env()
+        db_api.image_tag_create(self.context, UUID1, 'snap')
+        image, tags = glance.db.registry.api.image_get_with_tags(self.context,
+                                                                 UUID1)
+        self.assertEqual(UUID1, image['id'])
+        self.assertEqual(['snap'], tags)
+
+    def test_image_tag_get_all_for_images_old_registry(self):
+        """
+        Test that the tags of several images are got one image at a time
+        from a registry that predates image_tag_get_all_for_images.
+        """
+        self.config(registry_host='0.0.0.0', registry_port=9191)
+        glance.db.registry.api.setup_db_env()
+        self.addCleanup(glance.db.registry.api._NO_BULK_TAGS_REGISTRIES.clear)
+        db_api.image_tag_create(self.context, UUID1, 'snap')
+
+        orig_register = rpc.Controller.register
+        requests = []
+
+        def register(controller, resource, **kwargs):
+            requests.append(resource)
+            orig_register(controller, resource, **kwargs)
+            del controller._registered['image_tag_get_all_for_images']
+
+        self.stubs.Set(rpc.Controller, 'register', register)
+        for x in range(2):
+            tags = glance.db.registry.api.image_tag_get_all_for_images(
+                self.context, [UUID1, UUID2])
+            self.assertEqual({UUID1: ['snap'], UUID2: []}, tags)
+        # The registry is only asked for the command once
+        self.assertEqual(3, len(requests))
+
     def test_create_image_with_null_min_disk_min_ram(self):
         UUID3 = _gen_uuid()
         extra_fixture = self.get_fixture(id=UUID3, name='asdf', min_disk=None,